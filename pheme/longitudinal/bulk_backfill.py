@@ -0,0 +1,480 @@
+"""Set based backfill of new visits, bypassing the workers
+
+The `LongitudinalWorker` merges a visit one message at a time, which
+is appropriate for nightly increments and the tricky lab and clinical
+data, but far too slow when backfilling millions of historical
+visits.  `BulkBackfill` computes the same fact_visit rows for batches
+of visits with a handful of SQL statements in the data mart.
+
+As the warehouse and mart are distinct databases, the messages for
+each batch are extracted from the warehouse with `COPY ... TO STDOUT`
+and loaded into temporary staging tables in the mart with `COPY ...
+FROM STDIN`.
+
+"""
+import logging
+import tempfile
+import time
+
+from .longitudinal_worker import clinical_codes_of_interest
+from .select_or_insert import advisory_key
+
+ORM = 'ORM^O01^ORM_O01'
+ORU = 'ORU^R01^ORU_R01'
+CLINICAL_CODES = ', '.join(["'%s'" % code for code in
+                            sorted(clinical_codes_of_interest)])
+
+
+def _latest(expression, condition):
+    """SQL aggregate for the most recent value meeting condition
+
+    Mirrors the worker's 'keep the latest value, provided it has one'
+    handling of messages processed oldest to newest.
+
+    """
+    return ("(array_agg(%s ORDER BY message_datetime DESC, hl7_msh_id "
+            "DESC) FILTER (WHERE %s))[1]" % (expression, condition))
+
+
+def _first(expression):
+    """SQL aggregate for the value from the oldest message"""
+    return ("(array_agg(%s ORDER BY message_datetime, hl7_msh_id))[1]" %
+            expression)
+
+
+class BulkBackfill(object):
+    """Merge batches of new visits into fact_visit with set based SQL
+
+    Only visits new to the data mart (no fact_visit rows) whose
+    pending messages are all ADT or ORM messages are taken on.  Visits
+    with any of the following are left in the pending work queue for
+    the workers:
+
+    - ORU messages (labs and clinical observations)
+    - ADT messages carrying OBX segments of interest
+      (`clinical_codes_of_interest`)
+    - an unknown ('U') patient class
+    - a patient class lacking an admit_datetime
+
+    For each (visit_id, patient_class), patient_id and facility come
+    from the oldest message, first and last message from the min and
+    max message_datetime, and the remaining columns and single value
+    dimensions from the latest message with a value.  Diagnoses keep
+    the oldest message's rank and datetime for each (icd9, status).
+    Age is calculated from the YYYYMM dob, assuming mid month.  The
+    dimension rows needed are inserted as necessary, except for the
+    static dim_admission_source and dim_disposition tables.
+
+    Each batch of candidate visits is locked, merged, marked processed
+    and removed from internal_pending_visit in a single transaction,
+    so workers and distributed managers may run concurrently.  New
+    dimension rows are committed ahead of the batch, serialized with
+    the workers' own inserts (see `_insert_dimensions`).
+
+    """
+    BATCH_SIZE = 10000
+
+    # Dimension table locks (see TABLE_LOCKS) held while inserting,
+    # excluding workers inserting the same tables
+    DIMENSION_LOCKS = ('assigned_location_lock', 'admit_reason_lock',
+                       'chief_complaint_lock', 'diagnosis_lock',
+                       'location_lock', 'race_lock', 'service_area_lock')
+
+    # Single column dimensions: (table, column, bulk_visit_core source)
+    DIMENSIONS = (('dim_ar', 'admit_reason', 'chief_complaint'),
+                  ('dim_cc', 'chief_complaint', 'chief_complaint'),
+                  ('dim_assigned_location', 'location',
+                   'assigned_location'),
+                  ('dim_race', 'race', 'race'),
+                  ('dim_service_area', 'area', 'service_area'))
+
+    def __init__(self, warehouse_engine, mart_engine,
+                 batch_size=BATCH_SIZE, table_locks=None):
+        """Initialize the backfill
+
+        :param warehouse_engine: sqlalchemy engine for the warehouse
+        :param mart_engine: sqlalchemy engine for the data mart
+        :param batch_size: number of visits merged per transaction
+        :param table_locks: the manager's dictionary of in process
+          locks (see TABLE_LOCKS), if its workers use them
+
+        """
+        self.warehouse_engine = warehouse_engine
+        self.mart_engine = mart_engine
+        self.batch_size = batch_size
+        self.table_locks = table_locks or {}
+
+    def run(self):
+        """Backfill till no candidate visits remain
+
+        returns the number of visits merged
+
+        """
+        startTime = time.time()
+        warehouse = self.warehouse_engine.raw_connection()
+        mart = self.mart_engine.raw_connection()
+        try:
+            cursor = mart.cursor()
+            # Candidates already considered, so ineligible visits
+            # aren't locked and extracted over and over.  It outlives
+            # the batch transactions, so must be dropped before the
+            # connection goes back to the pool.
+            cursor.execute("DROP TABLE IF EXISTS bulk_seen")
+            cursor.execute("""CREATE TEMPORARY TABLE bulk_seen (
+            visit_id VARCHAR(255) PRIMARY KEY)""")
+            mart.commit()
+            cursor.close()
+
+            total = 0
+            while True:
+                count, merged = self._batch(warehouse, mart)
+                if not count:
+                    break
+                total += merged
+                logging.info("bulk backfill merged %d of %d candidate "
+                             "visits", merged, count)
+        finally:
+            try:
+                mart.rollback()
+                cursor = mart.cursor()
+                cursor.execute("DROP TABLE IF EXISTS bulk_seen")
+                mart.commit()
+                cursor.close()
+            finally:
+                warehouse.close()
+                mart.close()
+        logging.info("bulk backfill merged %d visits in %s", total,
+                     time.time() - startTime)
+        return total
+
+    def _batch(self, warehouse, mart):
+        """Merge the next batch of candidates in a single transaction
+
+        returns (number of candidates, number of visits merged)
+
+        """
+        cursor = mart.cursor()
+        try:
+            cursor.execute("""CREATE TEMPORARY TABLE bulk_visit (
+            visit_id VARCHAR(255) PRIMARY KEY) ON COMMIT DROP""")
+            cursor.execute("""INSERT INTO bulk_visit
+            SELECT visit_id FROM internal_pending_visit p
+            WHERE (p.lease_expires IS NULL OR p.lease_expires < now())
+            AND NOT EXISTS (SELECT 1 FROM bulk_seen s
+              WHERE s.visit_id = p.visit_id)
+            AND NOT EXISTS (SELECT 1 FROM fact_visit f
+              WHERE f.visit_id = p.visit_id)
+            ORDER BY p.oldest_message LIMIT %(batch_size)s
+            FOR UPDATE SKIP LOCKED""", {'batch_size': self.batch_size})
+            count = cursor.rowcount
+            if not count:
+                mart.rollback()
+                return 0, 0
+            cursor.execute("INSERT INTO bulk_seen SELECT visit_id "
+                           "FROM bulk_visit")
+
+            self._stage(warehouse, mart)
+            merged = self._merge(cursor)
+            mart.commit()
+            return count, merged
+        except:
+            mart.rollback()
+            raise
+
+    def _stage(self, warehouse, mart):
+        """Copy the batch's unprocessed messages into the mart"""
+        msh_ids = tempfile.TemporaryFile()
+        messages = tempfile.TemporaryFile()
+        dxes = tempfile.TemporaryFile()
+        try:
+            cursor = mart.cursor()
+            cursor.copy_expert("""COPY (SELECT hl7_msh_id
+            FROM internal_message_processed JOIN bulk_visit
+            USING (visit_id) WHERE processed_datetime IS NULL)
+            TO STDOUT""", msh_ids)
+            msh_ids.seek(0)
+
+            w_cursor = warehouse.cursor()
+            try:
+                w_cursor.execute("""CREATE TEMPORARY TABLE bulk_msh (
+                hl7_msh_id INTEGER PRIMARY KEY) ON COMMIT DROP""")
+                w_cursor.copy_expert("COPY bulk_msh FROM STDIN", msh_ids)
+                w_cursor.copy_expert("""COPY (SELECT m.hl7_msh_id,
+                m.message_datetime, m.message_type, m.facility,
+                v.visit_id, v.patient_class, v.patient_id,
+                v.admit_datetime, v.discharge_datetime, v.gender, v.dob,
+                v.disposition, v.zip, v.country, v.state, v.county,
+                v.admission_source, v.assigned_patient_location,
+                v.chief_complaint, v.race, v.service_code,
+                EXISTS (SELECT 1 FROM hl7_obx o
+                  WHERE o.hl7_msh_id = m.hl7_msh_id
+                  AND o.observation_id IN (%s))
+                FROM hl7_msh m JOIN hl7_visit v USING (hl7_msh_id)
+                JOIN bulk_msh USING (hl7_msh_id)) TO STDOUT""" %
+                                     CLINICAL_CODES, messages)
+                w_cursor.copy_expert("""COPY (SELECT d.hl7_msh_id,
+                d.rank, d.dx_code, d.dx_description, d.dx_type
+                FROM hl7_dx d JOIN bulk_msh USING (hl7_msh_id))
+                TO STDOUT""", dxes)
+            finally:
+                warehouse.rollback()  # read only, drops bulk_msh
+            messages.seek(0)
+            dxes.seek(0)
+
+            cursor.execute("""CREATE TEMPORARY TABLE bulk_msg (
+            hl7_msh_id INTEGER PRIMARY KEY,
+            message_datetime TIMESTAMP, message_type TEXT,
+            facility TEXT, visit_id TEXT, patient_class TEXT,
+            patient_id TEXT, admit_datetime TIMESTAMP,
+            discharge_datetime TIMESTAMP, gender TEXT, dob TEXT,
+            disposition TEXT, zip TEXT, country TEXT, state TEXT,
+            county TEXT, admission_source TEXT,
+            assigned_patient_location TEXT, chief_complaint TEXT,
+            race TEXT, service_code TEXT, clinical BOOLEAN)
+            ON COMMIT DROP""")
+            cursor.copy_expert("COPY bulk_msg FROM STDIN", messages)
+            cursor.execute("""CREATE TEMPORARY TABLE bulk_dx (
+            hl7_msh_id INTEGER, rank SMALLINT, dx_code TEXT,
+            dx_description TEXT, dx_type TEXT) ON COMMIT DROP""")
+            cursor.copy_expert("COPY bulk_dx FROM STDIN", dxes)
+        finally:
+            msh_ids.close()
+            messages.close()
+            dxes.close()
+
+    def _merge(self, cursor):
+        """Merge the staged messages, returns number of visits merged"""
+        cursor.execute("""CREATE TEMPORARY TABLE bulk_eligible
+        ON COMMIT DROP AS SELECT visit_id FROM bulk_msg
+        GROUP BY visit_id HAVING NOT bool_or(
+          message_type = '%(oru)s' OR (message_type <> '%(orm)s' AND
+          (patient_class = 'U' OR clinical)))""" %
+                       {'oru': ORU, 'orm': ORM})
+        cursor.execute("""DELETE FROM bulk_eligible e WHERE EXISTS (
+        SELECT 1 FROM bulk_msg m WHERE m.visit_id = e.visit_id
+        AND m.message_type <> '%s' GROUP BY m.patient_class
+        HAVING count(m.admit_datetime) = 0)""" % ORM)
+
+        cursor.execute("""CREATE TEMPORARY TABLE bulk_adt ON COMMIT DROP
+        AS SELECT m.* FROM bulk_msg m JOIN bulk_eligible USING (visit_id)
+        WHERE m.message_type <> '%s'""" % ORM)
+
+        cursor.execute("""CREATE TEMPORARY TABLE bulk_visit_core
+        ON COMMIT DROP AS SELECT visit_id, patient_class,
+        %(patient_id)s AS patient_id,
+        %(facility)s AS facility,
+        min(message_datetime) AS first_message,
+        max(message_datetime) AS last_message,
+        %(admit_datetime)s AS admit_datetime,
+        %(discharge_datetime)s AS discharge_datetime,
+        %(gender)s AS gender,
+        %(dob)s AS dob,
+        %(disposition)s AS disposition,
+        %(admission_source)s AS admission_source,
+        %(assigned_location)s AS assigned_location,
+        %(chief_complaint)s AS chief_complaint,
+        %(race)s AS race,
+        %(service_area)s AS service_area,
+        coalesce(bool_or(
+          (btrim(assigned_patient_location) <> '' AND
+           (right(assigned_patient_location, 3) IN ('ICU', 'ACU') OR
+            assigned_patient_location = 'ACUI')) OR
+          service_code IN ('INT', 'PIN')), false) AS ever_in_icu
+        FROM bulk_adt GROUP BY visit_id, patient_class""" % {
+            'patient_id': _first('patient_id'),
+            'facility': _first('facility'),
+            'admit_datetime': _latest('admit_datetime',
+                                      'admit_datetime IS NOT NULL'),
+            'discharge_datetime': _latest(
+                'discharge_datetime', 'discharge_datetime IS NOT NULL'),
+            'gender': _latest('gender', "gender <> ''"),
+            'dob': _latest('dob::integer',
+                           "dob ~ '^0*[1-9][0-9]*$'"),
+            'disposition': _latest('btrim(disposition)::smallint',
+                                   "btrim(disposition) ~ '^[0-9]+$'"),
+            'admission_source': _latest(
+                'admission_source', "btrim(admission_source) <> ''"),
+            'assigned_location': _latest(
+                'assigned_patient_location',
+                "btrim(assigned_patient_location) <> ''"),
+            'chief_complaint': _latest('chief_complaint',
+                                       "btrim(chief_complaint) <> ''"),
+            'race': _latest('race', "race <> ''"),
+            'service_area': _latest('service_code',
+                                    "btrim(service_code) <> ''"),
+        })
+
+        # The latest message with any demographic sets the location
+        cursor.execute("""CREATE TEMPORARY TABLE bulk_location
+        ON COMMIT DROP AS SELECT DISTINCT ON (visit_id, patient_class)
+        visit_id, patient_class, country, county, state, zip
+        FROM bulk_adt WHERE coalesce(zip, '') <> ''
+        OR coalesce(country, '') <> '' OR coalesce(state, '') <> ''
+        OR coalesce(county, '') <> ''
+        ORDER BY visit_id, patient_class, message_datetime DESC,
+        hl7_msh_id DESC""")
+
+        self._insert_dimensions(cursor)
+
+        cursor.execute("""INSERT INTO fact_visit (visit_id,
+        patient_class, patient_id, admit_datetime, first_message,
+        last_message, discharge_datetime, age, dob, gender, ever_in_icu,
+        influenza_test_summary, dim_ar_pk, dim_cc_pk,
+        dim_disposition_pk, dim_facility_pk, dim_location_pk,
+        dim_service_area_pk, dim_admission_source_pk,
+        dim_assigned_location_pk, dim_race_pk, last_updated)
+        SELECT c.visit_id, c.patient_class, c.patient_id,
+        c.admit_datetime, c.first_message, c.last_message,
+        c.discharge_datetime,
+        CASE WHEN c.dob BETWEEN 100000 AND 999999 THEN greatest(0,
+          date_part('year', age(c.admit_datetime,
+            to_date(c.dob::text || '15', 'YYYYMMDD'))))
+        END, c.dob, coalesce(c.gender, 'U'), c.ever_in_icu, 99,
+        (SELECT min(pk) FROM dim_ar
+          WHERE admit_reason = c.chief_complaint),
+        (SELECT min(pk) FROM dim_cc
+          WHERE chief_complaint = c.chief_complaint),
+        (SELECT code FROM dim_disposition WHERE code = c.disposition),
+        c.facility::integer,
+        (SELECT min(d.pk) FROM dim_location d WHERE
+          d.country IS NOT DISTINCT FROM l.country AND
+          d.county IS NOT DISTINCT FROM l.county AND
+          d.state IS NOT DISTINCT FROM l.state AND
+          d.zip IS NOT DISTINCT FROM l.zip),
+        (SELECT min(pk) FROM dim_service_area
+          WHERE area = c.service_area),
+        (SELECT pk FROM dim_admission_source
+          WHERE pk = c.admission_source),
+        (SELECT min(pk) FROM dim_assigned_location
+          WHERE location = c.assigned_location),
+        (SELECT min(pk) FROM dim_race WHERE race = c.race),
+        now()
+        FROM bulk_visit_core c LEFT JOIN bulk_location l
+        ON l.visit_id = c.visit_id AND l.patient_class = c.patient_class
+        """)
+
+        cursor.execute("""INSERT INTO assoc_visit_dx (fact_visit_pk,
+        dim_dx_pk, status, dx_datetime, rank, last_updated)
+        SELECT DISTINCT ON (f.pk, dx.pk, d.dx_type) f.pk, dx.pk,
+        d.dx_type, a.message_datetime, coalesce(d.rank, 0), now()
+        FROM bulk_dx d JOIN bulk_adt a USING (hl7_msh_id)
+        JOIN fact_visit f ON f.visit_id = a.visit_id
+          AND f.patient_class = a.patient_class
+        JOIN dim_dx dx ON dx.icd9 = d.dx_code
+        WHERE btrim(d.dx_code) <> '' AND d.dx_type IS NOT NULL
+        ORDER BY f.pk, dx.pk, d.dx_type, a.message_datetime,
+        a.hl7_msh_id""")
+
+        cursor.execute("""UPDATE internal_message_processed
+        SET processed_datetime = now() WHERE hl7_msh_id IN (
+          SELECT hl7_msh_id FROM bulk_msg JOIN bulk_eligible
+          USING (visit_id))""")
+        cursor.execute("""DELETE FROM internal_pending_visit
+        WHERE visit_id IN (SELECT visit_id FROM bulk_eligible)""")
+        return cursor.rowcount
+
+    def _new_dimension_values(self, cursor):
+        """Collect the dimension values of the batch missing from the mart
+
+        returns a dictionary keyed by table, of single column values or
+        (for dim_location and dim_dx) row tuples
+
+        """
+        values = {}
+        for table, column, source in self.DIMENSIONS:
+            cursor.execute("""SELECT DISTINCT c.%(source)s
+            FROM bulk_visit_core c WHERE c.%(source)s IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM %(table)s d
+              WHERE d.%(column)s = c.%(source)s)""" %
+                           {'table': table, 'column': column,
+                            'source': source})
+            values[table] = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute("""SELECT DISTINCT l.country, l.county, l.state,
+        l.zip FROM bulk_location l
+        WHERE NOT EXISTS (SELECT 1 FROM dim_location d WHERE
+          d.country IS NOT DISTINCT FROM l.country AND
+          d.county IS NOT DISTINCT FROM l.county AND
+          d.state IS NOT DISTINCT FROM l.state AND
+          d.zip IS NOT DISTINCT FROM l.zip)""")
+        values['dim_location'] = cursor.fetchall()
+
+        # The worker keeps the first description seen for an icd9
+        cursor.execute("""SELECT DISTINCT ON (d.dx_code) d.dx_code,
+        d.dx_description FROM bulk_dx d
+        JOIN bulk_adt a USING (hl7_msh_id)
+        WHERE btrim(d.dx_code) <> ''
+        AND NOT EXISTS (SELECT 1 FROM dim_dx x WHERE x.icd9 = d.dx_code)
+        ORDER BY d.dx_code, a.message_datetime, a.hl7_msh_id""")
+        values['dim_dx'] = cursor.fetchall()
+        return values
+
+    def _insert_dimensions(self, cursor):
+        """Insert the dimension rows referenced by the batch, if new
+
+        Workers insert dimension rows one at a time, each committed
+        under the manager's in process `table_locks`, the table's
+        advisory lock (distributed workers) or a shared table advisory
+        lock and one on the value (with advisory_locks) - see
+        `SelectOrInsert`.  The new rows are inserted likewise, in a
+        short transaction of their own holding the table locks of
+        every kind, exclusively.  Should any worker be (or have been)
+        first to insert a value, it's found and left be.
+
+        """
+        values = self._new_dimension_values(cursor)
+        if not any(values.values()):
+            return
+
+        held = []
+        connection = self.mart_engine.raw_connection()
+        try:
+            for lock in self.DIMENSION_LOCKS:
+                if lock in self.table_locks:
+                    self.table_locks[lock].acquire()
+                    held.append(self.table_locks[lock])
+            d_cursor = connection.cursor()
+            for lock in self.DIMENSION_LOCKS:
+                d_cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)",
+                                 advisory_key(lock))
+
+            for table, column, source in self.DIMENSIONS:
+                if not values[table]:
+                    continue
+                d_cursor.execute("""INSERT INTO %(table)s (%(column)s,
+                last_updated) SELECT v, now() FROM unnest(%%s::text[]) v
+                WHERE NOT EXISTS (SELECT 1 FROM %(table)s d
+                  WHERE d.%(column)s = v)""" %
+                                 {'table': table, 'column': column},
+                                 (values[table],))
+
+            if values['dim_location']:
+                d_cursor.execute("""INSERT INTO dim_location (country,
+                county, state, zip, last_updated) SELECT l.country,
+                l.county, l.state, l.zip, now() FROM unnest(%s::text[],
+                  %s::text[], %s::text[], %s::text[])
+                  AS l(country, county, state, zip)
+                WHERE NOT EXISTS (SELECT 1 FROM dim_location d WHERE
+                  d.country IS NOT DISTINCT FROM l.country AND
+                  d.county IS NOT DISTINCT FROM l.county AND
+                  d.state IS NOT DISTINCT FROM l.state AND
+                  d.zip IS NOT DISTINCT FROM l.zip)
+                ON CONFLICT DO NOTHING""",
+                                 [list(c) for c in
+                                  zip(*values['dim_location'])])
+
+            if values['dim_dx']:
+                d_cursor.execute("""INSERT INTO dim_dx (icd9,
+                description, last_updated) SELECT d.icd9, d.description,
+                now() FROM unnest(%s::text[], %s::text[])
+                  AS d(icd9, description)
+                ON CONFLICT (icd9) DO NOTHING""",
+                                 [list(c) for c in zip(*values['dim_dx'])])
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            for lock in held:
+                lock.release()
+            connection.close()
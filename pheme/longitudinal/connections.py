@@ -0,0 +1,199 @@
+"""Central source of pooled database connections
+
+The manager, each of its workers and the report tool would otherwise
+open connections of their own (via `AlchemyAccess` and
+`DirectAccess`), each access with a pool of its own, so connection
+counts grew with every worker well beyond what's used.  The
+`ConnectionFactory` shares one small, bounded pool per database in
+each process instead.
+
+For a transaction mode pooler such as PgBouncer, configure `pgbouncer`
+- the pooler then does the pooling, and callers avoid state outliving
+a transaction (see `ConnectionFactory.pgbouncer`).  Reports depend on
+such state, so aren't supported through the pooler.
+
+"""
+import logging
+import os
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from pheme.util.config import Config
+
+# Engines of this process, keyed by (pid, url) and pool settings.  A
+# forked child inherits its parent's, but never uses them.
+_engines = {}
+
+
+class PooledAccess(object):
+    """Stand in for `AlchemyAccess`, over a shared pooled engine
+
+    Provides the `engine`, a `session` of its own, and `disconnect`,
+    which returns the session's connection to the pool.
+
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.session = sessionmaker(bind=engine)()
+
+    def disconnect(self):
+        self.session.close()
+
+
+class DedicatedAccess(object):
+    """Stand in for `DirectAccess`, over a dedicated connection
+
+    For callers depending on session state, i.e. the report's
+    temporary tables and cursors WITH HOLD.  Statements autocommit.
+
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._dbapi = connection.connection
+        self._dbapi.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+
+    def raw_query(self, query):
+        """Execute the query, returns the (DBAPI) cursor"""
+        cursor = self._dbapi.cursor()
+        cursor.execute(query)
+        return cursor
+
+    def close(self):
+        self._connection.close()
+
+
+class ConnectionFactory(object):
+    """Pooled engines and accesses, one pool per database per process
+
+    Each pool holds up to `pool_size` connections, opening up to
+    `max_overflow` more under demand, and makes callers wait up to
+    `pool_timeout` seconds for a connection beyond those.  A
+    connection held for the life of the process, such as a worker's
+    for session level locks, is `dedicated` rather than taken from
+    the pool.  So a process uses no more than `per_process`
+    connections to each database.
+
+    In `pgbouncer` mode no pool is kept, connections are returned to
+    the pooler as soon as they're closed.  As a transaction mode
+    pooler may hand each transaction a different server connection,
+    callers must not depend on session state - session level advisory
+    locks, LISTEN, SET or temporary tables outliving a transaction.
+
+    Defaults come from the [longitudinal] config section:
+    `database_user`, `database_password`, `pool_size` (2),
+    `pool_max_overflow` (1), `pool_timeout` (30) and `pgbouncer`
+    (false).
+
+    """
+    POOL_SIZE = 2
+    MAX_OVERFLOW = 1
+    POOL_TIMEOUT = 30
+    DEDICATED = 1  # most dedicated connections per process
+
+    def __init__(self, user, password, host='localhost', pool_size=None,
+                 max_overflow=None, pool_timeout=None, pgbouncer=None):
+        config = Config()
+
+        def setting(value, option, default):
+            if value is not None:
+                return value
+            return config.get('longitudinal', option, default=default)
+
+        self.user = user or config.get('longitudinal', 'database_user')
+        self.password = password or config.get('longitudinal',
+                                               'database_password')
+        self.host = host
+        self.pool_size = int(setting(pool_size, 'pool_size',
+                                     self.POOL_SIZE))
+        self.max_overflow = int(setting(max_overflow, 'pool_max_overflow',
+                                        self.MAX_OVERFLOW))
+        self.pool_timeout = int(setting(pool_timeout, 'pool_timeout',
+                                        self.POOL_TIMEOUT))
+        pgbouncer = setting(pgbouncer, 'pgbouncer', False)
+        self.pgbouncer = str(pgbouncer).lower() in ('1', 'true', 'yes',
+                                                    'on')
+
+    @property
+    def per_process(self):
+        """Most connections a process holds to each database"""
+        return self.pool_size + self.max_overflow + self.DEDICATED
+
+    def _url(self, database, port):
+        return "postgresql://%s:%s@%s:%d/%s" % (
+            self.user, self.password, self.host, port, database)
+
+    def engine(self, database, port=5432):
+        """Returns this process's engine for the database"""
+        url = self._url(database, port)
+        if self.pgbouncer:
+            key = (os.getpid(), url, None)
+        else:
+            key = (os.getpid(), url, self.pool_size, self.max_overflow,
+                   self.pool_timeout)
+        if key not in _engines:
+            if self.pgbouncer:
+                engine = create_engine(url, poolclass=NullPool)
+            else:
+                engine = create_engine(url, pool_size=self.pool_size,
+                                       max_overflow=self.max_overflow,
+                                       pool_timeout=self.pool_timeout)
+            _engines[key] = engine
+        return _engines[key]
+
+    def dedicated(self, database, port=5432):
+        """Returns a connection to the database outside the pool
+
+        For a connection held for the life of the process, which
+        would otherwise leave the pool a connection short.  Close it
+        when done.
+
+        """
+        key = (os.getpid(), self._url(database, port), None)
+        if key not in _engines:
+            _engines[key] = create_engine(key[1], poolclass=NullPool)
+        return _engines[key].connect()
+
+    def access(self, database, port=5432):
+        """Returns a `PooledAccess` to the database"""
+        return PooledAccess(self.engine(database, port))
+
+    def dedicated_access(self, database, port=5432):
+        """Returns a `DedicatedAccess` to the database
+
+        raises ValueError in `pgbouncer` mode, as the session state
+        such callers depend on wouldn't survive the pooler
+
+        """
+        if self.pgbouncer:
+            raise ValueError("session state unsupported through a "
+                             "transaction pooler (pgbouncer)")
+        return DedicatedAccess(self.dedicated(database, port))
+
+    def workers_within(self, engine, workers, databases=1, reserve=1):
+        """Limit workers to the connections the server has to spare
+
+        :param engine: engine for the database server to check
+        :param workers: the number of workers hoped for
+        :param databases: databases on the server each worker uses
+        :param reserve: connections to leave for this process
+
+        returns the number of workers that fit, at least one
+
+        """
+        if self.pgbouncer:
+            # The pooler limits server connections
+            return workers
+        row = engine.execute(text("""SELECT
+          current_setting('max_connections')::integer -
+          current_setting('superuser_reserved_connections')::integer,
+          (SELECT count(*) FROM pg_stat_activity)""")).first()
+        spare = row[0] - row[1] - reserve
+        fit = max(1, spare // (self.per_process * databases))
+        if fit < workers:
+            logging.warn("only %d spare connections, limiting to %d of "
+                         "%d workers", spare, fit, workers)
+            return fit
+        return workers
@@ -0,0 +1,125 @@
+"""Dimension cache shared by the worker processes of a manager
+
+Each `SelectOrInsert` keeps a small cache of its own, but the workers
+launched by a manager would otherwise each warm a private copy of the
+same hot dimension rows, and never see the rows inserted by one
+another.  The `SharedDimensionCache` is created by the manager before
+the workers are forked, and inherited by each.
+
+"""
+import hashlib
+import logging
+import mmap
+import struct
+
+from .select_or_insert import TrackedLock
+
+
+class SharedDimensionCache(object):
+    """Fixed size hash table of (table, values) -> pk in shared memory
+
+    Backed by an anonymous shared `mmap`, so it must be created before
+    forking the processes that use it (`multiprocessing.shared_memory`
+    isn't available to python 2).
+
+    Each slot holds the 16 byte md5 digest of the key followed by the
+    8 byte pk, an all zero digest marks an empty slot.  Collisions are
+    resolved by linear probing.  Entries are never removed or changed,
+    as dimension rows are never deleted.
+
+    Readers don't lock.  A writer holds the lock while it finds an
+    empty slot, and writes the pk before the digest, so a reader that
+    matches a digest always finds the pk in place.  Once the probe
+    limit is exhausted, new entries are quietly dropped.  The lock is
+    a `TrackedLock`, so the manager can release it should a writer be
+    killed (see `release_if_held_by`).
+
+    Only integer primary keys are cached.
+
+    """
+    DIGEST_SIZE = 16
+    PK_FORMAT = '<q'
+    SLOT_SIZE = DIGEST_SIZE + struct.calcsize(PK_FORMAT)
+    MAX_PROBES = 32
+    EMPTY = '\0' * DIGEST_SIZE
+
+    def __init__(self, slots):
+        """Allocate the shared table
+
+        :param slots: number of entries the table can hold
+
+        """
+        if slots < 1:
+            raise ValueError("slots must be positive")
+        self.slots = slots
+        self._map = mmap.mmap(-1, slots * self.SLOT_SIZE)
+        self._lock = TrackedLock()
+        self._full = False
+
+    def _digest(self, table, values):
+        return hashlib.md5('%s\x1e%s' % (table, values)).digest()
+
+    def _probe(self, digest):
+        """Generate the offsets of the slots to search for digest"""
+        start = struct.unpack('<Q', digest[:8])[0] % self.slots
+        for i in xrange(min(self.MAX_PROBES, self.slots)):
+            yield ((start + i) % self.slots) * self.SLOT_SIZE
+
+    def lookup(self, table, values):
+        """Returns the cached pk, or None if not found
+
+        :param table: name of the dimension table
+        :param values: the serialized query_fields values
+
+        """
+        digest = self._digest(table, values)
+        for offset in self._probe(digest):
+            slot = self._map[offset:offset + self.SLOT_SIZE]
+            found = slot[:self.DIGEST_SIZE]
+            if found == digest:
+                return struct.unpack(self.PK_FORMAT,
+                                     slot[self.DIGEST_SIZE:])[0]
+            if found == self.EMPTY:
+                return None
+        return None
+
+    def publish(self, table, values, pk):
+        """Add the pk for the table's values, if room remains
+
+        :param table: name of the dimension table
+        :param values: the serialized query_fields values
+        :param pk: the integer primary key of the row
+
+        """
+        if not isinstance(pk, (int, long)):
+            return
+        digest = self._digest(table, values)
+        self._lock.acquire()
+        try:
+            for offset in self._probe(digest):
+                found = self._map[offset:offset + self.DIGEST_SIZE]
+                if found == digest:
+                    return
+                if found == self.EMPTY:
+                    self._map[offset + self.DIGEST_SIZE:
+                              offset + self.SLOT_SIZE] = \
+                        struct.pack(self.PK_FORMAT, pk)
+                    self._map[offset:offset + self.DIGEST_SIZE] = digest
+                    return
+        finally:
+            self._lock.release()
+        if not self._full:
+            self._full = True
+            logging.warn("shared dimension cache full, consider "
+                         "more than %d slots", self.slots)
+
+    def release_if_held_by(self, pid):
+        """Release the lock if held by (the now dead) process pid
+
+        returns True if the lock was released
+
+        """
+        return self._lock.release_if_held_by(pid)
+
+    def close(self):
+        self._map.close()
@@ -1,16 +1,23 @@
 #!/usr/bin/env python
 from datetime import datetime, timedelta
 import logging
+from multiprocessing import Pool
 from optparse import OptionParser
 import os
 import re
+import traceback
+
+from sqlalchemy import text
 
 from pheme.util.config import Config, configure_logging
 from pheme.util.datefile import Datefile
 from pheme.util.util import parseDate
-from pheme.util.pg_access import AlchemyAccess, DirectAccess
-from pheme.longitudinal.tables import Report
-from pheme.webAPIclient.archive import document_find, document_store
+from pheme.longitudinal.connections import ConnectionFactory
+from pheme.longitudinal.report_diff import ReportDiff
+from pheme.longitudinal.report_output import ReportOutput
+from pheme.longitudinal.tables import Report, diagnosis_aggregate
+from pheme.longitudinal.tables import refresh_essence_flat
+from pheme.webAPIclient.archive import document_store
 from pheme.webAPIclient.transfer import PHINMS_client, Distribute_client
 
 # Front end to generation of daily essence reports from database
@@ -43,6 +50,29 @@ def raiseValueError(message):
     raise ValueError(message)
 
 
+# Region names found in each database, shared by all the reports of
+# a run
+_reportable_regions = {}
+
+
+def reportable_region_exists(database, user, password, region):
+    """Look for region in the database's internal_reportable_region
+
+    The region names are looked up once, and again only should a
+    region not be found (it may since have been added).
+
+    """
+    if region in _reportable_regions.get(database, ()):
+        return True
+    engine = ConnectionFactory(user=user, password=password).\
+        engine(database)
+    _reportable_regions[database] = set(
+        row[0] for row in engine.execute(text(
+            "SELECT DISTINCT region_name FROM "
+            "internal_reportable_region")))
+    return region in _reportable_regions[database]
+
+
 class ReportCriteria(object):
     """Container to house common report criteria
 
@@ -132,19 +162,11 @@ class ReportCriteria(object):
             raise AttributeError("can't set attribute")
         # Confirm the requested region is in the db.
         if value:
-            connection = DirectAccess(database=self.database,
-                                      user=self.user,
-                                      password=self.password)
-
-            cursor = connection.raw_query("SELECT count(*) FROM "\
-                                          "internal_reportable_region "\
-                                          "WHERE region_name = '%s'" %
-                                          value)
-            if cursor.next()[0] < 1:
+            if not reportable_region_exists(self.database, self.user,
+                                            self.password, value):
                 self.error_callback("%s region not found in "\
                                     "internal_reportable_region table" %
                                     value)
-            connection.close()
         self._crit['reportable_region'] = value
 
     @property
@@ -247,26 +269,55 @@ class GenerateReport(object):
     assert(columns[diagnosis_column_index][1] == 'visit_pk')
     assert(columns[patient_class_column_index][1] == 'patient_class')
 
+    # Rows fetched at a time from the server side cursors
+    FETCH_SIZE = 5000
+
+    # Bytes of output buffered between writes to the report file
+    OUTPUT_BUFFER = 1 << 20
+
     def __init__(self, user=None, password=None, report_criteria=None,
-                 datefile=None):
+                 datefile=None, sql_diagnosis=False, essence_flat=False,
+                 compress=False, part_size=None, refresh_flat=True):
         """Initialize report generation.
 
         :param user: database user
         :param password: database password
         :param report_criteria: ReportCriteria defining specifics
         :param datefile: useful for persistent walks through time
+        :param sql_diagnosis: export mode, have the database aggregate
+          each visit's diagnoses (see `_diagnosis_aggregate`) and write
+          the report (see `_copy`)
+        :param essence_flat: read the materialized essence_flat table,
+          diagnoses included, rather than the essence view
+        :param compress: gzip the report as it's written, rather than
+          have the transport zip it
+        :param part_size: split the report into files of at most
+          part_size bytes (see `ReportOutput`)
+        :param refresh_flat: with essence_flat, catch the table up
+          before reading it - unset if the caller already has
 
         """
+        if (sql_diagnosis or essence_flat) and \
+                report_criteria.include_vitals:
+            raise ValueError("sql_diagnosis and essence_flat don't "
+                             "support vitals")
         self.user = user
         self.password = password
+        self.essence_flat = essence_flat
+        self.refresh_flat = refresh_flat
+        # The flat table's diagnoses are aggregated in the database too
+        self.sql_diagnosis = sql_diagnosis or essence_flat
         self.criteria = report_criteria
         self.database = self.criteria.database
+        self.compress = compress
+        self.part_size = part_size
         if datefile:
             assert((self.criteria.start_date, self.criteria.end_date)
                    == datefile.get_date_range())
             self.datePersistence = datefile
 
-        self._diags = {}
+        self._diags = iter(())
+        self._next_diag = None
         self._prepare_output_file()
         self._prepare_columns()
         self._set_transport()
@@ -285,9 +336,10 @@ class GenerateReport(object):
         """Plug in the appropriate transport mechanism"""
         # Transport strategies differ for the different reports
         if self.criteria.reportable_region:
-            self._transport = Distribute_client(zip_first=True)
+            self._transport = Distribute_client(
+                zip_first=not self.compress)
         else:
-            self._transport = PHINMS_client(zip_first=True)
+            self._transport = PHINMS_client(zip_first=not self.compress)
 
     def _generate_output_filename(self, start_date=None,
                                   end_date=None):
@@ -309,20 +361,23 @@ class GenerateReport(object):
         return filepath
 
     def _prepare_output_file(self):
-        """Open the local filesystem file for output"""
+        """Prepare the local filesystem file(s) for output"""
         filepath = self.\
             _generate_output_filename(start_date=self.criteria.start_date,
                                       end_date=self.criteria.end_date)
+        self.output = ReportOutput(filepath, compress=self.compress,
+                                   part_size=self.part_size,
+                                   buffer_size=self.OUTPUT_BUFFER)
 
         # watch for oversight errors; notify if like report exists -
         # unless it's size zero (from a previous failed run)
+        filepath = self.output.name
         if os.path.exists(filepath) and os.path.getsize(filepath):
             logging.warning("Found requested report file already "\
                              "exists - overwriting: '%s'"\
                              % filepath)
 
-        self.output = open(filepath, 'w')
-        self._output_filename = self.output.name
+        self._output_filename = filepath
 
     @property
     def output_filename(self):
@@ -332,6 +387,11 @@ class GenerateReport(object):
                 "didn't happen!")
         return self._output_filename
 
+    @property
+    def output_filenames(self):
+        """All the files written, more than one if split into parts"""
+        return self.output.names
+
     def _header(self):
         if self.criteria.include_vitals:
             columns = [c[0] for c in self.columns]
@@ -357,24 +417,35 @@ class GenerateReport(object):
     def _build_visit_join_table(self):
         """ Helper in selection of visits for the report - this method
         builds a temporary table and populates it with the visit_pks
-        that belong in the report.  This should include all visit_pks
-        with the matching admit_datetime as well as any that have
-        received updates since the last like report was produced.
+        that belong in the report (see `_reportable_visits`).
 
         """
-        # If include_vitals is on, we also need the visit_id to keep
-        # the joins managable.  vitals don't have a patient class, so
-        # you can't join on the same values.
-
         sql = "CREATE TEMPORARY TABLE reportable_pks (pk "\
             "integer not null unique)"
-        selectCols = "fact_visit.pk"
 
         self._getConn()
         self.access.raw_query(sql)
+        for select in self._reportable_visits():
+            self.access.raw_query("INSERT INTO reportable_pks %s "
+                                  "ON CONFLICT (pk) DO NOTHING" % select)
+
+        cursor = self.access.raw_query("SELECT COUNT(*) FROM "\
+                                           "reportable_pks")
+        logging.debug("%d visits to report on", cursor.fetchall()[0][0])
+
+    def _reportable_visits(self):
+        """ Builds the SELECT statements for the visit_pks that belong
+        in the report.  This should include all visit_pks with the
+        matching admit_datetime as well as any that have received
+        updates since the last like report was produced.
+
+        returns list of SELECT statements, each for a single pk
+        column
 
+        """
         # If we're only selecting those facilites in a region, the SQL
         # is more complicated - build up the respective clauses.
+        selectCols = "fact_visit.pk"
         joinClause = regionClause = ""
         if self.criteria.reportable_region:
             joinClause = "JOIN internal_reportable_region ON "\
@@ -402,45 +473,42 @@ class GenerateReport(object):
                 self.criteria.patient_class
 
         # Start with all visits for the requested date range
-        sql = "INSERT INTO reportable_pks SELECT %s FROM "\
-              "fact_visit %s WHERE admit_datetime BETWEEN '%s' AND "\
-              "'%s' %s %s" %\
-              (selectCols, joinClause, self.criteria.start_date,
-               self.criteria.end_date + timedelta(days=1),
-               pc_limit, regionClause)
-
-        self.access.raw_query(sql)
+        selects = ["SELECT %s FROM "\
+                   "fact_visit %s WHERE admit_datetime BETWEEN '%s' AND "\
+                   "'%s' %s %s" %\
+                   (selectCols, joinClause, self.criteria.start_date,
+                    self.criteria.end_date + timedelta(days=1),
+                    pc_limit, regionClause)]
 
         if self.criteria.include_updates:
             # In this case, add all visits with updates since the
             # last run, but no newer than the requested date (in case
-            # we're building reports forward from historical data)
+            # we're building reports forward from historical data).
+            # Those admitted in the date range are already selected,
+            # so only earlier admissions are looked for - a range scan
+            # of ix_fact_visit_updated_admit (or with a region,
+            # ix_fact_visit_facility_admit) with no anti-join.
             sql = "SELECT max(processed_datetime) FROM internal_report "\
                   "WHERE report_method = '%s'" % self.criteria.report_method
 
+            self._getConn()
             cursor = self.access.raw_query(sql)
             last_report_generated = cursor.fetchall()[0][0]
             if last_report_generated is None:
                 last_report_generated = '2009-01-01'  # our epoch
             logging.debug("including updates, last_report_generated: "\
                               "%s", last_report_generated)
-            sql = "INSERT INTO reportable_pks SELECT %(sel_cols)s FROM "\
-                  "fact_visit %(join_clause)s LEFT JOIN reportable_pks ON "\
-                  "reportable_pks.pk = fact_visit.pk WHERE "\
+            selects.append("SELECT %(sel_cols)s FROM "\
+                  "fact_visit %(join_clause)s WHERE "\
                   "last_updated > '%(last_report)s' AND admit_datetime "\
-                  "< '%(date)s' AND reportable_pks.pk IS NULL "\
-                  "%(pc_limit)s %(region_clause)s" %\
+                  "< '%(date)s' %(pc_limit)s %(region_clause)s" %\
                   {'sel_cols': selectCols,
                    'last_report': last_report_generated,
-                   'date': self.criteria.end_date + timedelta(days=1),
+                   'date': self.criteria.start_date,
                    'pc_limit': pc_limit,
                    'join_clause': joinClause,
-                   'region_clause': regionClause}
-            self.access.raw_query(sql)
-
-        cursor = self.access.raw_query("SELECT COUNT(*) FROM "\
-                                           "reportable_pks")
-        logging.debug("%d visits to report on", cursor.fetchall()[0][0])
+                   'region_clause': regionClause})
+        return selects
 
     def _build_vitals_join_table(self):
         """When report is to include vitals - we use an additional
@@ -478,21 +546,76 @@ class GenerateReport(object):
           """
         self.access.raw_query(sql)
 
-    def _select_from_essence_view(self):
+    def _stream(self, stmt, name):
+        """Generate the rows of stmt, FETCH_SIZE at a time
+
+        Iterates through a named server side cursor, so only a chunk
+        of the result is held in memory however large the report.
+        WITH HOLD, as the connection may be in autocommit mode.
+
+        :param stmt: the SELECT statement
+        :param name: name for the cursor, unique among those open
+
+        """
+        self.access.raw_query("DECLARE %s NO SCROLL CURSOR WITH HOLD "
+                              "FOR %s" % (name, stmt))
+        try:
+            while True:
+                rows = self.access.raw_query(
+                    "FETCH FORWARD %d FROM %s" %
+                    (self.FETCH_SIZE, name)).fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            self.access.raw_query("CLOSE %s" % name)
+
+    def _select_from_essence_view(self, columns=None, extra=()):
         """Build up the SQL select statement to be used in gathering
         the data for this report.
 
+        Ordered by visit_pk, for the merge with `_select_diagnosis`.
+        With sql_diagnosis, the diagnosis column is the aggregate from
+        `_diagnosis_aggregate` in place of the visit_pk, or with
+        essence_flat, the table's own.
+
+        :param columns: report columns to select, if not self.columns
+        :param extra: further expressions to select, after the columns
+
         """
+        if columns is None:
+            columns = self.columns
+        columns = ['e.' + c[1] for c in columns] + list(extra)
+        join = ""
+        if self.essence_flat:
+            columns[self.diagnosis_column_index] = "e.diagnosis"
+            return """SELECT %s FROM essence_flat e JOIN reportable_pks ri
+            ON e.visit_pk = ri.pk ORDER BY e.visit_pk""" % ','.join(columns)
+        if self.sql_diagnosis:
+            columns[self.diagnosis_column_index] = "dx.diagnosis"
+            join = "LEFT JOIN (%s) dx ON dx.fact_visit_pk = e.visit_pk" %\
+                self._diagnosis_aggregate()
         stmt = """SELECT %s FROM essence e JOIN reportable_pks ri
-        ON e.visit_pk = ri.pk""" %\
-            (','.join(['e.' + c[1] for c in self.columns]))
+        ON e.visit_pk = ri.pk %s ORDER BY e.visit_pk""" %\
+            (','.join(columns), join)
         return stmt
 
+    def _diagnosis_aggregate(self):
+        """SQL producing the diagnosis column for each reportable visit
+
+        The database equivalent of `SortedDiagnosis`, see
+        `tables.diagnosis_aggregate`.
+
+        """
+        return diagnosis_aggregate(
+            "JOIN reportable_pks ON fact_visit_pk = reportable_pks.pk")
+
     def _select_diagnosis(self):
         """ Need to pull in all the diagnosis data for this report.
-        This is saved in an instance dictionary for use in
-        self._diagnosis to generate the list of diagnoses for each
-        respective visit.
+        Generates a SortedDiagnosis for each visit having any, in
+        visit_pk order, for self._diagnosis to merge with the
+        respective visits as they're written.
 
         A list of unique diagnoses ordered by rank is required.
         """
@@ -504,19 +627,30 @@ class GenerateReport(object):
                "dim_dx ON dim_dx_pk = dim_dx.pk JOIN "\
                "reportable_pks ON "\
                "assoc_visit_dx.fact_visit_pk = reportable_pks.pk "\
-               "ORDER BY dx_datetime DESC"
-        cursor = self.access.raw_query(stmt)
-        for row in cursor.fetchall():
-            visit_pk = row[0]
-            if visit_pk in self._diags:
-                self._diags[visit_pk].add(row[0], row[1], row[2])
-            else:
-                self._diags[visit_pk] = \
-                    SortedDiagnosis(row[0], row[1], row[2])
+               "ORDER BY fact_visit_pk, dx_datetime DESC"
+        diags = None
+        for visit_pk, rank, icd9 in self._stream(stmt, 'report_dx'):
+            if diags is not None and diags.visit_pk == visit_pk:
+                diags.add(visit_pk, rank, icd9)
+                continue
+            if diags is not None:
+                yield diags
+            diags = SortedDiagnosis(visit_pk, rank, icd9)
+        if diags is not None:
+            yield diags
 
     def _diagnosis(self, visit_pk):
-        if visit_pk in self._diags:
-            return [self._diags[visit_pk].__repr__(), ]
+        """Diagnoses for the visit, merged from `_select_diagnosis`
+
+        Visits must be requested in ascending visit_pk order.
+
+        """
+        while self._next_diag is not None and \
+                self._next_diag.visit_pk < visit_pk:
+            self._next_diag = next(self._diags, None)
+        if self._next_diag is not None and \
+                self._next_diag.visit_pk == visit_pk:
+            return [self._next_diag.__repr__(), ]
         else:
             return ['', ]
 
@@ -570,39 +704,104 @@ class GenerateReport(object):
         :param save_report: If set, persist the document and related
           metadata to the mbds archive.
 
-        returns the document ID, the mbds archive key, if saved
+        returns the document IDs, the mbds archive keys, if saved - one
+        per file written
 
         """
         out = self.output
         print >> out, self._header()
+        if self.essence_flat and self.refresh_flat:
+            self._refresh_essence_flat()
         self._build_join_tables()
-        self._select_diagnosis()
+        if self.sql_diagnosis:
+            # Diagnoses are already in place, nothing left to merge
+            self._copy(self._select_from_essence_view(), len(self.columns),
+                       out)
+            return self._finish_output(save_report)
+
+        self._diags = self._select_diagnosis()
+        self._next_diag = next(self._diags, None)
         self._select_vitals()
-        cursor = self.access.raw_query(self._select_from_essence_view())
-        for row in cursor.fetchall():
+        formatter = RowFormatter(self.columns, self.diagnosis_column_index,
+                                 vitals=self.criteria.include_vitals)
+        write = out.write
+        for row in self._stream(self._select_from_essence_view(),
+                                'report_essence'):
             # Each row is the colums up to the diagnosis + the
             # comma separated diagnosis + the rest of the columns
             # and finally with vitals if configured for such
             visit_pk = row[self.diagnosis_column_index]  # yuck, but true
-            print >> out,\
-                '|'.join([strSansNone(column) for column in
-                          row[:self.diagnosis_column_index]] +
-                         self._diagnosis(visit_pk) +
-                         [strSansNone(column) for column in
-                          row[self.diagnosis_column_index + 1:]] +
-                         self._vitals_for_visit(visit_pk))
+            write(formatter.format(row, self._diagnosis(visit_pk)[0],
+                                   self._vitals_for_visit(visit_pk)))
+        # Close the diagnosis cursor, should visits run out first
+        self._diags.close()
+        return self._finish_output(save_report)
+
+    def _copy(self, stmt, width, out):
+        """Have the database write the rows of stmt to out
+
+        The export path - the report is written without per row work
+        in Python, byte for byte as `RowFormatter` would.
+
+        Each row is joined into a single '|' delimited line by
+        concat_ws, NULLs as empty strings.  COPY in CSV format, as the
+        text format escapes backslashes, tabs and newlines.  The
+        delimiter and quote characters are control characters absent
+        from the data, so the only quoting is of lines with embedded
+        newlines, removed again by `CopyUnquote`.  The rows of the
+        (ordered) stmt are copied in order.
+
+        :param stmt: the SELECT statement
+        :param width: number of columns stmt selects
+        :param out: file to write to
+
+        """
+        names = ['c%d' % i for i in range(width)]
+        line = "SELECT concat_ws('|', %s) FROM (%s) r (%s)" % (
+            ', '.join("coalesce(%s::text, '')" % name for name in names),
+            stmt, ', '.join(names))
+        # The access only hands out cursors along with a result
+        cursor = self.access.raw_query("SELECT 1")
+        # QUOTE is CopyUnquote.QUOTE
+        cursor.copy_expert("COPY (%s) TO STDOUT WITH (FORMAT csv, "
+                           "DELIMITER E'\\x1f', QUOTE E'\\x1e')" % line,
+                           CopyUnquote(out))
+
+    def _refresh_essence_flat(self):
+        """Catch essence_flat up with visits updated since refreshed"""
+        refreshed = refresh_essence_flat(ConnectionFactory(
+            user=self.user, password=self.password).engine(self.database))
+        logging.info("refreshed %d essence_flat rows", refreshed)
+
+    def _finish_output(self, save_report):
+        """Close the output file(s), persist them if save_report
+
+        returns the list of document IDs, empty unless saved
 
+        """
         # Close the file and persist to the document archive if
         # requested
         self.output.close()
-        if save_report:
-            metadata = {k: v for k, v in self.criteria._crit.items() if v
-                        is not None}
+        if not save_report:
+            return []
+        metadata = {k: v for k, v in self.criteria._crit.items() if v
+                    is not None}
+
+        # At this point, all documents are of 'essence' type
+        return [document_store(document=filename,
+                               allow_duplicate_filename=True,
+                               document_type='essence', **metadata)
+                for filename in self.output_filenames]
 
-            # At this point, all documents are of 'essence' type
-            return document_store(document=self.output.name,
-                                  allow_duplicate_filename=True,
-                                  document_type='essence', **metadata)
+    def _deliver(self, report_oids, transmit_report=False,
+                 transmit_differences=False):
+        """Record and transmit the saved report file(s)"""
+        for report_oid in report_oids:
+            self._record_report(report_oid)
+            if transmit_report:
+                self._transmit_report(report_oid)
+        if transmit_differences and report_oids:
+            self._transmit_differences(report_oids)
 
     def _record_report(self, report_oid):
         """Record the details from this report generation in the db"""
@@ -612,7 +811,9 @@ class GenerateReport(object):
                         file_path=report_oid,
                         report_method=self.criteria.report_method)
 
-        alchemy = AlchemyAccess(database=self.database)
+        alchemy = ConnectionFactory(user=self.user,
+                                    password=self.password).\
+            access(self.database)
         alchemy.session.add(report)
         alchemy.session.commit()
         alchemy.disconnect()
@@ -622,48 +823,73 @@ class GenerateReport(object):
         logging.info("initiate upload of %s", report)
         self._transport.transfer_file(report)
 
-    def _transmit_differences(self, report):
-        """Compute differences from yesterday's like report; transport"""
+    def _transmit_differences(self, report_oids):
+        """Compute differences from yesterday's like report; transport
 
+        Only rows new or changed since yesterday's report (by visit)
+        are uploaded, see `ReportDiff`.  Yesterday's report is read
+        from the file(s) its run left in tmp_dir - without them, the
+        whole report is uploaded.
+
+        """
         # This option really only makes sense on date range reports,
         # as updates hit older data than just 'yesterday'.
         if self.criteria.start_date == self.criteria.end_date:
             raise ValueError("difference calculation not supported on "\
                              "single day reports")
-        # See if we can find a similar report in the archive from
-        # yesterday
-        search_criteria = {'report_method':
-                           self.criteria.report_method,
-                           'start_date': self.criteria.start_date -
-                           timedelta(days=1), 'end_date':
-                           self.criteria.end_date - timedelta(days=1)}
-        old_doc = document_find(search_criteria, limit=1)
-        if old_doc is None:
+        old_files = self._previous_report_files()
+        if not old_files:
             logging.info("No comparable report found for difference "\
                          "generation")
-            self._transmit_report(report)
-        else:
-            target_filename = self.\
-                _generate_output_filename(start_date=self.criteria.start_date,
-                                          end_date=self.criteria.end_date)
-            # RemoveDuplicates not yet ported!!
-            raise ValueError("RemoveDuplicates not ported")
-            #from pheme.essence.remove_duplicates import RemoveDuplicates
-            #rd = RemoveDuplicates(new_report=report,
-            #                      old_report=old_doc,
-            #                      out=target_filename)
-            #rd.generate_report()
-            #logging.info("initiate upload of difference %s", target_filename)
-            #self._transport.transfer_file(target_filename)
+            for report_oid in report_oids:
+                self._transmit_report(report_oid)
+            return
+
+        root, ext = os.path.splitext(self.output.filepath)
+        target = ReportOutput(root + '-diff' + ext, compress=self.compress,
+                              part_size=self.part_size,
+                              buffer_size=self.OUTPUT_BUFFER)
+        key_columns = [i for i, column in enumerate(self.columns)
+                       if column[1] in ('hospital', 'visit_id',
+                                        'patient_class')]
+        config = Config()
+        diff = ReportDiff(old_files, self.output_filenames, key_columns,
+                          tmp_dir=config.get('general', 'tmp_dir',
+                                             default='/tmp'))
+        try:
+            rows = diff.write(target)
+        finally:
+            target.close()
+        logging.info("%d rows new or changed since %s", rows,
+                     old_files[0])
+        for filename in target.names:
+            logging.info("initiate upload of difference %s", filename)
+            self._transport.transfer_file(filename)
+
+    def _previous_report_files(self):
+        """Returns the file(s) of yesterday's like report, if found"""
+        previous = ReportOutput(self._generate_output_filename(
+            start_date=self.criteria.start_date - timedelta(days=1),
+            end_date=self.criteria.end_date - timedelta(days=1)),
+            compress=self.compress, part_size=self.part_size)
+        files = []
+        while os.path.exists(previous.part_name(len(files) + 1)):
+            files.append(previous.part_name(len(files) + 1))
+            if not self.part_size:
+                break
+        return files
 
     def _getConn(self):
         """ Local wrapper to get database connection
+
+        Dedicated to the report, which keeps temporary tables and
+        cursors for the session - so unsupported in pgbouncer mode.
         """
         if hasattr(self, 'access'):
             return
-        self.access = DirectAccess(database=self.database,
-                                   user=self.user,
-                                   password=self.password)
+        self.access = ConnectionFactory(
+            user=self.user, password=self.password).dedicated_access(
+                self.database)
 
     def _closeConn(self):
         """ Local wrapper to close database connection
@@ -685,12 +911,8 @@ class GenerateReport(object):
                      self.criteria.report_method)
 
         self._getConn()
-        report_oid = self._write_report(save_report)
-        self._record_report(report_oid)
-        if transmit_report:
-            self._transmit_report(report_oid)
-        if transmit_differences:
-            self._transmit_differences(report_oid)
+        report_oids = self._write_report(save_report)
+        self._deliver(report_oids, transmit_report, transmit_differences)
         self._closeConn()
         if hasattr(self, 'datePersistence'):
             self.datePersistence.bump_date()
@@ -701,6 +923,199 @@ class GenerateReport(object):
                      self.criteria.report_method)
 
 
+class MultiReport(object):
+    """Generate several reports in a single pass over the data
+
+    Each report's visits are selected as usual (see
+    `GenerateReport._reportable_visits`), but into one reportable_pks
+    table, tagging each visit with a bitmask of the reports it belongs
+    to.  The essence rows and diagnoses of that superset are read
+    once, each row written to every report it belongs to - less the
+    patient_class column for reports limited to a patient_class, as
+    when generated on their own.
+
+    The reports must share the database and date range, and can't
+    include vitals.  The first report's connection is used for all.
+
+    """
+    # Bits available in the reportable_pks bitmask
+    MAX_REPORTS = 31
+
+    def __init__(self, user=None, password=None, report_criteria=(),
+                 datefile=None, sql_diagnosis=False, essence_flat=False,
+                 compress=False, part_size=None):
+        """Initialize generation of the reports.
+
+        :param user: database user
+        :param password: database password
+        :param report_criteria: list of ReportCriteria, one per report
+        :param datefile: useful for persistent walks through time
+        :param sql_diagnosis: see `GenerateReport`
+        :param essence_flat: see `GenerateReport`
+        :param compress: see `GenerateReport`
+        :param part_size: see `GenerateReport`
+
+        """
+        if not 0 < len(report_criteria) <= self.MAX_REPORTS:
+            raise ValueError("between 1 and %d reports supported" %
+                             self.MAX_REPORTS)
+        lead = report_criteria[0]
+        for criteria in report_criteria:
+            if (criteria.database, criteria.start_date,
+                    criteria.end_date) != (lead.database,
+                                           lead.start_date, lead.end_date):
+                raise ValueError("reports must share database and dates")
+            if criteria.include_vitals:
+                raise ValueError("multiple reports don't support vitals")
+        if len(set(c.report_method for c in report_criteria)) != \
+                len(report_criteria):
+            raise ValueError("duplicate report requested")
+        if datefile:
+            assert((lead.start_date, lead.end_date)
+                   == datefile.get_date_range())
+            self.datePersistence = datefile
+
+        self.reports = [GenerateReport(user=user, password=password,
+                                       report_criteria=criteria,
+                                       sql_diagnosis=sql_diagnosis,
+                                       essence_flat=essence_flat,
+                                       compress=compress,
+                                       part_size=part_size)
+                        for criteria in report_criteria]
+        self.lead = self.reports[0]
+
+    def _build_visit_join_table(self):
+        """Populate reportable_pks with the visits of every report
+
+        The `reports` column is the bitmask of the reports each visit
+        belongs to, bit n for self.reports[n].
+
+        """
+        access = self.lead.access
+        access.raw_query("CREATE TEMPORARY TABLE reportable_pks (pk "
+                         "integer not null unique, reports integer not "
+                         "null)")
+        for bit, report in enumerate(self.reports):
+            for select in report._reportable_visits():
+                access.raw_query(
+                    "INSERT INTO reportable_pks SELECT pk, %d FROM (%s) v "
+                    "ON CONFLICT (pk) DO UPDATE SET reports = "
+                    "reportable_pks.reports | EXCLUDED.reports" %
+                    (1 << bit, select))
+
+        cursor = access.raw_query("SELECT COUNT(*) FROM reportable_pks")
+        logging.debug("%d visits to report on, for %d reports",
+                      cursor.fetchall()[0][0], len(self.reports))
+
+    def _write_reports(self, save_report=False):
+        """Write out and potentially store the results of every report
+
+        :param save_report: If set, persist the documents and related
+          metadata to the mbds archive.
+
+        returns the list of document IDs of each report, in report
+        order
+
+        """
+        lead = self.lead
+        for report in self.reports:
+            print >> report.output, report._header()
+        if lead.essence_flat:
+            lead._refresh_essence_flat()
+        self._build_visit_join_table()
+        if not lead.sql_diagnosis:
+            lead._diags = lead._select_diagnosis()
+            lead._next_diag = next(lead._diags, None)
+
+        # The full row is selected, each report writing its own columns
+        diagnosis_index = GenerateReport.diagnosis_column_index
+        layouts = []
+        for bit, report in enumerate(self.reports):
+            omit = None
+            if report.criteria.patient_class:
+                omit = GenerateReport.patient_class_column_index
+            layouts.append((1 << bit, report.output.write,
+                            RowFormatter(GenerateReport.columns,
+                                         diagnosis_index, omit=omit)))
+
+        stmt = lead._select_from_essence_view(GenerateReport.columns,
+                                              extra=['ri.reports'])
+        for row in lead._stream(stmt, 'report_essence'):
+            reports = row[-1]
+            row = row[:-1]
+            if lead.sql_diagnosis:
+                diagnosis = strSansNone(row[diagnosis_index])
+            else:
+                diagnosis = lead._diagnosis(row[diagnosis_index])[0]
+            for mask, write, formatter in layouts:
+                if reports & mask:
+                    write(formatter.format(row, diagnosis))
+        if not lead.sql_diagnosis:
+            lead._diags.close()
+        return [report._finish_output(save_report)
+                for report in self.reports]
+
+    def tearDown(self):
+        "Public interface to clean up internals"
+        self.lead._closeConn()
+
+    def execute(self, save_report=False, transmit_report=False,
+                transmit_differences=False):
+        """Execute generation of all the reports
+        """
+        logging.info("Initiate %d ESSENCE report generations [%s-%s] "
+                     "in a single pass", len(self.reports),
+                     self.lead.criteria.start_date,
+                     self.lead.criteria.end_date)
+
+        self.lead._getConn()
+        for report in self.reports[1:]:
+            report.access = self.lead.access
+        report_oids = self._write_reports(save_report)
+        for report, oids in zip(self.reports, report_oids):
+            report._deliver(oids, transmit_report, transmit_differences)
+        self.lead._closeConn()
+        if hasattr(self, 'datePersistence'):
+            self.datePersistence.bump_date()
+
+        logging.info("Completed ESSENCE report generation [%s-%s] for %s",
+                     self.lead.criteria.start_date,
+                     self.lead.criteria.end_date,
+                     ', '.join(report.criteria.report_method
+                               for report in self.reports))
+
+
+def _generate_report(job):
+    """Generate one report of a `--parallel` run, in a pool process
+
+    :param job: dictionary of the report's criteria (as validated by
+      the parent), credentials and GenerateReport options - with
+      essence_flat, the parent has already refreshed the table
+
+    returns (report_method, None) on success, (report_method,
+    traceback) on failure
+
+    """
+    criteria = ReportCriteria()
+    criteria._crit.update(job['criteria'])
+    report_method = criteria.report_method
+    try:
+        report = GenerateReport(user=job['user'],
+                                password=job['password'],
+                                report_criteria=criteria,
+                                sql_diagnosis=job['sql_diagnosis'],
+                                essence_flat=job['essence_flat'],
+                                refresh_flat=False,
+                                compress=job['compress'],
+                                part_size=job['part_size'])
+        report.execute(save_report=job['save_report'],
+                       transmit_report=job['transmit_report'],
+                       transmit_differences=job['transmit_differences'])
+    except Exception:
+        return report_method, traceback.format_exc()
+    return report_method, None
+
+
 class SortedDiagnosis(object):
     """ Special class unlikely to have use beyond report generation -
     this is used to build up a list of diagnosis for a visit,
@@ -800,6 +1215,73 @@ class Vitals(object):
                     ('8310-5', '20564-1', '46077-4', '29544-4')]
 
 
+class CopyUnquote(object):
+    """File wrapper dropping the quotes of `GenerateReport._copy`
+
+    COPY in CSV format quotes any line with an embedded newline.  As
+    the QUOTE character never occurs in the data, every occurrence is
+    such a quote, and simply dropped.
+
+    """
+    QUOTE = '\x1e'
+
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, data):
+        self.out.write(data.replace(self.QUOTE, ''))
+
+
+class RowFormatter(object):
+    """Formats report rows into lines, compiled once for the layout
+
+    Rows are as selected for the report, the visit_pk standing in for
+    the diagnosis column, and followed by the vitals if included.  The
+    line template is built up front, so each row costs a single
+    string formatting, None values written as empty strings.
+
+    A row selected for several reports (see `MultiReport`) may carry
+    a column some don't write, i.e. the patient_class of a report
+    limited to one - given as `omit`.
+
+    """
+    VITALS = 4  # columns, see `Vitals`
+
+    def __init__(self, columns, diagnosis_index, vitals=False,
+                 omit=None):
+        """Compile the formatter
+
+        :param columns: the columns of each row
+        :param diagnosis_index: index of the diagnosis column
+        :param vitals: True if the vitals columns follow
+        :param omit: index of a column not to write, if any
+
+        """
+        width = len(columns) + (self.VITALS if vitals else 0)
+        if omit is not None:
+            width -= 1
+        self.template = '|'.join(['%s'] * width) + '\n'
+        self.diagnosis_index = diagnosis_index
+        self.vitals = vitals
+        self.omit = omit
+
+    def format(self, row, diagnosis, vitals=()):
+        """Returns the line for row, newline included
+
+        :param row: the selected columns
+        :param diagnosis: the diagnosis column, replacing the visit_pk
+        :param vitals: the vitals columns, if included
+
+        """
+        values = ['' if column is None else column for column in row]
+        values[self.diagnosis_index] = diagnosis
+        if self.omit is not None:
+            del values[self.omit]
+        if self.vitals:
+            values.extend(vitals)
+        return self.template % tuple(values)
+
+
 class ReportCommandLineInterface(object):
     """Command line interface to generating reports
 
@@ -811,6 +1293,8 @@ class ReportCommandLineInterface(object):
         """initializer for CLI"""
         # All criteria used to uniquely define a report
         self.criteria = ReportCriteria()
+        # Criteria of each report, when generating several at once
+        self.report_criteria = [self.criteria]
 
         # Any additional attributes collected but not necessarily
         # unique to recreating a like report
@@ -821,6 +1305,11 @@ class ReportCommandLineInterface(object):
         self.save_report = False
         self.transmit_report = False
         self.transmit_differences = False
+        self.sql_diagnosis = False
+        self.essence_flat = False
+        self.parallel = 0
+        self.compress = False
+        self.part_size = None
 
     @property
     def password(self):
@@ -873,15 +1362,22 @@ class ReportCommandLineInterface(object):
                               "data) as additional columns in the "\
                               "report")
         parser.add_option("-k", "--patient-class",
-                          dest="patient_class",
+                          dest="patient_class", action="append",
                           default=None, help="use "\
                           "to filter report on a specific patient "\
-                          "class [E,I,O]")
+                          "class [E,I,O], repeat for a report of each")
         parser.add_option("-r", "--region", dest="region",
-                          default=None,
+                          action="append", default=None,
                           help="reportable region defining limited set "\
                               "of facilities to include, by default "\
-                              "all  facilities are included")
+                              "all  facilities are included.  Repeat "\
+                              "for a report of each region (and each "\
+                              "patient class), generated in one pass")
+        parser.add_option("--with-statewide", action='store_true',
+                          dest="with_statewide", default=False,
+                          help="also generate the statewide report, "\
+                              "in the same pass as the -r and -k "\
+                              "reports")
         parser.add_option("-s", "--save-and-upload",
                           action='store_true', dest="save_upload",
                           default=False, help="save file and upload to "\
@@ -897,6 +1393,29 @@ class ReportCommandLineInterface(object):
                           action='store_true', dest="thirty_days",
                           default=False, help="include 30 days up to "\
                               "requested date ")
+        parser.add_option("--export", "--sql-diagnosis",
+                          action='store_true',
+                          dest="sql_diagnosis", default=False,
+                          help="aggregate diagnoses in the database, "\
+                              "which then writes the report via COPY "\
+                              "(not with --include-vitals)")
+        parser.add_option("--essence-flat", action='store_true',
+                          dest="essence_flat", default=False,
+                          help="report from the essence_flat table, "\
+                              "refreshed first (not with "\
+                              "--include-vitals)")
+        parser.add_option("--parallel", dest="parallel", type="int",
+                          default=self.parallel, metavar="N",
+                          help="generate the -r and -k reports as "\
+                              "separate jobs, N at a time, rather "\
+                              "than in a single pass")
+        parser.add_option("-z", "--gzip", action='store_true',
+                          dest="compress", default=False,
+                          help="gzip the report as it's written")
+        parser.add_option("--part-size", dest="part_size", type="int",
+                          default=None, metavar="MB",
+                          help="split the report into files of at most "\
+                              "MB megabytes each")
         parser.add_option("-v", "--verbose", dest="verbosity",
                           action="count", default=self.verbosity,
                           help="increase output verbosity")
@@ -904,19 +1423,48 @@ class ReportCommandLineInterface(object):
         (options, args) = parser.parse_args()
         if len(args) != 2:
             parser.error("incorrect number of arguments")
+        if options.sql_diagnosis and options.includeVitals:
+            parser.error("export (sql-diagnosis) and include-vitals are "\
+                         "mutually exclusive")
+        if options.essence_flat and options.includeVitals:
+            parser.error("essence-flat and include-vitals are "\
+                         "mutually exclusive")
+
+        # A report for each region and patient class combination
+        reports = [(region, patient_class)
+                   for region in options.region or [None]
+                   for patient_class in options.patient_class or [None]]
+        if options.with_statewide and (None, None) not in reports:
+            reports.insert(0, (None, None))
+        if options.part_size is not None and options.part_size < 1:
+            parser.error("--part-size must be positive")
+        if options.parallel < 0:
+            parser.error("--parallel must be positive")
+        if len(reports) > MultiReport.MAX_REPORTS and \
+                not options.parallel:
+            parser.error("at most %d reports in a single pass" %
+                         MultiReport.MAX_REPORTS)
+        if len(reports) > 1 and options.includeVitals and \
+                not options.parallel:
+            parser.error("include-vitals is limited to a single report, "
+                         "unless --parallel")
 
         # Database to query
         self.criteria.database = args[0]
         self.user = options.user
         self.password = options.password
+        if ConnectionFactory(user=self.user,
+                             password=self.password).pgbouncer:
+            parser.error("reports need a direct connection, not "
+                         "supported in pgbouncer mode")
         self.criteria.credentials(user=self.user,
                                   password=self.password)
 
         # Potential region restriction
-        self.criteria.reportable_region = options.region
+        self.criteria.reportable_region = reports[0][0]
 
         # Potential patient class restriction
-        self.criteria.patient_class = options.patient_class
+        self.criteria.patient_class = reports[0][1]
 
         # Potential to include vitals (not tied to gipse format)
         self.criteria.include_vitals = options.includeVitals
@@ -942,6 +1490,20 @@ class ReportCommandLineInterface(object):
         self.criteria.start_date, self.criteria.end_date =\
             self.datefile.get_date_range()
 
+        # Like criteria for any further reports
+        for region, patient_class in reports[1:]:
+            criteria = ReportCriteria()
+            criteria.error_callback = parser.error
+            criteria.database = self.criteria.database
+            criteria.credentials(user=self.user, password=self.password)
+            criteria.reportable_region = region
+            criteria.patient_class = patient_class
+            criteria.include_vitals = self.criteria.include_vitals
+            criteria.include_updates = self.criteria.include_updates
+            criteria.start_date = self.criteria.start_date
+            criteria.end_date = self.criteria.end_date
+            self.report_criteria.append(criteria)
+
         # What to do once report is completed.  Complicated, protect
         # user from themselves!
         self.save_report = options.save_upload or \
@@ -969,20 +1531,94 @@ class ReportCommandLineInterface(object):
 
         # How verbosely to log
         self.verbosity = options.verbosity
+        self.sql_diagnosis = options.sql_diagnosis
+        self.essence_flat = options.essence_flat
+        self.parallel = options.parallel
+        self.compress = options.compress
+        if options.part_size:
+            self.part_size = options.part_size << 20
 
     def execute(self):
         """Use the collected info to launch execution"""
         configure_logging(verbosity=self.verbosity,
                          logfile="%s.log" % self.criteria.report_method)
 
-        gr = GenerateReport(user=self.user,
-                            password=self.password,
-                            report_criteria=self.criteria,
-                            datefile=self.datefile)
+        if self.parallel and len(self.report_criteria) > 1:
+            return self._execute_parallel()
+        if len(self.report_criteria) > 1:
+            gr = MultiReport(user=self.user,
+                             password=self.password,
+                             report_criteria=self.report_criteria,
+                             datefile=self.datefile,
+                             sql_diagnosis=self.sql_diagnosis,
+                             essence_flat=self.essence_flat,
+                             compress=self.compress,
+                             part_size=self.part_size)
+        else:
+            gr = GenerateReport(user=self.user,
+                                password=self.password,
+                                report_criteria=self.criteria,
+                                datefile=self.datefile,
+                                sql_diagnosis=self.sql_diagnosis,
+                                essence_flat=self.essence_flat,
+                                compress=self.compress,
+                                part_size=self.part_size)
         gr.execute(save_report=self.save_report,
                     transmit_report=self.transmit_report,
                     transmit_differences=self.transmit_differences)
 
+    def _execute_parallel(self):
+        """Generate each report as a separate job in a process pool
+
+        Each job has its own database connection.  Progress and
+        failures are logged here as the jobs complete, any failure
+        ending the run with a non zero exit status (and the date not
+        bumped) once all are done.
+
+        With essence_flat, the table is refreshed here once, rather
+        than by every job.
+
+        """
+        if self.essence_flat:
+            engine = ConnectionFactory(
+                user=self.user, password=self.password).engine(
+                    self.criteria.database)
+            logging.info("refreshed %d essence_flat rows",
+                         refresh_essence_flat(engine))
+            # Leave no pooled connections to the forked jobs
+            engine.dispose()
+        jobs = [{'criteria': dict(criteria._crit),
+                 'user': self.user,
+                 'password': self.password,
+                 'sql_diagnosis': self.sql_diagnosis,
+                 'essence_flat': self.essence_flat,
+                 'compress': self.compress,
+                 'part_size': self.part_size,
+                 'save_report': self.save_report,
+                 'transmit_report': self.transmit_report,
+                 'transmit_differences': self.transmit_differences}
+                for criteria in self.report_criteria]
+        logging.info("Initiate %d ESSENCE report generations, %d at a "
+                     "time", len(jobs), self.parallel)
+        failures = []
+        pool = Pool(min(self.parallel, len(jobs)))
+        try:
+            for done, (report_method, error) in enumerate(
+                    pool.imap_unordered(_generate_report, jobs), 1):
+                if error:
+                    failures.append(report_method)
+                    logging.error("%s failed: %s", report_method, error)
+                logging.info("%d of %d reports done, %d failed", done,
+                             len(jobs), len(failures))
+        finally:
+            pool.close()
+            pool.join()
+        if failures:
+            raise SystemExit("%d of %d reports failed: %s" %
+                             (len(failures), len(jobs),
+                              ', '.join(failures)))
+        self.datefile.bump_date()
+
 
 def main():
     cli = ReportCommandLineInterface()
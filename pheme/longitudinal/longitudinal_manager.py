@@ -1,21 +1,34 @@
 #!/usr/bin/env python
 
-from datetime import timedelta
+from datetime import datetime, timedelta
+import errno
+import json
 import logging
 from optparse import OptionParser
 import os
-from multiprocessing import JoinableQueue, Process, Lock
+from multiprocessing import Event, JoinableQueue, Process, Queue
+from Queue import Empty
+import signal
 import time
 
-from sqlalchemy.sql import and_
+from sqlalchemy.sql import text
 
-from .longitudinal_worker import LongitudinalWorker
-from .tables import MessageProcessed
+from .bulk_backfill import BulkBackfill
+from .connections import ConnectionFactory
+from .dimension_cache import SharedDimensionCache
+from .longitudinal_worker import LongitudinalWorker, WorkerSlot
+from .notify import VisitListener
+from .scheduling import CoalescingScheduler, PriorityLanes, ShardFeeder
+from .select_or_insert import TABLE_LOCKS, TrackedLock, advisory_key
+from .tables import MessageProcessed, PendingVisit
+from .throttle import Throttle, configured_thresholds, database_load
+from .tables import rebuild_pending_visits, refresh_essence_flat
 from pheme.util.datefile import Datefile
 from pheme.util.lock import Lock as FileLock
-from pheme.util.pg_access import AlchemyAccess, DirectAccess
-from pheme.util.config import configure_logging
+from pheme.util.config import Config, configure_logging
 from pheme.util.util import parseDate, systemUnderLoad
+from pheme.util.util import none_safe_max as max
+from pheme.util.util import none_safe_min as min
 
 usage = """%prog [options] data_warehouse data_mart
 
@@ -40,12 +53,60 @@ class LongitudinalManager(object):
     advatage of multi-core processor and database as the limiting
     factor).
 
+    In distributed mode, managers on any number of hosts may run
+    concurrently against the same data mart.  Their workers claim
+    visits directly from the mart's internal_pending_visit table and
+    synchronize dimension inserts with database advisory locks,
+    rather than relying on this manager's queue and locks.
+
+    In daemon mode, the manager and a pool of persistent workers run
+    indefinitely, picking up new messages every few seconds rather
+    than at the cadence of cron.
+
+    When throttling, the workers are slowed or paused while the
+    databases are under load, see `_check_load`.
+
+    With priority workers, urgent visits (i.e. today's) are fed ahead
+    of any backlog, see `_dispatch`.
+
+    In range mode (i.e. --start and --end) the admission days of a
+    backfill are worked several at a time, see `_run_range`.
+
     """
     # The gating issue is the number of postgres connections that are
     # allowed to run concurrently.  Setting this to N-1 (where N is
     # the number of cores) has proven the fastest and most reliable.
     NUM_PROCS = 5
 
+    # When listening for notifications, how often to fall back to
+    # discovering all visits needing attention
+    FULL_DISCOVERY_SECONDS = 600
+
+    # A failed daemon cycle is retried after BACKOFF_SECONDS, doubled
+    # with each consecutive failure up to MAX_BACKOFF_SECONDS
+    BACKOFF_SECONDS = 5
+    MAX_BACKOFF_SECONDS = 300
+
+    # Workers are checked on every SUPERVISE_SECONDS.  One taking
+    # longer than VISIT_TIMEOUT seconds on a visit is killed, and the
+    # visit of a dead worker requeued up to MAX_RETRIES times.
+    SUPERVISE_SECONDS = 5
+    VISIT_TIMEOUT = 900
+    MAX_RETRIES = 1
+
+    # Visits are fed to the workers as they complete, keeping at most
+    # FEED_AHEAD per worker dispatched at any time
+    FEED_AHEAD = 4
+
+    # Admission days worked at once in range mode
+    ACTIVE_SHARDS = 4
+
+    # With priority workers, how often to look for new urgent visits
+    PRIORITY_REFRESH_SECONDS = 60
+
+    # When throttling, how often to sample the database load
+    THROTTLE_SECONDS = 30
+
     def __init__(self, data_warehouse=None, data_mart=None,
                  reportDate=None, database_user=None,
                  database_password=None, verbosity=0):
@@ -59,10 +120,42 @@ class LongitudinalManager(object):
         self.dir, thisFile = os.path.split(__file__)
         self.verbosity = verbosity
         self.queue = JoinableQueue()
+        self.done_queue = Queue()
+        self.stop = Event()
         self.datefile = "/tmp/longitudinal_datefile"
+        tmp_dir = Config().get('general', 'tmp_dir', default='/tmp')
+        self.checkpoint_file = os.path.join(tmp_dir,
+                                            'longitudinal_checkpoint')
+        self.progress_file = os.path.join(tmp_dir,
+                                          'longitudinal_range_progress')
         self.datePersistence = Datefile(initial_date=self.reportDate)
         self.lock = FileLock(LOCKFILE)
         self.skip_prep = False
+        self.rebuild_pending = False
+        self.distributed = False
+        self.advisory_locks = False
+        self.shared_cache_slots = 0
+        self.shared_cache = None
+        self.preload = False
+        self.bulk_backfill = False
+        self.daemon_interval = 0
+        self.listen_channel = None
+        self.quiet = 0
+        self.max_delay = None
+        self.visit_timeout = self.VISIT_TIMEOUT
+        self._workers = []
+        self._table_locks = {}
+        self._retries = {}
+        self.range_start = None
+        self.range_end = None
+        self.active_shards = self.ACTIVE_SHARDS
+        self.priority_workers = 0
+        self.throttle_load = False
+        self.essence_flat = False
+        self._throttle = None
+        self._load_sampled = 0
+        self._in_flight = set()
+        self._stopping = False
 
     def __call__(self):
         return self.execute()
@@ -79,10 +172,89 @@ class LongitudinalManager(object):
         parser.add_option("-d", "--date", dest="date", default=None,
                           help="single admission date to dedup "\
                           "(by default, checks the entire database)")
+        parser.add_option("--start", dest="start", default=None,
+                          help="first admission date of a range to "\
+                          "dedup, several days at a time (requires "\
+                          "--end)")
+        parser.add_option("--end", dest="end", default=None,
+                          help="last admission date of the range, "\
+                          "inclusive")
+        parser.add_option("--shards", dest="active_shards",
+                          default=self.active_shards, type="int",
+                          help="with --start, number of days worked at "\
+                          "once (default %d)" % self.active_shards)
         parser.add_option("-s", "--skip-prep", dest="skip_prep",
                           default=False, action="store_true",
                           help="skip the expense of looking for new "\
                           "messages")
+        parser.add_option("--rebuild-pending", dest="rebuild_pending",
+                          default=False, action="store_true",
+                          help="rebuild the pending visit work queue "\
+                          "from internal_message_processed before "\
+                          "looking for visits to process")
+        parser.add_option("--distributed", dest="distributed",
+                          default=False, action="store_true",
+                          help="claim work from the data mart, so "\
+                          "managers on several hosts may share the "\
+                          "load (entire database only)")
+        parser.add_option("--advisory-locks", dest="advisory_locks",
+                          default=False, action="store_true",
+                          help="synchronize dimension inserts with per "\
+                          "value database advisory locks in place of "\
+                          "table wide locks")
+        parser.add_option("--shared-cache", dest="shared_cache_slots",
+                          default=0, type="int", metavar="SLOTS",
+                          help="share a dimension cache of SLOTS "\
+                          "entries between this manager's workers")
+        parser.add_option("--preload", dest="preload", default=False,
+                          action="store_true",
+                          help="warm the workers' dimension caches "\
+                          "from the data mart at startup")
+        parser.add_option("--bulk-backfill", dest="bulk_backfill",
+                          default=False, action="store_true",
+                          help="merge new visits lacking lab and "\
+                          "clinical data with set based SQL before "\
+                          "launching workers (see BulkBackfill)")
+        parser.add_option("--daemon", dest="daemon_interval",
+                          default=0, type="int", metavar="SECONDS",
+                          help="run indefinitely, with persistent "\
+                          "workers, looking for new messages every "\
+                          "SECONDS (entire database only)")
+        parser.add_option("--listen", dest="listen_channel",
+                          default=None, metavar="CHANNEL",
+                          help="with --daemon, LISTEN on CHANNEL for "\
+                          "new visits notified by the warehouse "\
+                          "trigger (see install_notify_trigger)")
+        parser.add_option("--quiet", dest="quiet", default=0,
+                          type="int", metavar="SECONDS",
+                          help="with --daemon, hold busy visits till "\
+                          "they've received no new messages for "\
+                          "SECONDS, merging them in a single pass")
+        parser.add_option("--max-delay", dest="max_delay", default=None,
+                          type="int", metavar="SECONDS",
+                          help="with --quiet, longest a visit is held "\
+                          "(default 4 times the quiet period)")
+        parser.add_option("--visit-timeout", dest="visit_timeout",
+                          default=self.visit_timeout, type="int",
+                          metavar="SECONDS",
+                          help="kill and replace a worker taking longer "\
+                          "than SECONDS on a single visit, 0 to wait "\
+                          "indefinitely (default %d)" % self.visit_timeout)
+        parser.add_option("--priority-workers", dest="priority_workers",
+                          default=0, type="int", metavar="N",
+                          help="reserve N workers for urgent visits, "\
+                          "those recently admitted or from the "\
+                          "priority_facilities or patient classes "\
+                          "configured, fed ahead of any backlog")
+        parser.add_option("--throttle", dest="throttle_load",
+                          default=False, action="store_true",
+                          help="slow or pause the workers while the "\
+                          "mart or warehouse is under load (see "\
+                          "throttle_* config)")
+        parser.add_option("--essence-flat", dest="essence_flat",
+                          default=False, action="store_true",
+                          help="maintain the essence_flat reporting "\
+                          "table as visits are processed")
         parser.add_option("-v", "--verbose", dest="verbosity",
                           action="count", default=self.verbosity,
                           help="increase output verbosity")
@@ -96,6 +268,40 @@ class LongitudinalManager(object):
         (options, args) = parser.parse_args()
         if len(args) != 2:
             parser.error("incorrect number of arguments")
+        if bool(options.start) != bool(options.end):
+            parser.error("--start and --end go together")
+        if options.start and (options.date or options.countdown or
+                              options.distributed or
+                              options.daemon_interval):
+            parser.error("--start and --end can't be combined with a "
+                         "single date, --distributed or --daemon")
+        if not 0 <= options.priority_workers < self.NUM_PROCS:
+            parser.error("--priority-workers must leave at least one "
+                         "of the %d workers for the backlog" %
+                         self.NUM_PROCS)
+        if options.priority_workers and (options.distributed or
+                                         options.start):
+            parser.error("--priority-workers can't be combined with "
+                         "--distributed or --start")
+        if options.throttle_load and options.distributed:
+            parser.error("--throttle can't be combined with "
+                         "--distributed")
+        if options.active_shards < 1:
+            parser.error("--shards must be positive")
+        if options.distributed and (options.date or options.countdown):
+            parser.error("--distributed works on the entire database, "
+                         "not a single date")
+        if options.daemon_interval and (options.date or
+                                        options.countdown):
+            parser.error("--daemon works on the entire database, "
+                         "not a single date")
+        if options.listen_channel and not options.daemon_interval:
+            parser.error("--listen requires --daemon")
+        if options.quiet and not options.daemon_interval:
+            parser.error("--quiet requires --daemon")
+        if options.max_delay is not None and \
+                options.max_delay < options.quiet:
+            parser.error("--max-delay can't be less than --quiet")
 
         self.data_warehouse = args[0]
         self.data_mart = args[1]
@@ -103,6 +309,26 @@ class LongitudinalManager(object):
         self.mart_port = parser.values.mart_port
         self.verbosity = parser.values.verbosity
         self.skip_prep = parser.values.skip_prep
+        self.rebuild_pending = parser.values.rebuild_pending
+        self.distributed = parser.values.distributed
+        self.advisory_locks = parser.values.advisory_locks
+        self.shared_cache_slots = parser.values.shared_cache_slots
+        self.preload = parser.values.preload
+        self.bulk_backfill = parser.values.bulk_backfill
+        self.daemon_interval = parser.values.daemon_interval
+        self.listen_channel = parser.values.listen_channel
+        self.quiet = parser.values.quiet
+        self.max_delay = parser.values.max_delay
+        self.visit_timeout = parser.values.visit_timeout
+        self.active_shards = parser.values.active_shards
+        self.priority_workers = parser.values.priority_workers
+        self.throttle_load = parser.values.throttle_load
+        self.essence_flat = parser.values.essence_flat
+        if options.start:
+            self.range_start = parseDate(options.start)
+            self.range_end = parseDate(options.end)
+            if self.range_end < self.range_start:
+                parser.error("--end precedes --start")
         initial_date = parser.values.date and \
             parseDate(parser.values.date) or None
         self.datePersistence = Datefile(initial_date=initial_date,
@@ -121,6 +347,10 @@ class LongitudinalManager(object):
         referential integrity available at the database level, so care
         should be taken.
 
+        Each visit receiving new messages is also queued (or has its
+        pending count bumped) in the internal_pending_visit table, in
+        the same transaction as the messages themselves.
+
         """
         startTime = time.time()
         logging.info("Starting INSERT INTO internal_message_processed "
@@ -137,7 +367,8 @@ class LongitudinalManager(object):
             max_id = 0
 
         new_msgs = list()
-        stmt = """SELECT hl7_msh_id, message_datetime, visit_id
+        stmt = """SELECT hl7_msh_id, message_datetime, visit_id,
+        admit_datetime, facility, patient_class
         FROM hl7_msh JOIN hl7_visit USING (hl7_msh_id) WHERE
         hl7_msh_id > %d """ % max_id
         rs = self.data_warehouse_access.engine.execute(stmt)
@@ -146,12 +377,19 @@ class LongitudinalManager(object):
             results = rs.fetchmany(many)
             if not results:
                 break
+            pending = dict()
             for r in results:
                 new_msgs.append(MessageProcessed(hl7_msh_id=r[0],
                                                  message_datetime=r[1],
                                                  visit_id=r[2]))
+                count, oldest, admit, facility, patient_class = \
+                    pending.get(r[2], (0, None, None, None, None))
+                pending[r[2]] = (count + 1, min(oldest, r[1]),
+                                 max(admit, r[3]), r[4] or facility,
+                                 r[5] or patient_class)
 
             self.data_mart_access.session.add_all(new_msgs)
+            self._queue_pending_visits(pending)
             self.data_mart_access.session.commit()
             logging.debug("added %d new messages" % len(new_msgs))
             new_msgs = list()
@@ -159,23 +397,65 @@ class LongitudinalManager(object):
         logging.info("Added new rows to internal_message_processed in %s",
                      time.time() - startTime)
 
-    def _visitsToProcess(self):
+    def _queue_pending_visits(self, pending):
+        """Add or bump internal_pending_visit rows for new messages
+
+        Executed in the data mart session, left for the caller to
+        commit along with the respective internal_message_processed
+        rows.
+
+        :param pending: dictionary keyed by visit_id, values being
+          (count of new messages, oldest new message_datetime, latest
+          admit_datetime, facility, patient_class)
+
+        """
+        if not pending:
+            return
+        stmt = text("""INSERT INTO internal_pending_visit
+        (visit_id, pending_count, oldest_message, admit_datetime,
+          facility, patient_class) VALUES
+        (:visit_id, :pending_count, :oldest_message, :admit_datetime,
+          :facility, :patient_class)
+        ON CONFLICT (visit_id) DO UPDATE SET
+        pending_count = internal_pending_visit.pending_count +
+          EXCLUDED.pending_count,
+        oldest_message = least(internal_pending_visit.oldest_message,
+          EXCLUDED.oldest_message),
+        admit_datetime = greatest(internal_pending_visit.admit_datetime,
+          EXCLUDED.admit_datetime),
+        facility = coalesce(EXCLUDED.facility,
+          internal_pending_visit.facility),
+        patient_class = coalesce(EXCLUDED.patient_class,
+          internal_pending_visit.patient_class),
+        attempts = 0""")
+        self.data_mart_access.session.execute(
+            stmt, [{'visit_id': visit_id, 'pending_count': count,
+                    'oldest_message': oldest, 'admit_datetime': admit,
+                    'facility': facility, 'patient_class': patient_class}
+                   for visit_id, (count, oldest, admit, facility,
+                                  patient_class) in pending.items()])
+
+    def _visitsToProcess(self, day=None):
         """ Look up all distinct visit ids needing attention
 
         Obtain unique list of visit_ids that have messages that
-        haven't previously been processed.  If the user requested just
+        haven't previously been processed, as found in the
+        internal_pending_visit work queue.  If the user requested just
         one days worth (i.e. -d) only that days visits will be
         returned.
 
+        :param day: admission date to look up, in place of the
+          reportDate
+
         """
         visit_ids = list()
-        if not self.reportDate:
+        day = day or self.reportDate
+        if not day:
             logging.info("Launch deduplication for entire database")
             # Do the whole batch, that is, all that haven't been
-            # processed before.
-            stmt = """SELECT DISTINCT(visit_id) FROM
-            internal_message_processed
-            WHERE processed_datetime IS NULL"""
+            # processed before - oldest first.
+            stmt = """SELECT visit_id FROM internal_pending_visit
+            ORDER BY oldest_message"""
             rs = self.data_mart_access.engine.execute(stmt)
             many = 10000
             while True:
@@ -186,8 +466,7 @@ class LongitudinalManager(object):
                     visit_ids.append(r[0])
 
         else:
-            logging.info("Launch deduplication for %s",
-                         self.reportDate)
+            logging.info("Launch deduplication for %s", day)
             # Process the requested day only - as we can't join across
             # db boundaries - first acquire the full list of visits
             # for the requested day from the data_warehouse to use in
@@ -195,8 +474,7 @@ class LongitudinalManager(object):
 
             stmt = """SELECT DISTINCT(visit_id) FROM hl7_visit WHERE
             admit_datetime BETWEEN '%s' AND '%s';""" %\
-            (self.reportDate, self.reportDate + timedelta(days=1))
-            self.access.raw_query(stmt)
+            (day, day + timedelta(days=1))
             rs = self.data_warehouse_access.engine.execute(stmt)
             many = 1000
             potential_visit_ids = list()
@@ -210,11 +488,9 @@ class LongitudinalManager(object):
 
             if potential_visit_ids:
                 query = self.data_mart_access.session.query(\
-                    MessageProcessed.visit_id).distinct().\
-                    filter(and_(MessageProcessed.processed_datetime ==
-                                None,
-                                MessageProcessed.visit_id.\
-                                in_(potential_visit_ids)))
+                    PendingVisit.visit_id).\
+                    filter(PendingVisit.visit_id.\
+                           in_(potential_visit_ids))
 
                 for r in query:
                     visit_ids.append(r[0])
@@ -223,10 +499,768 @@ class LongitudinalManager(object):
                      len(visit_ids))
         return visit_ids
 
+    def _distributed_prep(self):
+        """Prep the deduplicate tables unless another host is
+
+        Only one manager need bring over new messages at a time.  A
+        database advisory lock determines which - others carry on
+        without waiting.
+
+        The lock is transaction scoped, held by a transaction left open
+        for the duration, so it's kept behind a transaction pooler.
+
+        """
+        key = advisory_key('prep_deduplicate_tables')
+        connection = self.data_mart_access.engine.connect()
+        transaction = connection.begin()
+        try:
+            if not connection.execute(
+                    text("SELECT pg_try_advisory_xact_lock(:k1, :k2)"),
+                    k1=key[0], k2=key[1]).scalar():
+                logging.info("Another manager is adding new messages, "
+                             "skipping prep")
+                return
+            self._prepDeduplicateTables()
+        finally:
+            transaction.rollback()
+            connection.close()
+
+    def _bulk_backfill(self):
+        """Merge what can be with set based SQL, leaving the rest
+
+        Visits merged are removed from internal_pending_visit, so
+        won't be found by `_visitsToProcess` or claimed by workers.
+
+        """
+        BulkBackfill(self.data_warehouse_access.engine,
+                     self.data_mart_access.engine,
+                     table_locks=self._table_locks).run()
+
+    def _launch_worker(self, procNumber, table_locks, slot=None):
+        """Start a LongitudinalWorker in its own process
+
+        :param procNumber: number used to identify the worker
+        :param table_locks: dictionary of locks (see TABLE_LOCKS),
+          unused by distributed workers or with advisory_locks
+        :param slot: `WorkerSlot` for the worker to record its
+          progress in
+
+        returns the started Process
+
+        """
+        dw = Process(target=LongitudinalWorker,
+                     kwargs={'queue': self.queue,
+                             'procNumber': procNumber,
+                             'data_warehouse': self.data_warehouse,
+                             'warehouse_port': self.warehouse_port,
+                             'data_mart': self.data_mart,
+                             'mart_port': self.mart_port,
+                             'dbUser': self.database_user,
+                             'dbPass': self.database_password,
+                             'table_locks': table_locks,
+                             'verbosity': self.verbosity,
+                             'distributed': self.distributed,
+                             'advisory_locks': self.advisory_locks,
+                             'shared_cache': self.shared_cache,
+                             'preload': self.preload,
+                             'persistent': bool(self.daemon_interval),
+                             'slot': slot,
+                             'done_queue': self.done_queue,
+                             'stop': self.stop,
+                             'essence_flat': self.essence_flat})
+        dw.daemon = True
+        dw.start()
+        return dw
+
     def tearDown(self):
         """ Clean up any open handles/connections """
         # now done in execute when we're done with teh connections
 
+    def _connect(self):
+        """Open the manager's database connections"""
+        self.connections = ConnectionFactory(
+            user=self.database_user, password=self.database_password)
+        self.data_warehouse_access = self.connections.access(
+            self.data_warehouse, self.warehouse_port)
+        self.data_mart_access = self.connections.access(
+            self.data_mart, self.mart_port)
+
+    def _disconnect(self):
+        """Free up the manager's database connections, pool and all"""
+        for access in (self.data_mart_access, self.data_warehouse_access):
+            access.disconnect()
+            access.engine.dispose()
+
+    def _fit_workers(self):
+        """Launch no more workers than the database servers can serve
+
+        Each worker takes up to `ConnectionFactory.per_process`
+        connections to the mart and to the warehouse.
+
+        """
+        shared = self.mart_port == self.warehouse_port
+        for access in (self.data_mart_access, self.data_warehouse_access):
+            procs = self.connections.workers_within(
+                access.engine, self.NUM_PROCS,
+                databases=shared and 2 or 1,
+                reserve=self.connections.per_process)
+            self.NUM_PROCS = max(procs, self.priority_workers + 1)
+
+    def _refresh_essence_flat(self):
+        """Catch essence_flat up with visits the workers didn't touch
+
+        Workers run with --essence-flat refresh the rows of each visit
+        they process.  Bulk backfill bypasses them, so is followed by
+        a refresh, as is each daemon cycle and the end of other runs.
+        Each refresh takes in every visit updated since the last (see
+        `refresh_essence_flat`) - those merged by earlier runs without
+        --essence-flat included.
+
+        """
+        startTime = time.time()
+        refreshed = refresh_essence_flat(self.data_mart_access.engine)
+        logging.info("refreshed %d essence_flat rows in %s", refreshed,
+                     time.time() - startTime)
+
+    def _prep(self):
+        """Pick up new messages, bulk backfill if requested"""
+        if not self.skip_prep:
+            if self.distributed:
+                self._distributed_prep()
+            else:
+                self._prepDeduplicateTables()
+        if self.bulk_backfill:
+            self._bulk_backfill()
+            if self.essence_flat:
+                self._refresh_essence_flat()
+
+    def _new_table_locks(self):
+        """One lock for each table needing protection from
+        asynchronous inserts - see TABLE_LOCKS.  Workers using
+        advisory locks, or distributed workers, need none.
+
+        """
+        if self.advisory_locks or self.distributed:
+            return {}
+        return dict([(table, TrackedLock()) for table in TABLE_LOCKS])
+
+    def _launch_workers(self):
+        """Launch NUM_PROCS workers, returns the started Processes"""
+        # The shared cache must exist before the workers fork
+        if self.shared_cache_slots and self.shared_cache is None:
+            self.shared_cache = SharedDimensionCache(
+                self.shared_cache_slots)
+        self._table_locks = self._new_table_locks()
+        self._workers = []
+        for i in range(self.NUM_PROCS):
+            slot = WorkerSlot()
+            self._workers.append(
+                (self._launch_worker(i, self._table_locks, slot), slot))
+        return [worker for worker, slot in self._workers]
+
+    def _requeue(self, visit_id):
+        """Requeue the visit of a dead worker, within MAX_RETRIES"""
+        retries = self._retries.get(visit_id, 0)
+        if retries < self.MAX_RETRIES:
+            self._retries[visit_id] = retries + 1
+            logging.info("requeue visit %s", visit_id)
+            self._in_flight.add(visit_id)
+            self.queue.put(visit_id)
+        else:
+            logging.error("giving up on visit %s after %d attempts, it "
+                          "remains pending", visit_id, retries + 1)
+            # Report it done, the worker never will
+            self.done_queue.put(visit_id)
+
+    def _supervise(self):
+        """Replace any dead or hung workers
+
+        A worker exceeding the visit timeout is killed.  Locks held by
+        dead workers are released, their visit requeued (queue mode
+        only, distributed claims simply expire) and a replacement
+        launched.  Distributed workers exiting cleanly are out of work
+        and left be.
+
+        """
+        now = time.time()
+        for i, (worker, slot) in enumerate(self._workers):
+            visit_id = slot.visit_id
+            if worker.is_alive():
+                if not (visit_id and self.visit_timeout and
+                        now - slot.started > self.visit_timeout):
+                    continue
+                logging.error("worker-%d exceeded %d seconds on visit "
+                              "%s, killing", i, self.visit_timeout,
+                              visit_id)
+                os.kill(worker.pid, signal.SIGKILL)
+                worker.join()
+            elif worker.exitcode == 0:
+                continue
+            else:
+                logging.error("worker-%d died (exit code %s) on visit %s",
+                              i, worker.exitcode, visit_id)
+
+            for table, lock in self._table_locks.items():
+                if lock.release_if_held_by(worker.pid):
+                    logging.warn("released %s held by worker-%d", table,
+                                 i)
+            if self.shared_cache and \
+                    self.shared_cache.release_if_held_by(worker.pid):
+                logging.warn("released shared cache held by worker-%d", i)
+            if visit_id and not self.distributed:
+                self._requeue(visit_id)
+            slot = WorkerSlot()
+            self._workers[i] = (self._launch_worker(
+                i, self._table_locks, slot), slot)
+
+    def _dispatch(self, visits_to_process):
+        """Feed visits to the workers, returning once all are done
+
+        Rather than filling the queue up front, visits are fed as the
+        workers report them done on the `done_queue`, so a stop
+        request (see `_handle_signal`) need only wait on the few in
+        flight.  The workers are supervised meanwhile.
+
+        With `priority_workers`, urgent visits (see `_urgentVisits`)
+        are fed ahead of the rest, and the backlog is held to the
+        remaining workers.  New messages are picked up every
+        PRIORITY_REFRESH_SECONDS, so visits turning urgent meanwhile
+        needn't wait on the backlog.  A visit still pending once done,
+        i.e. failing, is fed again by the refresh no more than
+        MAX_RETRIES times.
+
+        returns the visits not dispatched, should a stop be requested
+
+        """
+        backlog_limit = None
+        if self.priority_workers:
+            backlog_limit = self.NUM_PROCS - self.priority_workers
+        lanes = PriorityLanes(backlog_limit)
+        lanes.add(visits_to_process)
+        # Limit a single date run to that date's visits
+        within = self.reportDate and set(visits_to_process) or None
+        refreshed = None
+        attempts = {}
+        while True:
+            if self.priority_workers and not self._stopping and \
+                    (refreshed is None or time.time() - refreshed >=
+                     self.PRIORITY_REFRESH_SECONDS):
+                if refreshed is not None and not self.skip_prep:
+                    self._prepDeduplicateTables()
+                refreshed = time.time()
+                lanes.add([visit_id for visit_id in self._urgentVisits()
+                           if visit_id not in self._in_flight and
+                           attempts.get(visit_id, 0) <= self.MAX_RETRIES
+                           and (within is None or visit_id in within)],
+                          urgent=True)
+            while not self._stopping and \
+                    len(self._in_flight) < self._feed_limit():
+                visit_id = lanes.next()
+                if visit_id is None:
+                    break
+                attempts[visit_id] = attempts.get(visit_id, 0) + 1
+                self._in_flight.add(visit_id)
+                self.queue.put(visit_id)
+            if not self._in_flight and (self._stopping or not lanes):
+                return lanes.remaining()
+            for visit_id in self._reap():
+                self._in_flight.discard(visit_id)
+                lanes.done(visit_id)
+
+    def _urgentVisits(self):
+        """Returns the urgent pending visits, latest admission first
+
+        Urgent visits were admitted within `priority_days` (1 by
+        default), or come from one of the `priority_facilities`, or
+        are of one of the `priority_patient_classes` (i.e. 'E'), as
+        set (comma separated) in the [longitudinal] config section.
+
+        """
+        config = Config()
+
+        def listed(option):
+            return [value.strip() for value in
+                    config.get('longitudinal', option,
+                               default='').split(',') if value.strip()]
+
+        days = int(config.get('longitudinal', 'priority_days', default=1))
+        rs = self.data_mart_access.engine.execute(text("""SELECT visit_id
+        FROM internal_pending_visit WHERE admit_datetime >= :since OR
+        facility = ANY(:facilities) OR patient_class = ANY(:classes)
+        ORDER BY admit_datetime DESC NULLS LAST"""),
+            since=datetime.now() - timedelta(days=days),
+            facilities=listed('priority_facilities'),
+            classes=listed('priority_patient_classes'))
+        return [r[0] for r in rs]
+
+    def _reap(self):
+        """Wait briefly on the workers, supervising them
+
+        returns the visits reported done meanwhile
+
+        """
+        done = []
+        try:
+            done.append(self.done_queue.get(
+                timeout=self.SUPERVISE_SECONDS))
+            while True:
+                done.append(self.done_queue.get_nowait())
+        except Empty:
+            pass
+        except (IOError, OSError), e:
+            # interrupted by a signal
+            if e.errno != errno.EINTR:
+                raise
+        self._supervise()
+        self._check_load()
+        return done
+
+    def _feed_limit(self):
+        """Most visits to have in flight, as the throttle allows
+
+        At full speed, FEED_AHEAD visits per worker.  Throttled, no
+        more visits than the throttle's level, leaving the remaining
+        workers idle - none at all when paused.
+
+        """
+        if self._throttle and self._throttle.throttled:
+            return self._throttle.level
+        return self.FEED_AHEAD * self.NUM_PROCS
+
+    def _check_load(self):
+        """Update the throttle, every THROTTLE_SECONDS
+
+        Signals are the worst of the mart and warehouse, along with
+        the workers' commit latency.
+
+        """
+        now = time.time()
+        if not self._throttle or now - self._load_sampled < \
+                self.THROTTLE_SECONDS:
+            return
+        signals = database_load(self.data_mart_access.engine)
+        for signal_name, value in database_load(
+                self.data_warehouse_access.engine).items():
+            signals[signal_name] = max(signals[signal_name], value)
+        latency = None
+        for worker, slot in self._workers:
+            latency = max(latency,
+                          slot.commit_latency(since=self._load_sampled))
+        signals['commit_latency'] = latency
+        self._load_sampled = now
+        self._throttle.update(signals)
+
+    def _keep_connected(self):
+        """Does dispatch need the manager's database connections"""
+        return bool(self.priority_workers or self._throttle)
+
+    def _wait_workers(self):
+        """Wait on the workers to exit, supervising meanwhile"""
+        while any(worker.is_alive() for worker, slot in self._workers):
+            if self._stopping:
+                self.stop.set()
+            time.sleep(self.SUPERVISE_SECONDS)
+            self._supervise()
+
+    def _stop_workers(self):
+        """Have idle workers exit, killing any that won't"""
+        self.stop.set()
+        if not self.distributed:
+            for worker in self._workers:
+                self.queue.put(None)
+        for worker, slot in self._workers:
+            worker.join(self.SUPERVISE_SECONDS)
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGKILL)
+                worker.join()
+        self._workers = []
+
+    def _handle_signal(self, signum, frame):
+        """Stop gracefully on SIGTERM or SIGINT
+
+        Visits in flight are finished, but no more dispatched.  The
+        workers ignore SIGINT, leaving the manager in charge.  Each
+        run mode stops its workers however it ends.
+
+        """
+        logging.warn("received signal %d, finishing visits in flight "
+                     "and stopping", signum)
+        self._stopping = True
+
+    def _checkpoint_target(self):
+        """Identifies the run a checkpoint belongs to"""
+        return self.reportDate and str(self.reportDate) or \
+            'whole database'
+
+    def _save_checkpoint(self, visit_ids):
+        """Persist the visits yet to be dispatched, for `_load_checkpoint`
+
+        Processed visits leave internal_pending_visit, so the
+        checkpoint need only save the expense of discovering those
+        remaining.
+
+        """
+        with open(self.checkpoint_file, 'w') as checkpoint:
+            json.dump({'target': self._checkpoint_target(),
+                       'visits': visit_ids}, checkpoint)
+        logging.info("checkpointed %d visits yet to process in %s",
+                     len(visit_ids), self.checkpoint_file)
+
+    def _load_checkpoint(self):
+        """Returns the visits checkpointed by an interrupted run
+
+        Only a checkpoint for the same target (whole database or
+        date) is used, and consumed.  Returns None if there's nothing
+        to resume.
+
+        """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file) as checkpoint:
+            saved = json.load(checkpoint)
+        if saved.get('target') != self._checkpoint_target():
+            logging.warn("ignoring checkpoint for %s", saved.get('target'))
+            return None
+        os.remove(self.checkpoint_file)
+        logging.info("resuming %d checkpointed visits",
+                     len(saved['visits']))
+        return saved['visits']
+
+    def _run_once(self):
+        """Single pass, as run from cron
+
+        A run stopped by signal checkpoints the visits it didn't get
+        to (see `_save_checkpoint`), which the next run resumes
+        without rediscovering, and leaves the date unchanged.
+
+        """
+        startTime = time.time()
+        self._prep()
+        if self.distributed:
+            pending = self.data_mart_access.engine.execute(
+                "SELECT count(*) FROM internal_pending_visit").scalar()
+            logging.info("Launch distributed deduplication, %d "
+                         "visits pending", pending)
+        else:
+            visits_to_process = self._load_checkpoint()
+            if visits_to_process is None:
+                visits_to_process = self._visitsToProcess()
+
+        # Now done with db access needs at the manager level
+        # free up resources (unless needed while dispatching):
+        if not self._keep_connected():
+            self._disconnect()
+
+        try:
+            if self.distributed:
+                # Workers claim until the pending queue is exhausted
+                self._launch_workers()
+                self._wait_workers()
+
+            # If we have visits to process, fire up the workers...
+            elif len(visits_to_process) > 1:
+                self._launch_workers()
+
+                # Feed the queue until done (or stopped)
+                undispatched = self._dispatch(visits_to_process)
+                self._stop_workers()
+                if self._stopping:
+                    self._save_checkpoint(undispatched)
+        finally:
+            self._stop_workers()
+
+        # Common cleanup
+        if self._keep_connected():
+            self._disconnect()
+        self.tearDown()
+        if self._stopping:
+            logging.info("Stopped after %s", time.time() - startTime)
+            return
+        self.datePersistence.bump_date()
+        logging.info("Queue is empty - done in %s", time.time() -
+                     startTime)
+
+    def _range_target(self):
+        """Identifies the range a progress file belongs to"""
+        return '%s..%s' % (self.range_start, self.range_end)
+
+    def _load_progress(self):
+        """Returns the days of this range finished by earlier runs"""
+        if not os.path.exists(self.progress_file):
+            return set()
+        with open(self.progress_file) as progress:
+            saved = json.load(progress)
+        if saved.get('target') != self._range_target():
+            logging.warn("ignoring progress for range %s",
+                         saved.get('target'))
+            return set()
+        return set(saved['days'])
+
+    def _save_progress(self, days):
+        """Persist the finished days of this range"""
+        with open(self.progress_file, 'w') as progress:
+            json.dump({'target': self._range_target(),
+                       'days': sorted(days)}, progress)
+
+    def _run_range(self):
+        """Backfill the admission days from range_start to range_end
+
+        Each day is a shard, with its own visit discovery (see
+        `_visitsToProcess`).  `active_shards` days are worked at once,
+        their visits fed in turn (see `ShardFeeder`) so each gets an
+        equal share of the workers.  Each day is logged as it
+        finishes, and recorded in the progress file (removed once the
+        range is done), so a run that is stopped or dies resumes with
+        the unfinished days.  A day is only recorded once none of its
+        visits remain pending - one with failing visits is left for
+        the next run.  Work
+        already done on those is gone from internal_pending_visit, so
+        isn't repeated.
+
+        The datefile is neither read nor bumped.
+
+        """
+        startTime = time.time()
+        self._prep()
+        finished = self._load_progress()
+        days = []
+        day = self.range_start
+        while day <= self.range_end:
+            if str(day) not in finished:
+                days.append(day)
+            day += timedelta(days=1)
+        total = len(days) + len(finished)
+        logging.info("Launch deduplication for %s, %d of %d days "
+                     "remaining", self._range_target(), len(days), total)
+
+        shardTimes = {}
+
+        shardVisits = {}
+        failed = set()
+
+        def discover(day):
+            shardTimes[day] = time.time()
+            shardVisits[day] = self._visitsToProcess(day)
+            return shardVisits[day]
+
+        feeder = ShardFeeder(days, discover, self.active_shards)
+        self._launch_workers()
+        try:
+            while True:
+                while not self._stopping and \
+                        len(self._in_flight) < self._feed_limit():
+                    visit_id = feeder.next()
+                    if visit_id is None:
+                        break
+                    self._in_flight.add(visit_id)
+                    self.queue.put(visit_id)
+                for day, count in feeder.finished():
+                    left = len(self._pendingCounts(shardVisits.pop(day)))
+                    if left:
+                        failed.add(str(day))
+                        logging.warn("%s has %d of %d visits still "
+                                     "pending, left for the next run",
+                                     day, left, count)
+                        shardTimes.pop(day)
+                        continue
+                    finished.add(str(day))
+                    self._save_progress(finished)
+                    logging.info("Finished %s, %d visits in %s (%d of "
+                                 "%d days done)", day, count,
+                                 time.time() - shardTimes.pop(day),
+                                 len(finished), total)
+                if not self._in_flight and (self._stopping or
+                                            feeder.exhausted):
+                    break
+                for visit_id in self._reap():
+                    self._in_flight.discard(visit_id)
+                    feeder.done(visit_id)
+        finally:
+            self._stop_workers()
+        self._disconnect()
+        self.tearDown()
+        if self._stopping:
+            logging.info("Stopped after %s, %d days unfinished",
+                         time.time() - startTime, total - len(finished))
+            return
+        if failed:
+            logging.warn("Range done in %s, but for %d days with visits "
+                         "still pending: %s", time.time() - startTime,
+                         len(failed), ', '.join(sorted(failed)))
+            return
+        if os.path.exists(self.progress_file):
+            os.remove(self.progress_file)
+        logging.info("Range done in %s", time.time() - startTime)
+
+    def _notifiedVisits(self, notified):
+        """Returns those notified visit_ids needing attention"""
+        if not notified:
+            return []
+        query = self.data_mart_access.session.query(
+            PendingVisit.visit_id).\
+            filter(PendingVisit.visit_id.in_(list(notified))).\
+            order_by(PendingVisit.oldest_message)
+        visit_ids = [r[0] for r in query]
+        self.data_mart_access.session.commit()
+        return visit_ids
+
+    def _pendingCounts(self, visit_ids=None):
+        """Returns (visit_id, pending_count) for visits needing attention
+
+        :param visit_ids: limit to these visits, all if None
+
+        """
+        query = self.data_mart_access.session.query(
+            PendingVisit.visit_id, PendingVisit.pending_count)
+        if visit_ids is not None:
+            if not visit_ids:
+                return []
+            query = query.filter(PendingVisit.visit_id.in_(
+                list(visit_ids)))
+        results = query.order_by(PendingVisit.oldest_message).all()
+        self.data_mart_access.session.commit()
+        return results
+
+    def _coalesce(self, scheduler, visit_ids, now):
+        """Observe the visits needing attention, return those ready
+
+        The pending count serves as the scheduler's marker, changing
+        as new messages arrive for a visit.  Held visits observed no
+        longer pending were finished by other means (bulk backfill, a
+        rebuild or a distributed peer), and are forgotten.
+
+        :param scheduler: the `CoalescingScheduler` holding visits
+        :param visit_ids: visits to observe, all if None
+
+        """
+        pending = set()
+        for visit_id, pending_count in self._pendingCounts(visit_ids):
+            scheduler.observe(visit_id, pending_count, now)
+            pending.add(visit_id)
+        observed = scheduler if visit_ids is None else \
+            [visit_id for visit_id in visit_ids if visit_id in scheduler]
+        for visit_id in observed:
+            if visit_id not in pending:
+                scheduler.forget(visit_id)
+        return scheduler.ready(time.time())
+
+    def _reconnect(self, listener):
+        """Replace the manager's connections after a failed cycle
+
+        returns the new listener, if listening
+
+        """
+        for close in (listener and listener.close, self._disconnect):
+            try:
+                if close:
+                    close()
+            except Exception:
+                logging.exception("ignoring failure to disconnect")
+        self._connect()
+        if listener:
+            listener = VisitListener(self.data_warehouse_access.engine,
+                                     self.listen_channel)
+        return listener
+
+    def _run_daemon(self):
+        """Run indefinitely, polling for new messages
+
+        The workers are launched once, and like the manager, keep
+        their connections open between polls.  Every `daemon_interval`
+        seconds new messages are picked up from the warehouse, and the
+        visits needing attention are queued for the waiting workers.
+        Distributed workers claim from the data mart on their own,
+        idling between claims when there's nothing to do.
+
+        When listening, the wait between polls ends as soon as the
+        warehouse notifies of new visits (after a short debounce), and
+        only the notified visits are queued.  All visits needing
+        attention are still discovered every FULL_DISCOVERY_SECONDS,
+        catching any notifications missed.
+
+        With a `quiet` period, visits are held back by a
+        `CoalescingScheduler` until their messages stop arriving, so
+        a busy visit is merged once rather than on every poll.
+
+        With `essence_flat`, the table is caught up every cycle (see
+        `_refresh_essence_flat`).
+
+        A cycle failing, i.e. on losing a database connection, is
+        logged and the next one tried after backing off (see
+        BACKOFF_SECONDS), with fresh connections.  Only a signal ends
+        the daemon.
+
+        """
+        logging.info("Launch deduplication daemon, polling every %d "
+                     "seconds", self.daemon_interval)
+        listener = None
+        if self.listen_channel and self.connections.pgbouncer:
+            logging.warn("can't LISTEN through a transaction pooler, "
+                         "polling only")
+        elif self.listen_channel:
+            listener = VisitListener(self.data_warehouse_access.engine,
+                                     self.listen_channel)
+        scheduler = None
+        if self.quiet:
+            scheduler = CoalescingScheduler(
+                self.quiet, self.max_delay or 4 * self.quiet)
+        self._launch_workers()
+        notified, last_discovery, failures = set(), 0, 0
+        try:
+            while not self._stopping:
+                startTime = time.time()
+                try:
+                    if failures:
+                        listener = self._reconnect(listener)
+                    self._supervise()
+                    self._prep()
+                    if not self.distributed:
+                        full = not listener or startTime - \
+                            last_discovery >= self.FULL_DISCOVERY_SECONDS
+                        if full:
+                            last_discovery = startTime
+                        if scheduler:
+                            visits_to_process = self._coalesce(
+                                scheduler, None if full else notified,
+                                startTime)
+                        elif full:
+                            visits_to_process = self._visitsToProcess()
+                        else:
+                            visits_to_process = self._notifiedVisits(
+                                notified)
+                        # Undispatched visits remain pending, for the
+                        # next run to discover
+                        self._dispatch(visits_to_process)
+                        if visits_to_process:
+                            logging.info("Deduplicated %d visits in %s",
+                                         len(visits_to_process),
+                                         time.time() - startTime)
+                    if self.essence_flat and not self._stopping:
+                        self._refresh_essence_flat()
+                    failures = 0
+                    remaining = max(0, self.daemon_interval -
+                                    (time.time() - startTime))
+                    if listener:
+                        notified = listener.wait(remaining)
+                    else:
+                        time.sleep(remaining)
+                except Exception:
+                    failures += 1
+                    backoff = min(self.MAX_BACKOFF_SECONDS,
+                                  self.BACKOFF_SECONDS *
+                                  2 ** (failures - 1))
+                    logging.exception("daemon cycle failed (%d in a "
+                                      "row), retrying in %d seconds",
+                                      failures, backoff)
+                    # Notifications may have been lost meanwhile
+                    notified, last_discovery = set(), 0
+                    if not self._stopping:
+                        time.sleep(backoff)
+        finally:
+            if listener:
+                listener.close()
+            self._stop_workers()
+
     def execute(self):
         """ Start the process """
         # Initialize logging now (verbosity is now set regardless of
@@ -235,7 +1269,8 @@ class LongitudinalManager(object):
                           logfile="longitudinal-manager.log")
 
         logging.info("Initiate deduplication for %s",
-                         (self.reportDate and self.reportDate or
+                         (self.range_start and self._range_target() or
+                          self.reportDate and self.reportDate or
                           "whole database"))
         # Only allow one instance of the manager to run at a time.
         if self.lock.is_locked():
@@ -243,90 +1278,35 @@ class LongitudinalManager(object):
             return
 
         if systemUnderLoad():
-            logging.warn("system under load - continue anyhow")
+            logging.warn("system under load - %s",
+                         self.throttle_load and "throttling as needed" or
+                         "continue anyhow")
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._handle_signal)
 
         try:
             self.lock.acquire()
+            self._connect()
+            self._fit_workers()
+            if self.throttle_load:
+                # Ceiling of the workers fitted, not those requested
+                self._throttle = Throttle(self.NUM_PROCS,
+                                          configured_thresholds())
 
-            self.access = DirectAccess(database=self.data_warehouse,
-                                       port=self.warehouse_port,
-                                       user=self.database_user,
-                                       password=self.database_password)
-            self.data_warehouse_access = AlchemyAccess(
-                database=self.data_warehouse,
-                port=self.warehouse_port,
-                user=self.database_user, password=self.database_password)
-            self.data_mart_access = AlchemyAccess(
-                database=self.data_mart, port=self.mart_port,
-                user=self.database_user, password=self.database_password)
-
-            startTime = time.time()
-            if not self.skip_prep:
-                self._prepDeduplicateTables()
-            visits_to_process = self._visitsToProcess()
-
-            # Now done with db access needs at the manager level
-            # free up resources:
-            self.data_mart_access.disconnect()
-            self.data_warehouse_access.disconnect()
-            self.access.close()
-
-            # Set of locks used, one for each table needing protection
-            # from asynchronous inserts.  Names should match table
-            # minus 'dim_' prefix, plus '_lock' suffix
-            # i.e. dim_location -> 'location_lock'
-            table_locks = {'admission_source_lock': Lock(),
-                           'admission_o2sat_lock': Lock(),
-                           'admission_temp_lock': Lock(),
-                           'assigned_location_lock': Lock(),
-                           'admit_reason_lock': Lock(),
-                           'chief_complaint_lock': Lock(),
-                           'diagnosis_lock': Lock(),
-                           'disposition_lock': Lock(),
-                           'flu_vaccine_lock': Lock(),
-                           'h1n1_vaccine_lock': Lock(),
-                           'lab_flag_lock': Lock(),
-                           'lab_result_lock': Lock(),
-                           'location_lock': Lock(),
-                           'note_lock': Lock(),
-                           'order_number_lock': Lock(),
-                           'performing_lab_lock': Lock(),
-                           'pregnancy_lock': Lock(),
-                           'race_lock': Lock(),
-                           'reference_range_lock': Lock(),
-                           'service_area_lock': Lock(),
-                           'specimen_source_lock': Lock(),
-                           }
+            if self.rebuild_pending:
+                rebuild_pending_visits(self.data_mart_access.engine)
 
-            # If we have visits to process, fire up the workers...
-            if len(visits_to_process) > 1:
-                for i in range(self.NUM_PROCS):
-                    dw = Process(target=LongitudinalWorker,
-                                 kwargs={'queue': self.queue,
-                                         'procNumber': i,
-                                         'data_warehouse': self.data_warehouse,
-                                         'warehouse_port': self.warehouse_port,
-                                         'data_mart': self.data_mart,
-                                         'mart_port': self.mart_port,
-                                         'dbUser': self.database_user,
-                                         'dbPass': self.database_password,
-                                         'table_locks': table_locks,
-                                         'verbosity': self.verbosity})
-                    dw.daemon = True
-                    dw.start()
-
-                # Populate the queue
-                for v in visits_to_process:
-                    self.queue.put(v)
-
-                # Wait on the queue until empty
-                self.queue.join()
-
-            # Common cleanup
-            self.tearDown()
-            self.datePersistence.bump_date()
-            logging.info("Queue is empty - done in %s", time.time() -
-                         startTime)
+            if self.daemon_interval:
+                self._run_daemon()
+            elif self.range_start:
+                self._run_range()
+            else:
+                self._run_once()
+            if self.essence_flat and not self._stopping and \
+                    not self.daemon_interval:
+                self._refresh_essence_flat()
+                self.data_mart_access.engine.dispose()
         finally:
             self.lock.release()
 
@@ -1,11 +1,16 @@
 from datetime import datetime
 import logging
-from time import time
+from multiprocessing import Array, Value
+import signal
+from time import sleep, time
 
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError, OperationalError
-from sqlalchemy.sql import and_, or_
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.sql import and_, or_, text
 
-from .select_or_insert import SelectOrInsert
+from .connections import ConnectionFactory
+from .select_or_insert import AdvisoryLock, SelectOrInsert, TABLE_LOCKS
 from .stripXML import strip as stripXML
 from .tables import AdmissionSource, SpecimenSource
 from .tables import PerformingLab, LabFlag
@@ -18,7 +23,10 @@ from .tables import LabResult, Location, Visit
 from .tables import MessageProcessed, ServiceArea
 from .tables import Disposition, VisitLabAssociation
 from .tables import Diagnosis, VisitDiagnosisAssociation
-from pheme.util.pg_access import AlchemyAccess
+from .tables import assoc_visit_dx, assoc_visit_lab, fact_visit
+from .tables import refresh_essence_flat
+from .visit_claims import VisitClaims
+from pheme.util.config import Config
 from pheme.warehouse.tables import ObservationData, HL7_Nte, FullMessage
 from pheme.util.util import getDobDatetime, getYearDiff, inProduction
 from pheme.util.util import none_safe_min as min
@@ -1153,6 +1161,66 @@ def _preferred_lab_flag(obx):
     return LabFlag(code=code, code_text=text, coding=coding)
 
 
+class WorkerSlot(object):
+    """Shared record of the visit a worker is busy with
+
+    Created by the manager for each worker it launches, so the
+    manager can tell which visit a worker was processing should it
+    die or exceed the time allowed.
+
+    The worker also records how long its commits take, for the
+    manager's throttle.
+
+    """
+    MAX_VISIT_ID = 255
+
+    # Weight of the latest commit in the commit_latency average
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self):
+        self._visit_id = Array('c', self.MAX_VISIT_ID + 1)
+        self._started = Value('d', 0)
+        self._commit_latency = Value('d', 0, lock=False)
+        self._committed = Value('d', 0, lock=False)
+
+    def start(self, visit_id):
+        """Record the visit being started, and when"""
+        if isinstance(visit_id, unicode):
+            visit_id = visit_id.encode('utf-8')
+        self._started.value = time()
+        self._visit_id.value = visit_id[:self.MAX_VISIT_ID]
+
+    def finish(self):
+        """Clear the record, once the visit is done with"""
+        self._visit_id.value = ''
+        self._started.value = 0
+
+    @property
+    def visit_id(self):
+        """The visit being processed, None if idle"""
+        return self._visit_id.value or None
+
+    @property
+    def started(self):
+        """time() the visit being processed was started"""
+        return self._started.value
+
+    def record_commit(self, seconds):
+        """Fold the duration of a commit into the commit_latency"""
+        latency = self._commit_latency.value
+        if latency:
+            seconds = (self.LATENCY_WEIGHT * seconds +
+                       (1 - self.LATENCY_WEIGHT) * latency)
+        self._commit_latency.value = seconds
+        self._committed.value = time()
+
+    def commit_latency(self, since):
+        """Average commit seconds, None if nothing committed since"""
+        if self._committed.value < since:
+            return None
+        return self._commit_latency.value
+
+
 class LongitudinalWorker(object):
     """ Deduplicate a visit.
 
@@ -1165,40 +1233,182 @@ class LongitudinalWorker(object):
     database connection, so time spent waiting on the db gives the
     other processes time to execute.
 
+    In `distributed` mode, visits are claimed directly from the data
+    mart (see `VisitClaims`) and table locks are postgres advisory
+    locks, so workers launched by managers on different hosts may
+    share the load.
+
+    Connections come from a per process `ConnectionFactory` pool.
+    Behind a transaction pooler (its `pgbouncer` mode) distributed
+    workers use transaction scoped `advisory_locks`, as session level
+    table locks would be lost.
+
+    With `advisory_locks`, table locks are replaced by transaction
+    scoped advisory locks on the values being inserted, so workers
+    only contend when inserting the very same dimension row.
+
+    Each table's `SelectOrInsert` caches up to DIMENSION_CACHE_SIZE
+    primary keys, backed by the optional `shared_cache` common to all
+    workers launched by the manager.
+
+    With `preload`, the caches are warmed at startup (see PRELOAD).
+
+    The visit in progress is recorded in the `slot` (see
+    `WorkerSlot`) if given, for the manager's supervision.
+
+    A `persistent` worker (see the manager's daemon mode) keeps its
+    connections open and waits for more work once the queue empties,
+    polling every IDLE_SECONDS when claiming from the data mart.
+
+    Shutdown is left to the manager, the worker ignores the SIGINT
+    of a terminal's Ctrl-C.  SIGTERM still ends the worker, should
+    the manager exit without stopping it.  Queued workers exit on a
+    None visit_id, claiming workers once the `stop` event is set.
+    Each visit handled is reported on the `done_queue` if given.
+
+    With `essence_flat`, each visit's essence_flat rows are refreshed
+    once it's processed (see `tables.refresh_essence_flat`).
+
     """
+    DIMENSION_CACHE_SIZE = 5000
+    IDLE_SECONDS = 5
+
+    # Dimension caches warmed by `preload`, keyed by lock name:
+    # (class, referencing column, default row limit).  A limit of None
+    # loads the whole table, otherwise the most referenced rows are
+    # loaded.  Override the limit with `preload_<table>` in the
+    # [longitudinal] config section, i.e. `preload_dim_cc = 2000`,
+    # 'all' or 0 to skip.
+    PRELOAD = {
+        'admission_source_lock': (AdmissionSource, None, None),
+        'admission_o2sat_lock': (AdmissionO2sat, None, None),
+        'admission_temp_lock': (AdmissionTemp, None, None),
+        'disposition_lock': (Disposition, None, None),
+        'flu_vaccine_lock': (FluVaccine, None, None),
+        'h1n1_vaccine_lock': (H1N1Vaccine, None, None),
+        'pregnancy_lock': (Pregnancy, None, None),
+        'race_lock': (Race, None, None),
+        'service_area_lock': (ServiceArea, None, None),
+        'chief_complaint_lock': (ChiefComplaint,
+                                 fact_visit.c.dim_cc_pk, 1000),
+        'location_lock': (Location, fact_visit.c.dim_location_pk, 1000),
+        'diagnosis_lock': (Diagnosis, assoc_visit_dx.c.dim_dx_pk, 1000),
+        'lab_result_lock': (LabResult,
+                            assoc_visit_lab.c.dim_lab_result_pk, 1000),
+    }
 
     def __init__(self, queue, procNumber, data_warehouse, data_mart,
                  table_locks={}, dbHost='localhost', dbUser=None,
                  dbPass=None, mart_port=5432, warehouse_port=5432,
-                 verbosity=0):
-        self.data_warehouse = AlchemyAccess(database=data_warehouse,
-                                            port=warehouse_port,
-                                            host=dbHost, user=dbUser,
-                                            password=dbPass)
-        self.data_mart = AlchemyAccess(database=data_mart,
-                                       host=dbHost, port=mart_port,
-                                       user=dbUser, password=dbPass)
+                 verbosity=0, distributed=False, advisory_locks=False,
+                 shared_cache=None, preload=False, persistent=False,
+                 slot=None, done_queue=None, stop=None,
+                 essence_flat=False):
+        connections = ConnectionFactory(user=dbUser, password=dbPass,
+                                        host=dbHost)
+        self.data_warehouse = connections.access(data_warehouse,
+                                                 warehouse_port)
+        self.data_mart = connections.access(data_mart, mart_port)
         self.queue = queue
         self.name = 'worker-%d' % procNumber
         self.verbosity = verbosity
+        self.persistent = persistent
+        self.slot = slot
+        self.done_queue = done_queue
+        self.stop = stop
+        self.distributed = distributed
+        self.essence_flat = essence_flat
+        self._lock_connection = None
+
+        if distributed:
+            self.queue = VisitClaims(self.data_mart.engine)
+            self.name = '%s-%d' % (self.queue.owner, procNumber)
+
+        if distributed and connections.pgbouncer:
+            # Session level locks don't survive a transaction pooler
+            advisory_locks = True
+        if advisory_locks:
+            table_locks = dict.fromkeys(TABLE_LOCKS)
+        elif distributed:
+            self._lock_connection = connections.dedicated(data_mart,
+                                                          mart_port)
+            table_locks = dict([(table,
+                                 AdvisoryLock(self._lock_connection, table))
+                                for table in TABLE_LOCKS])
 
         # Instantiate a SelectOrInsert tool for each provided lock,
         # named for the table it's protecting.
         # See `longitudinal_manager` for nomenclature
         for table, lock in table_locks.items():
             setattr(self, table,
-                    SelectOrInsert(lock, self.data_mart.session))
+                    SelectOrInsert(lock, self.data_mart.session,
+                                   advisory_locks=advisory_locks,
+                                   cache_size=self.DIMENSION_CACHE_SIZE,
+                                   shared_cache=shared_cache,
+                                   lock_name=table))
+
+        # With a shared cache, one worker's preload serves all
+        if preload and (shared_cache is None or procNumber == 0):
+            self._preload_caches()
 
         if self.queue:
             logging.info("%s: launching", self.name)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
             self.run()
 
+    def _preload_limit(self, table, default):
+        """Configured preload row limit for table, None for all"""
+        limit = Config().get('longitudinal', 'preload_%s' % table,
+                             default=default)
+        if limit is None or str(limit).lower() == 'all':
+            return None
+        return int(limit)
+
+    def _preload_caches(self):
+        """Warm the SelectOrInsert caches from the data mart"""
+        session = self.data_mart.session
+        for lock_name, (cls, referenced_by, default) in \
+                self.PRELOAD.items():
+            s_or_i = getattr(self, lock_name, None)
+            if s_or_i is None:
+                continue
+            table = class_mapper(cls).local_table.name
+            limit = self._preload_limit(table, default)
+            if limit == 0:
+                continue
+            query = session.query(cls)
+            if limit is not None and referenced_by is not None:
+                pk = class_mapper(cls).primary_key[0]
+                top = select([referenced_by]).\
+                    where(referenced_by != None).\
+                    group_by(referenced_by).\
+                    order_by(func.count().desc()).limit(limit)
+                query = query.filter(pk.in_(top))
+            elif limit is not None:
+                query = query.limit(limit)
+            count = s_or_i.preload(query)
+            logging.debug("%s: preloaded %d rows from %s", self.name,
+                          count, table)
+        session.commit()
+
     def run(self):
         while True:
+            if self.stop is not None and self.stop.is_set():
+                self.tearDown()
+                return
             startTime = time()
 
             # Grab an available visit_id off the queue
             visit_id = self.queue.get()
+            if visit_id is None:
+                # Nothing more to claim, or told to exit
+                if self.persistent and self.distributed:
+                    sleep(self.IDLE_SECONDS)
+                    continue
+                self.tearDown()
+                return
+            if self.slot:
+                self.slot.start(visit_id)
             try:
                 self.dedupVisit(visit_id)
 
@@ -1245,10 +1455,10 @@ class LongitudinalWorker(object):
                 # it'll continue to get picked up next run till the
                 # error is addressed.
                 self.queue.task_done()
-
-                # Clean up if we appear to be done.
-                if self.queue.empty():
-                    self.tearDown()
+                if self.done_queue is not None:
+                    self.done_queue.put(visit_id)
+                if self.slot:
+                    self.slot.finish()
 
     def tearDown(self):
         """tearDown this worker, free resources peacefully
@@ -1257,6 +1467,8 @@ class LongitudinalWorker(object):
         open connections can be peacefully shutdown.
 
         """
+        if self._lock_connection is not None:
+            self._lock_connection.close()
         self.data_warehouse.disconnect()
         self.data_mart.disconnect()
         logging.info("%s: tearing down", self.name)
@@ -1486,6 +1698,7 @@ class LongitudinalWorker(object):
                               MessageProcessed.processed_datetime ==
                               None)).all()
         msg_ids = [id[0] for id in ids]
+        self._merged_msg_ids = msg_ids
 
         sq = self.data_warehouse.session.query
         return sq(FullMessage).\
@@ -1553,6 +1766,58 @@ class LongitudinalWorker(object):
         assert not self._get_surrogate(patient_class)
         self._surrogates[patient_class] = SurrogateVisit(self, visit)
 
+    def _mark_processed(self, visit_id):
+        """Mark the merged messages processed, dequeue the visit
+
+        Sets processed_datetime on the internal_message_processed rows
+        merged by this pass (see `_query_messages_to_merge`) and
+        removes the visit from the internal_pending_visit work queue,
+        in a single transaction.
+
+        Messages may arrive for the visit while it's being merged,
+        i.e. from a manager on another host.  Those are left
+        unprocessed, and the visit stays queued (though unclaimed) for
+        another pass.
+
+        :param visit_id: the visit_id just deduplicated
+
+        """
+        connection = self.data_mart.engine.connect()
+        transaction = connection.begin()
+        try:
+            if self._merged_msg_ids:
+                connection.execute(text("""UPDATE
+                internal_message_processed SET processed_datetime = :now
+                WHERE hl7_msh_id = ANY(:msg_ids)"""), now=datetime.now(),
+                                   msg_ids=self._merged_msg_ids)
+            # Lock the queue row, waiting on any concurrent prep to
+            # commit, so the count below sees its messages.
+            connection.execute(text("""SELECT visit_id FROM
+            internal_pending_visit WHERE visit_id = :visit_id FOR
+            UPDATE"""), visit_id=visit_id)
+            remaining = connection.execute(text("""SELECT count(*) FROM
+            internal_message_processed WHERE processed_datetime IS NULL
+            AND visit_id = :visit_id"""), visit_id=visit_id).scalar()
+            if remaining:
+                connection.execute(text("""UPDATE internal_pending_visit
+                SET pending_count = :remaining, claimed_by = NULL,
+                lease_expires = NULL, attempts = 0
+                WHERE visit_id = :visit_id"""),
+                                   remaining=remaining, visit_id=visit_id)
+            else:
+                connection.execute(text("""DELETE FROM
+                internal_pending_visit WHERE visit_id = :visit_id"""),
+                                   visit_id=visit_id)
+            commitTime = time()
+            transaction.commit()
+            if self.slot:
+                self.slot.record_commit(time() - commitTime)
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+
     def dedupVisit(self, visit_id):
         """ Process a single visit_id - grab all associated data and
         merge any new info into the visit_state table.
@@ -1705,10 +1970,7 @@ class LongitudinalWorker(object):
                              "required admit_datetime field",
                              visit_id, pc)
                 # Have to mark it, or we'll keep retrying every time.
-                update = """UPDATE internal_message_processed SET
-                processed_datetime = '%s' WHERE processed_datetime IS
-                NULL AND visit_id  = '%s' """ % (datetime.now(), visit_id)
-                self.data_mart.engine.execute(update)
+                self._mark_processed(visit_id)
                 return
             else:
                 if sv.visit.pk is None:
@@ -1753,6 +2015,6 @@ class LongitudinalWorker(object):
             self._commit_visit(sv.visit, related_changes)
 
         # Mark those rows as processed
-        self.data_mart.engine.execute("""UPDATE internal_message_processed SET
-        processed_datetime = '%s' WHERE processed_datetime IS NULL AND visit_id
-        = '%s' """ % (datetime.now(), visit_id))
+        self._mark_processed(visit_id)
+        if self.essence_flat:
+            refresh_essence_flat(self.data_mart.engine, visit_id=visit_id)
@@ -0,0 +1,137 @@
+"""Postgres LISTEN/NOTIFY support for near real time deduplication
+
+A trigger installed in the data warehouse sends a notification
+carrying the visit_id as each hl7_visit row is added.  The
+`VisitListener` collects these for the longitudinal manager, so
+freshly arrived visits may be deduplicated within moments rather than
+waiting on the next poll or cron run.
+
+Notifications are a latency optimization only - they're lost while
+nobody is listening, so the manager still falls back to a periodic
+full discovery.
+
+"""
+import errno
+import logging
+from optparse import OptionParser
+import select
+import time
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import create_engine, text
+
+from pheme.util.config import Config
+
+CHANNEL = 'longitudinal_visit'
+
+
+def install_trigger(engine, channel=CHANNEL):
+    """Install (or replace) the notify trigger on hl7_visit
+
+    hl7_visit rather than hl7_msh, as the visit_id lives there.  The
+    notification is only delivered once the inserting transaction
+    commits.
+
+    :param engine: sqlalchemy engine for the data warehouse
+    :param channel: channel to notify
+
+    """
+    engine.execute(text("""BEGIN;
+        CREATE OR REPLACE FUNCTION longitudinal_notify_visit()
+        RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify(TG_ARGV[0], NEW.visit_id);
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS longitudinal_notify_visit ON hl7_visit;
+        CREATE TRIGGER longitudinal_notify_visit
+          AFTER INSERT ON hl7_visit FOR EACH ROW
+          EXECUTE PROCEDURE longitudinal_notify_visit('%s');
+        COMMIT;""" % channel))
+
+
+class VisitListener(object):
+    """LISTEN for visit_id notifications from the warehouse
+
+    Holds a dedicated autocommit connection for the lifetime of the
+    listener.  Notifications tend to arrive in bursts as a batch of
+    messages is loaded, so `wait` keeps collecting for a short
+    debounce window after the first arrives, returning a micro-batch.
+
+    """
+    DEBOUNCE_SECONDS = 2
+
+    def __init__(self, engine, channel=CHANNEL,
+                 debounce=DEBOUNCE_SECONDS):
+        """Start listening
+
+        :param engine: sqlalchemy engine for the data warehouse
+        :param channel: channel to LISTEN on
+        :param debounce: seconds to keep collecting after the first
+          notification
+
+        """
+        self.channel = channel
+        self.debounce = debounce
+        self._raw = engine.raw_connection()
+        self._conn = self._raw.connection
+        self._conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self._conn.cursor()
+        cursor.execute('LISTEN "%s"' % channel)
+        cursor.close()
+        logging.info("listening on channel '%s'", channel)
+
+    def _poll(self, timeout):
+        """Wait up to timeout seconds, returns payloads received"""
+        try:
+            ready = select.select([self._conn], [], [], timeout)
+        except select.error, e:
+            # interrupted by a signal, i.e. the manager stopping
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        if ready != ([], [], []):
+            self._conn.poll()
+        payloads = [n.payload for n in self._conn.notifies]
+        del self._conn.notifies[:]
+        return payloads
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for notifications
+
+        returns the set of visit_ids notified, empty on timeout
+
+        """
+        visit_ids = set(self._poll(timeout))
+        if visit_ids:
+            end = time.time() + self.debounce
+            remaining = self.debounce
+            while remaining > 0:
+                visit_ids.update(self._poll(remaining))
+                remaining = end - time.time()
+        return visit_ids
+
+    def close(self):
+        self._raw.close()
+
+
+def install():  # pragma: no cover
+    """Entry point to install the notify trigger in the warehouse"""
+    parser = OptionParser(usage="%prog [options] data_warehouse")
+    parser.add_option("-c", "--channel", dest="channel", default=CHANNEL,
+                      help="channel to notify (default %s)" % CHANNEL)
+    parser.add_option("-w", "--warehouse-port", dest="warehouse_port",
+                      default=5432, type="int",
+                      help="alternate port number for data warehouse")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("incorrect number of arguments")
+
+    config = Config()
+    user = config.get('longitudinal', 'database_user')
+    password = config.get('longitudinal', 'database_password')
+    engine = create_engine("postgresql://%s:%s@localhost:%d/%s" %
+                           (user, password, options.warehouse_port,
+                            args[0]))
+    install_trigger(engine, options.channel)
@@ -0,0 +1,129 @@
+"""Streaming difference of two reports
+
+ESSENCE only needs the rows that are new or changed since the like
+report it last received.  A `ReportDiff` compares today's report with
+yesterday's, in bounded memory however large the reports - both are
+first split by a hash of each row's visit key into partition files
+small enough to compare in memory, one partition at a time.
+
+"""
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+
+
+def open_report(filename):
+    """Open a report file for reading, gzipped if named .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+class ReportDiff(object):
+    """New and changed rows of a report, compared to an older one
+
+    Rows are keyed by the `key_columns`, i.e. the visit_id and
+    patient_class.  A row of the new report is included if the old
+    report has no row with its key, or one that differs.  Rows gone
+    from the new report are of no interest.  The first line of each
+    file is its header, as are those of each part of a split report.
+
+    Rows are written grouped by partition, not in report order.
+
+    """
+    DELIMITER = '|'
+    # Uncompressed bytes of the old report per partition, bounding
+    # the memory used to compare each
+    PARTITION_BYTES = 32 << 20
+    # Guess at the compression of gzipped reports, to size partitions
+    COMPRESSION_RATIO = 8
+
+    def __init__(self, old_files, new_files, key_columns, partitions=None,
+                 tmp_dir=None):
+        """Prepare the difference
+
+        :param old_files: the older report's file(s), in order
+        :param new_files: the newer report's file(s), in order
+        :param key_columns: indexes of the columns identifying a row
+        :param partitions: number of partitions, by default enough for
+          PARTITION_BYTES of the old report in each
+        :param tmp_dir: directory for the partition files
+
+        """
+        if not (old_files and new_files):
+            raise ValueError("old and new report files required")
+        self.old_files = old_files
+        self.new_files = new_files
+        self.key_columns = key_columns
+        if partitions is None:
+            size = sum(os.path.getsize(f) * (f.endswith('.gz') and
+                                             self.COMPRESSION_RATIO or 1)
+                       for f in old_files)
+            partitions = size // self.PARTITION_BYTES + 1
+        if partitions < 1:
+            raise ValueError("partitions must be positive")
+        self.partitions = partitions
+        self.tmp_dir = tmp_dir
+
+    def _key(self, line):
+        fields = line.rstrip('\r\n').split(self.DELIMITER)
+        return self.DELIMITER.join(fields[i] if i < len(fields) else ''
+                                   for i in self.key_columns)
+
+    def _partition(self, files, directory, name):
+        """Split the rows of files into partition files
+
+        returns the header, the first line of the first file
+
+        """
+        header = None
+        outputs = [open(os.path.join(directory, '%s-%d' % (name, i)),
+                        'wb') for i in xrange(self.partitions)]
+        try:
+            for filename in files:
+                report = open_report(filename)
+                try:
+                    first = report.readline()
+                    if header is None:
+                        header = first
+                    for line in report:
+                        key = self._key(line)
+                        outputs[(zlib.crc32(key) & 0xffffffff) %
+                                self.partitions].write(line)
+                finally:
+                    report.close()
+        finally:
+            for output in outputs:
+                output.close()
+        return header
+
+    def write(self, out):
+        """Write the header and the new or changed rows to out
+
+        returns the number of rows written
+
+        """
+        directory = tempfile.mkdtemp(prefix='report_diff', dir=self.tmp_dir)
+        try:
+            self._partition(self.old_files, directory, 'old')
+            header = self._partition(self.new_files, directory, 'new')
+            if header:
+                out.write(header)
+            written = 0
+            for i in xrange(self.partitions):
+                old = {}
+                with open(os.path.join(directory, 'old-%d' % i)) as rows:
+                    for line in rows:
+                        old[self._key(line)] = hashlib.md5(line).digest()
+                with open(os.path.join(directory, 'new-%d' % i)) as rows:
+                    for line in rows:
+                        if old.get(self._key(line)) != \
+                                hashlib.md5(line).digest():
+                            out.write(line)
+                            written += 1
+            return written
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,119 @@
+"""Streaming output of report files
+
+Reports were written as plain text, then reread by the transport to
+be zipped before upload.  A `ReportOutput` compresses as it writes,
+and can split a large report into parts of bounded size for
+downstream upload limits.
+
+"""
+import gzip
+import os
+
+
+class ReportOutput(object):
+    """Report file writer, optionally gzipped and split into parts
+
+    Stands in for the report's file object - written to a line or
+    chunk of lines at a time, then closed.  The first line written is
+    taken as the header.  Files are opened as first written to.
+
+    With `compress`, output is gzipped on the fly, '.gz' appended to
+    each file name.
+
+    With a `part_size`, output is split at line boundaries into parts
+    named `<root>-part001<ext>` and so on, each beginning with the
+    header.  A new part is started rather than let a part grow past
+    part_size bytes on disk, unless a single write is larger still.
+    Compressed parts may overrun slightly, by what the compressor
+    holds back.
+
+    """
+    COMPRESS_LEVEL = 6  # the gzip default of 9 costs more than it saves
+
+    def __init__(self, filepath, compress=False, part_size=None,
+                 buffer_size=-1):
+        """Prepare for output
+
+        :param filepath: path of the report file
+        :param compress: gzip the output
+        :param part_size: most bytes in each part, None not to split
+        :param buffer_size: buffer size for the file, as for `open`
+
+        """
+        if part_size is not None and part_size < 1:
+            raise ValueError("part_size must be positive")
+        self.filepath = filepath
+        self.compress = compress
+        self.part_size = part_size
+        self.buffer_size = buffer_size
+        self.names = []
+        self.closed = False
+        self._header = None
+        self._partial = ''
+        self._file = self._out = None
+
+    @property
+    def name(self):
+        """Name of the (first) file written"""
+        return self.part_name(1)
+
+    def part_name(self, number):
+        """Returns the name of the numbered part (from 1)"""
+        name = self.filepath
+        if self.part_size:
+            root, ext = os.path.splitext(name)
+            name = '%s-part%03d%s' % (root, number, ext)
+        if self.compress:
+            name += '.gz'
+        return name
+
+    def _open_part(self):
+        name = self.part_name(len(self.names) + 1)
+        self._file = open(name, 'wb', self.buffer_size)
+        self._out = self._file
+        if self.compress:
+            self._out = gzip.GzipFile(
+                filename=os.path.basename(name[:-len('.gz')]), mode='wb',
+                compresslevel=self.COMPRESS_LEVEL, fileobj=self._file)
+        self.names.append(name)
+        if self._header is not None:
+            self._out.write(self._header)
+        self._written = 0
+
+    def _close_part(self):
+        if self._out is not self._file:
+            self._out.close()
+        self._file.close()
+
+    def write(self, data):
+        if self._out is None:
+            self._open_part()
+        if not self.part_size:
+            self._out.write(data)
+            return
+
+        # Hold back any partial line, parts end on line boundaries
+        data = self._partial + data
+        end = data.rfind('\n') + 1
+        self._partial = data[end:]
+        if not end:
+            return
+        if self._header is None:
+            self._header = data[:data.index('\n') + 1]
+        elif self._written and \
+                self._file.tell() + end > self.part_size:
+            self._close_part()
+            self._open_part()
+        self._out.write(data[:end])
+        self._written += end
+
+    def close(self):
+        if self.closed:
+            return
+        if self._out is None:
+            self._open_part()
+        if self._partial:
+            self._out.write(self._partial)
+            self._partial = ''
+        self._close_part()
+        self.closed = True
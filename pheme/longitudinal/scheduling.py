@@ -0,0 +1,257 @@
+"""Scheduling of visits for deduplication
+
+Busy visits, such as an emergency department visit receiving a string
+of A08 updates, would otherwise be deduplicated again and again as
+each message trickles in.  The `CoalescingScheduler` holds such
+visits back until they go quiet, so all their messages are merged in
+a single pass.
+
+The `PriorityLanes` let urgent visits, such as today's, overtake a
+backlog.
+
+The `ShardFeeder` spreads a long backfill over several shards (i.e.
+admission days) at once, handing out their visits in turn.
+
+"""
+from collections import deque
+
+
+class CoalescingScheduler(object):
+    """Hold visits until quiet, or held too long
+
+    Visits are observed along with a marker, any value that changes
+    as new messages arrive for the visit (i.e. its pending count).  A
+    visit is ready once its marker hasn't changed for `quiet` seconds,
+    or once `max_delay` seconds have passed since it was first
+    observed, whichever comes first.  Ready visits are released once,
+    and forgotten - observing the visit again starts afresh.
+
+    Times are seconds, as from `time.time()`, and are passed in
+    rather than read, to simplify testing.
+
+    """
+    def __init__(self, quiet, max_delay):
+        """Initialize the scheduler
+
+        :param quiet: seconds without change before a visit is ready
+        :param max_delay: maximum seconds a visit is held
+
+        """
+        if max_delay < quiet:
+            raise ValueError("max_delay can't be less than quiet")
+        self.quiet = quiet
+        self.max_delay = max_delay
+        # visit_id: (marker, first observed, last changed)
+        self._held = {}
+
+    def __len__(self):
+        return len(self._held)
+
+    def __contains__(self, visit_id):
+        return visit_id in self._held
+
+    def __iter__(self):
+        """Iterate over (a copy of) the visits held"""
+        return iter(list(self._held))
+
+    def observe(self, visit_id, marker, now):
+        """Note the visit needs attention
+
+        :param visit_id: the visit needing attention
+        :param marker: value changing with new activity on the visit
+        :param now: the current time
+
+        """
+        if visit_id not in self._held:
+            self._held[visit_id] = (marker, now, now)
+            return
+        held_marker, first, changed = self._held[visit_id]
+        if marker != held_marker:
+            self._held[visit_id] = (marker, first, now)
+
+    def forget(self, visit_id):
+        """Drop a visit no longer needing attention"""
+        self._held.pop(visit_id, None)
+
+    def ready(self, now):
+        """Release the visits ready for deduplication
+
+        :param now: the current time
+
+        returns the ready visit_ids, those held longest first
+
+        """
+        ready = [(first, visit_id) for visit_id, (marker, first, changed)
+                 in self._held.items() if now - changed >= self.quiet or
+                 now - first >= self.max_delay]
+        ready.sort()
+        for first, visit_id in ready:
+            del self._held[visit_id]
+        return [visit_id for first, visit_id in ready]
+
+
+class PriorityLanes(object):
+    """Urgent and backlog lanes of visits yet to feed
+
+    Urgent visits are always fed first.  With a `backlog_limit`, no
+    more than that many backlog visits are in flight (fed and not yet
+    `done`) at once, keeping the remaining workers free to pick up
+    urgent visits as soon as they're added.
+
+    Adding a visit already in the backlog as urgent moves it to the
+    urgent lane.  Visits are fed once, unless added again after.
+
+    """
+    def __init__(self, backlog_limit=None):
+        """Initialize the lanes
+
+        :param backlog_limit: most backlog visits in flight at once,
+          None for no limit
+
+        """
+        if backlog_limit is not None and backlog_limit < 1:
+            raise ValueError("backlog_limit must be positive")
+        self.backlog_limit = backlog_limit
+        self._urgent = deque()
+        self._backlog = deque()
+        # visit_id: True if urgent, for each visit yet to feed
+        self._lane = {}
+        self._backlog_in_flight = set()
+
+    def __len__(self):
+        """Number of visits yet to feed"""
+        return len(self._lane)
+
+    def add(self, visit_ids, urgent=False):
+        """Add visits to the urgent or backlog lane"""
+        for visit_id in visit_ids:
+            queued = self._lane.get(visit_id)
+            if queued is None or (urgent and not queued):
+                self._lane[visit_id] = urgent
+                if urgent:
+                    self._urgent.append(visit_id)
+                else:
+                    self._backlog.append(visit_id)
+
+    def _pop(self, lane, urgent):
+        # Entries moved to the urgent lane are left behind in the
+        # backlog, and skipped here
+        while lane:
+            visit_id = lane.popleft()
+            if self._lane.get(visit_id) is urgent:
+                del self._lane[visit_id]
+                return visit_id
+        return None
+
+    def next(self):
+        """Returns the next visit_id to feed, None if none are ready"""
+        visit_id = self._pop(self._urgent, True)
+        if visit_id is not None:
+            return visit_id
+        if self.backlog_limit is not None and \
+                len(self._backlog_in_flight) >= self.backlog_limit:
+            return None
+        visit_id = self._pop(self._backlog, False)
+        if visit_id is not None:
+            self._backlog_in_flight.add(visit_id)
+        return visit_id
+
+    def done(self, visit_id):
+        """Note the visit is done"""
+        self._backlog_in_flight.discard(visit_id)
+
+    def remaining(self):
+        """Returns the visits yet to feed, in the order they'd be fed"""
+        return [visit_id for visit_id in self._urgent
+                if self._lane.get(visit_id) is True] + \
+            [visit_id for visit_id in self._backlog
+             if self._lane.get(visit_id) is False]
+
+
+class ShardFeeder(object):
+    """Feed the visits of several shards, a few shards at a time
+
+    Up to `active` shards are worked at once.  As a shard is
+    activated its visits are discovered, by calling `discover` with
+    the shard key, and `next` hands out visits from the active shards
+    in turn, so each receives an equal share of the workers.  A shard
+    is finished once all its visits are `done`, making room for the
+    next.
+
+    A visit discovered by more than one shard is only fed by the
+    first.
+
+    """
+    def __init__(self, shards, discover, active=4):
+        """Initialize the feeder
+
+        :param shards: shard keys, in the order to work them
+        :param discover: callable returning the visit_ids for a shard
+        :param active: number of shards worked at once
+
+        """
+        if active < 1:
+            raise ValueError("active must be positive")
+        self.discover = discover
+        self.active = active
+        self._shards = deque(shards)
+        self._active = deque()
+        # shard: [visits yet to feed, visits in flight, visit count]
+        self._work = {}
+        self._owner = {}
+        self._finished = []
+
+    def __len__(self):
+        """Number of visits fed and not yet done"""
+        return sum(len(self._work[shard][1]) for shard in self._active)
+
+    @property
+    def exhausted(self):
+        """True once every shard is finished"""
+        return not (self._shards or self._active)
+
+    def _activate(self):
+        while self._shards and len(self._active) < self.active:
+            shard = self._shards.popleft()
+            visits = deque()
+            for visit_id in self.discover(shard):
+                if visit_id not in self._owner:
+                    self._owner[visit_id] = shard
+                    visits.append(visit_id)
+            self._work[shard] = [visits, set(), len(visits)]
+            self._active.append(shard)
+            self._finish(shard)
+
+    def _finish(self, shard):
+        visits, in_flight, count = self._work[shard]
+        if not (visits or in_flight):
+            self._active.remove(shard)
+            del self._work[shard]
+            self._finished.append((shard, count))
+
+    def next(self):
+        """Returns the next visit_id to feed, None if none are ready"""
+        self._activate()
+        for i in xrange(len(self._active)):
+            shard = self._active[0]
+            self._active.rotate(-1)
+            visits, in_flight, count = self._work[shard]
+            if visits:
+                visit_id = visits.popleft()
+                in_flight.add(visit_id)
+                return visit_id
+        return None
+
+    def done(self, visit_id):
+        """Note the visit is done"""
+        shard = self._owner.pop(visit_id, None)
+        if shard is None or shard not in self._work:
+            return
+        self._work[shard][1].discard(visit_id)
+        self._finish(shard)
+
+    def finished(self):
+        """Returns (shard, visit count) for shards finished since last
+        called, in the order they finished"""
+        finished, self._finished = self._finished, []
+        return finished
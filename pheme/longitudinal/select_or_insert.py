@@ -1,4 +1,145 @@
+from collections import OrderedDict
+from multiprocessing import Lock, Value
+import os
+import time
+import zlib
+
+from sqlalchemy.orm import object_mapper
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.sql import text
+
+# Tables needing protection from asynchronous inserts, one lock each.
+# Names should match table minus 'dim_' prefix, plus '_lock' suffix
+# i.e. dim_location -> 'location_lock'
+TABLE_LOCKS = ('admission_source_lock',
+               'admission_o2sat_lock',
+               'admission_temp_lock',
+               'assigned_location_lock',
+               'admit_reason_lock',
+               'chief_complaint_lock',
+               'diagnosis_lock',
+               'disposition_lock',
+               'flu_vaccine_lock',
+               'h1n1_vaccine_lock',
+               'lab_flag_lock',
+               'lab_result_lock',
+               'location_lock',
+               'note_lock',
+               'order_number_lock',
+               'performing_lab_lock',
+               'pregnancy_lock',
+               'race_lock',
+               'reference_range_lock',
+               'service_area_lock',
+               'specimen_source_lock',
+               )
+
+
+def _int4(value):
+    """Fold the given string into a signed 32 bit integer"""
+    value = zlib.crc32(value) & 0xffffffff
+    if value > 0x7fffffff:
+        value -= 0x100000000
+    return value
+
+# First half of every advisory lock key taken by this package, so as
+# not to collide with other applications sharing the database.
+ADVISORY_NAMESPACE = _int4('pheme.longitudinal')
+
+
+def advisory_key(name):
+    """Returns the (int, int) postgres advisory lock key for name"""
+    return ADVISORY_NAMESPACE, _int4(name)
+
+
+class AdvisoryLock(object):
+    """Database backed stand-in for `multiprocessing.Lock`
+
+    Uses a postgres session level advisory lock, so the lock is
+    honored by any process on any host connected to the same
+    database, and is released by the database should the holder die.
+
+    The connection is dedicated to locking, as a session level lock
+    belongs to the connection it was taken on - a pooled ORM session
+    can't promise the release will use the same one.  Any number of
+    AdvisoryLocks (used by a single process) may share one.
+
+    """
+    def __init__(self, connection, name):
+        """Lock identified by name
+
+        :param connection: dedicated sqlalchemy Connection
+        :param name: name of the lock, i.e. 'location_lock'
+
+        """
+        self._connection = connection.execution_options(autocommit=True)
+        self._key = advisory_key(name)
+
+    def acquire(self):
+        self._connection.execute(text("SELECT pg_advisory_lock(:k1, :k2)"),
+                                 k1=self._key[0], k2=self._key[1])
+
+    def release(self):
+        self._connection.execute(
+            text("SELECT pg_advisory_unlock(:k1, :k2)"),
+            k1=self._key[0], k2=self._key[1])
+
+
+class TrackedLock(object):
+    """`multiprocessing.Lock` recording the pid of the holder
+
+    A worker dying while holding a table lock would otherwise leave
+    its siblings blocked forever.  The manager, on finding a dead
+    worker, releases any locks it held (see `release_if_held_by`).
+
+    The pid is recorded just after acquiring the lock, and cleared
+    just before releasing it.  A holder killed in between leaves the
+    lock held with no pid recorded - once it's been so for
+    ORPHAN_SECONDS, the manager releases it all the same.
+
+    """
+    ORPHAN_SECONDS = 1
+
+    def __init__(self):
+        self._lock = Lock()
+        self._holder = Value('i', 0, lock=False)
+
+    def acquire(self):
+        self._lock.acquire()
+        self._holder.value = os.getpid()
+
+    def release(self):
+        self._holder.value = 0
+        self._lock.release()
+
+    def _orphaned(self):
+        """True if held, with no holder recorded, for ORPHAN_SECONDS"""
+        deadline = time.time() + self.ORPHAN_SECONDS
+        while self._holder.value == 0:
+            if self._lock.acquire(False):
+                self._lock.release()
+                return False
+            if time.time() >= deadline:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def release_if_held_by(self, pid):
+        """Release the lock if held by (the now dead) process pid
+
+        Also releases a lock orphaned by a holder killed before its
+        pid was recorded (see `_orphaned`).
+
+        returns True if the lock was released
+
+        """
+        if pid and self._holder.value == pid:
+            self.release()
+            return True
+        if pid and self._orphaned():
+            self.release()
+            return True
+        return False
 
 
 class SelectOrInsert(object):
@@ -11,34 +152,177 @@ class SelectOrInsert(object):
     return the existing row.
 
     To provide efficient access, this encapsulates a cache as well as
-    a locking mechanism to avoid collisions.
+    a locking mechanism to avoid collisions.  The lock may be a
+    `multiprocessing.Lock` or, for workers not sharing a parent
+    process, an `AdvisoryLock`.
+
+    With `advisory_locks` set, the table wide lock is replaced by a
+    transaction scoped postgres advisory lock keyed on the table and
+    the values being requested.  Only those inserting the same value
+    contend, regardless of which process, manager or host they belong
+    to.  Given the `lock_name`, the table's advisory lock is also
+    taken, though shared, excluding `BulkBackfill` (which takes it
+    exclusively) but not one another.
+
+    The cache maps the query_fields values to the primary key of rows
+    with a single column primary key.  A cache hit sets the primary
+    key on the object given to `fetch` and returns it, without
+    touching the database - callers only need the primary key.  An
+    optional `SharedDimensionCache` is consulted on a local miss, and
+    told of every row found in or added to the database.
 
     """
-    def __init__(self, lock, session):
+    CACHE_SIZE = 0
+
+    def __init__(self, lock, session, advisory_locks=False,
+                 cache_size=CACHE_SIZE, shared_cache=None,
+                 lock_name=None):
+        """Initialize for a single dimension table
+
+        :param lock: lock protecting the table, ignored (may be None)
+          if using advisory_locks
+        :param session: sqlalchemy session for the data mart
+        :param advisory_locks: use per value advisory locks in place
+          of `lock`
+        :param cache_size: maximum number of rows kept in the local
+          cache, zero disables
+        :param shared_cache: optional `SharedDimensionCache`, shared
+          with the other workers
+        :param lock_name: name of the table's lock (see TABLE_LOCKS)
+
+        """
         self._lock = lock
+        self._lock_name = lock_name
         self._session = session
+        self._advisory_locks = advisory_locks
+        self._cache_size = cache_size
+        self._shared_cache = shared_cache
+        self._cache = OrderedDict()
+        self._pk_attrs = {}
+
+    def _pk_attr(self, obj):
+        """Name of obj's primary key attribute, None if composite"""
+        cls = obj.__class__
+        if cls not in self._pk_attrs:
+            mapper = object_mapper(obj)
+            attr = None
+            if len(mapper.primary_key) == 1:
+                attr = mapper.get_property_by_column(
+                    mapper.primary_key[0]).key
+            self._pk_attrs[cls] = attr
+        return self._pk_attrs[cls]
+
+    def _remember(self, values, pk):
+        """Add to the local cache, evicting the least recent if full"""
+        if not self._cache_size:
+            return
+        self._cache.pop(values, None)
+        if len(self._cache) >= self._cache_size:
+            self._cache.popitem(last=False)
+        self._cache[values] = pk
 
     def cache_lookup(self, obj):
-        # TODO
-        return None
+        """Returns obj with its primary key set if cached, else None"""
+        if not (self._cache_size or self._shared_cache):
+            return None
+        attr = self._pk_attr(obj)
+        if attr is None:
+            return None
+        values = self._values(obj)
+        pk = self._cache.pop(values, None)
+        if pk is not None:
+            # Most recently used go last
+            self._cache[values] = pk
+        elif self._shared_cache:
+            pk = self._shared_cache.lookup(self._table(obj), values)
+            if pk is not None:
+                self._remember(values, pk)
+        if pk is None:
+            return None
+        setattr(obj, attr, pk)
+        return obj
 
     def cache_insert(self, obj):
-        # TODO
-        pass
+        """Cache the primary key of the persisted obj"""
+        if not (self._cache_size or self._shared_cache):
+            return
+        attr = self._pk_attr(obj)
+        if attr is None:
+            return
+        pk = getattr(obj, attr)
+        values = self._values(obj)
+        self._remember(values, pk)
+        if self._shared_cache:
+            self._shared_cache.publish(self._table(obj), values, pk)
 
-    def fetch(self, obj):
-        # First hit the cache - return a match if found
-        ret = self.cache_lookup(obj)
-        if ret:  # pragma: no cover  (Not implemented)
-            return ret
-        # Otherwise, need to insert in db and add to the cache
+    def preload(self, rows):
+        """Warm the cache with rows already persisted
+
+        :param rows: iterable of mapped instances, typically a query
+
+        returns the number of rows cached
+
+        """
+        count = 0
+        for row in rows:
+            self.cache_insert(row)
+            count += 1
+        return count
+
+    def _query(self, obj):
+        """Build the query for the row matching obj's query_fields"""
+        d = dict()
+        for f in obj.query_fields:
+            d[f] = getattr(obj, f, None)
+        return self._session.query(obj.__class__).filter_by(**d)
+
+    def _table(self, obj):
+        return object_mapper(obj).local_table.name
+
+    def _values(self, obj):
+        """Serialize obj's query_fields values to a utf-8 string"""
+        values = u'\x1f'.join([u'\x00' if v is None else unicode(v)
+                                for v in [getattr(obj, f, None) for f in
+                                          obj.query_fields]])
+        return values.encode('utf-8')
+
+    def _value_key(self, obj):
+        """Returns the (int, int) advisory lock key for obj's values"""
+        return _int4(self._table(obj)), _int4(self._values(obj))
+
+    def _advisory_fetch(self, obj):
+        """fetch() implementation using per value advisory locks"""
+        query = self._query(obj)
+        try:
+            return query.one()
+        except NoResultFound:
+            pass
+
+        # Serialize those attempting to insert this same value (and
+        # any bulk backfill), and look again in case another beat us
+        # to it.  The commit ends the transaction, releasing the
+        # locks.
+        if self._lock_name:
+            key = advisory_key(self._lock_name)
+            self._session.execute(
+                text("SELECT pg_advisory_xact_lock_shared(:k1, :k2)"),
+                {'k1': key[0], 'k2': key[1]})
+        key = self._value_key(obj)
+        self._session.execute(
+            text("SELECT pg_advisory_xact_lock(:k1, :k2)"),
+            {'k1': key[0], 'k2': key[1]})
+        try:
+            obj = query.one()
+        except NoResultFound:
+            self._session.add(obj)
+        self._session.commit()
+        return obj
+
+    def _locked_fetch(self, obj):
+        """fetch() implementation holding the table lock"""
         try:
             self._lock.acquire()
-            d = dict()
-            for f in obj.query_fields:
-                d[f] = getattr(obj, f, None)
-            query = self._session.query(obj.__class__).\
-                filter_by(**d)
+            query = self._query(obj)
             try:
                 return query.one()
             except MultipleResultsFound:  # pragma: no cover
@@ -47,7 +331,20 @@ class SelectOrInsert(object):
                 # Time to add it
                 self._session.add(obj)
                 self._session.commit()
-                self.cache_insert(obj)
                 return obj
         finally:
             self._lock.release()
+
+    def fetch(self, obj):
+        # First hit the cache - return a match if found
+        ret = self.cache_lookup(obj)
+        if ret is not None:
+            return ret
+        # Otherwise, need to select or insert in db and add to the
+        # cache
+        if self._advisory_locks:
+            ret = self._advisory_fetch(obj)
+        else:
+            ret = self._locked_fetch(obj)
+        self.cache_insert(ret)
+        return ret
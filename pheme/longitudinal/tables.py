@@ -9,7 +9,7 @@ import sys
 from sqlalchemy import create_engine, text
 from sqlalchemy import CHAR, VARCHAR, SMALLINT, NUMERIC, TEXT
 from sqlalchemy import Boolean, DateTime, Integer
-from sqlalchemy import Table, Column, ForeignKey, UniqueConstraint
+from sqlalchemy import Table, Column, ForeignKey, Index, UniqueConstraint
 from sqlalchemy import MetaData
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import mapper, relationship
@@ -519,7 +519,13 @@ fact_visit = Table(
     Column('last_updated', DateTime, default=datetime.datetime.now(),
            onupdate=datetime.datetime.now(), index=True),
     UniqueConstraint('visit_id', 'patient_class',
-                     name='unique_visit_patient_class'))
+                     name='unique_visit_patient_class'),
+    # For the report's visit selection, by admission date and
+    # (including updates) last_updated, statewide or by facility
+    Index('ix_fact_visit_updated_admit', 'last_updated',
+          'admit_datetime'),
+    Index('ix_fact_visit_facility_admit', 'dim_facility_pk',
+          'admit_datetime', 'last_updated'))
 
 
 class Visit(OrmObject):
@@ -650,6 +656,47 @@ class MessageProcessed(OrmObject):
 mapper(MessageProcessed, internal_message_processed)
 
 
+internal_pending_visit = Table(
+    'internal_pending_visit', metadata,
+    Column('visit_id', VARCHAR(255), primary_key=True),
+    Column('pending_count', Integer, nullable=False, default=0),
+    Column('oldest_message', DateTime, nullable=False, index=True),
+    Column('claimed_by', VARCHAR(255), default=None),
+    Column('lease_expires', DateTime, default=None, index=True),
+    Column('attempts', Integer, nullable=False, default=0,
+           server_default='0'),
+    Column('admit_datetime', DateTime, default=None),
+    Column('facility', VARCHAR(255), default=None),
+    Column('patient_class', VARCHAR(1), default=None),)
+
+
+class PendingVisit(OrmObject):
+    """Work queue of visits with messages yet to be processed
+
+    One row per visit_id having at least one unprocessed row in
+    'internal_message_processed'.  Rows are added (or their
+    `pending_count` bumped) as new messages are brought over from the
+    data warehouse, and removed by the worker once the visit has been
+    deduplicated.  Finding work is then a scan of pending visits,
+    rather than a DISTINCT over every unprocessed message.
+
+    Distributed workers claim visits by setting `claimed_by` and
+    `lease_expires`, counting `attempts` at each so a visit that keeps
+    failing is given up on - see `visit_claims.VisitClaims`.  New
+    messages for the visit reset the count.
+
+    The latest `admit_datetime`, `facility` and `patient_class` of the
+    new messages let the manager put urgent visits ahead of any
+    backlog.  They're unknown (NULL) on rows rebuilt from
+    internal_message_processed.
+
+    """
+    pass
+
+
+mapper(PendingVisit, internal_pending_visit)
+
+
 internal_reportable_region = Table(
     'internal_reportable_region', metadata,
     Column('region_name', VARCHAR(50), primary_key=True),
@@ -701,6 +748,46 @@ class Report(OrmObject):
 
 mapper(Report, internal_report)
 
+
+essence_flat = Table(
+    'essence_flat', metadata,
+    Column('visit_pk', ForeignKey('fact_visit.pk', ondelete='CASCADE'),
+           primary_key=True),
+    Column('hospital', VARCHAR(80)),
+    Column('visit_date', VARCHAR(10)),
+    Column('visit_time', VARCHAR(8)),
+    Column('gender', CHAR(1)),
+    Column('age', SMALLINT),
+    Column('chief_complaint', VARCHAR(80)),
+    Column('zip', VARCHAR(10)),
+    Column('diagnosis', TEXT),
+    Column('gipse_disposition', VARCHAR(16)),
+    Column('odin_disposition', VARCHAR(16)),
+    Column('patient_id', VARCHAR(60)),
+    Column('visit_id', VARCHAR(60)),
+    Column('patient_class', CHAR(1)),
+    Column('measured_temperature', NUMERIC),
+    Column('o2_saturation', SMALLINT),
+    Column('influenza_vaccine', VARCHAR(30)),
+    Column('h1n1_vaccine', VARCHAR(30)),
+    Column('last_updated', DateTime, index=True))
+
+
+class EssenceFlat(OrmObject):
+    """Materialized `essence` view, diagnoses included
+
+    One row per fact_visit, holding the essence view's columns along
+    with the aggregated `diagnosis` list, so reports needn't repeat
+    the view's joins or the diagnosis aggregation.  Maintained by
+    `refresh_essence_flat`, `last_updated` being the fact_visit's at
+    the time.
+
+    """
+    pass
+
+
+mapper(EssenceFlat, essence_flat)
+
 """
 ================================================================
 End table definitions.
@@ -751,6 +838,147 @@ def create_essence_view(engine):
     engine.execute(text(essence_view))
 
 
+def diagnosis_aggregate(join=""):
+    """SQL producing the diagnosis list of each visit
+
+    The database equivalent of the report's `SortedDiagnosis`: the
+    most recent row for each unique icd9 (DISTINCT ON), aggregated
+    into a space delimited list ordered by rank, ties most recent
+    first.  Selects (fact_visit_pk, diagnosis).
+
+    :param join: JOIN clause limiting the visits, i.e. to those in a
+      temporary table
+
+    """
+    return """SELECT fact_visit_pk,
+      string_agg(icd9, ' ' ORDER BY rank NULLS FIRST,
+                 dx_datetime DESC) AS diagnosis
+    FROM (SELECT DISTINCT ON (fact_visit_pk, icd9) fact_visit_pk,
+            icd9, rank, dx_datetime
+          FROM assoc_visit_dx
+          JOIN dim_dx ON dim_dx_pk = dim_dx.pk
+          %s
+          ORDER BY fact_visit_pk, icd9, dx_datetime DESC) latest
+    GROUP BY fact_visit_pk""" % join
+
+
+# Visits updated this long before the latest already in essence_flat
+# are refreshed again, catching those committed out of order.
+ESSENCE_FLAT_MARGIN = '1 hour'
+
+
+def refresh_essence_flat(engine, visit_id=None):
+    """Bring essence_flat up to date with fact_visit
+
+    Upserts the rows of visits updated since the latest refreshed
+    (less ESSENCE_FLAT_MARGIN), or every visit into an empty table.
+    Deleted visits cascade.
+
+    :param engine: engine connected to the data mart
+    :param visit_id: refresh just this visit's rows, regardless of
+      when updated
+
+    returns the number of rows refreshed
+
+    """
+    if visit_id is not None:
+        changed = "v.visit_id = :visit_id"
+    else:
+        changed = """v.last_updated > coalesce((SELECT max(last_updated)
+          FROM essence_flat), '-infinity') - interval '%s'""" % \
+            ESSENCE_FLAT_MARGIN
+    columns = [c.name for c in essence_flat.c
+               if c.name not in ('visit_pk', 'diagnosis', 'last_updated')]
+    stmt = """INSERT INTO essence_flat (visit_pk, diagnosis,
+      last_updated, %(columns)s)
+    SELECT v.pk, dx.diagnosis, v.last_updated, %(e_columns)s
+    FROM fact_visit v JOIN essence e ON e.visit_pk = v.pk
+    LEFT JOIN (%(dx)s) dx ON dx.fact_visit_pk = v.pk
+    WHERE %(changed)s
+    ON CONFLICT (visit_pk) DO UPDATE SET %(updates)s""" % {
+        'columns': ', '.join(columns),
+        'e_columns': ', '.join('e.' + c for c in columns),
+        'dx': diagnosis_aggregate(
+            "JOIN fact_visit v ON fact_visit_pk = v.pk AND " + changed),
+        'changed': changed,
+        'updates': ', '.join('%s = EXCLUDED.%s' % (c, c) for c in
+                             ['diagnosis', 'last_updated'] + columns)}
+    return engine.execute(text(stmt), visit_id=visit_id).rowcount
+
+
+def bless_user(engine, user, enable_delete=False):
+    """Grant `user` the privileges needed to run against the mart
+
+    :param engine: engine connected with table owner privileges
+    :param user: database user to grant privileges to
+    :param enable_delete: testing hook, also grant DELETE
+
+    """
+    engine.execute("""BEGIN; GRANT SELECT, INSERT, UPDATE %(delete)s ON
+                   assoc_visit_dx,
+                   assoc_visit_lab,
+                   dim_admission_o2sat,
+                   dim_admission_source,
+                   dim_admission_temp,
+                   dim_assigned_location,
+                   dim_cc,
+                   dim_disposition,
+                   dim_dx,
+                   dim_facility,
+                   dim_flu_vaccine,
+                   dim_h1n1_vaccine,
+                   dim_lab_flag,
+                   dim_lab_result,
+                   dim_location,
+                   dim_note,
+                   dim_order_number,
+                   dim_performing_lab,
+                   dim_pregnancy,
+                   dim_race,
+                   dim_ref_range,
+                   dim_service_area,
+                   dim_specimen_source,
+                   fact_visit,
+                   internal_export_delta,
+                   internal_message_processed,
+                   internal_pending_visit,
+                   internal_report,
+                   essence_flat,
+                   internal_reportable_region
+                   TO %(user)s; COMMIT;""" %
+                   {'delete': ", DELETE" if enable_delete else '',
+                    'user': user})
+
+    # Sequences also require UPDATE
+    engine.execute("""BEGIN; GRANT SELECT, UPDATE ON
+                   dim_admission_o2sat_pk_seq,
+                   dim_admission_temp_pk_seq,
+                   dim_assigned_location_pk_seq,
+                   dim_cc_pk_seq,
+                   dim_dx_pk_seq,
+                   dim_flu_vaccine_pk_seq,
+                   dim_h1n1_vaccine_pk_seq,
+                   dim_lab_flag_pk_seq,
+                   dim_lab_result_pk_seq,
+                   dim_location_pk_seq,
+                   dim_note_pk_seq,
+                   dim_order_number_pk_seq,
+                   dim_performing_lab_pk_seq,
+                   dim_pregnancy_pk_seq,
+                   dim_race_pk_seq,
+                   dim_ref_range_pk_seq,
+                   dim_service_area_pk_seq,
+                   dim_specimen_source_pk_seq,
+                   fact_visit_pk_seq,
+                   internal_export_delta_pk_seq,
+                   internal_report_pk_seq
+                   TO %(user)s; COMMIT;""" % {'user': user})
+
+    # Visits leave the work queue once processed
+    engine.execute("""BEGIN; GRANT DELETE ON internal_pending_visit
+                   TO %(user)s; COMMIT;""" % {'user': user})
+
+
 def create_tables(user=None, password=None, database=None,
                   enable_delete=False):
     """Create the longitudinal database tables.
@@ -779,72 +1007,83 @@ def create_tables(user=None, password=None, database=None,
     metadata.drop_all(bind=engine)
     metadata.create_all(bind=engine)
 
-    def bless_user(user):
-        engine.execute("""BEGIN; GRANT SELECT, INSERT, UPDATE %(delete)s ON
-                       assoc_visit_dx,
-                       assoc_visit_lab,
-                       dim_admission_o2sat,
-                       dim_admission_source,
-                       dim_admission_temp,
-                       dim_assigned_location,
-                       dim_cc,
-                       dim_disposition,
-                       dim_dx,
-                       dim_facility,
-                       dim_flu_vaccine,
-                       dim_h1n1_vaccine,
-                       dim_lab_flag,
-                       dim_lab_result,
-                       dim_location,
-                       dim_note,
-                       dim_order_number,
-                       dim_performing_lab,
-                       dim_pregnancy,
-                       dim_race,
-                       dim_ref_range,
-                       dim_service_area,
-                       dim_specimen_source,
-                       fact_visit,
-                       internal_export_delta,
-                       internal_message_processed,
-                       internal_report,
-                       internal_reportable_region
-                       TO %(user)s; COMMIT;""" %
-                       {'delete': ", DELETE" if enable_delete else '',
-                        'user': user})
-
-        # Sequences also require UPDATE
-        engine.execute("""BEGIN; GRANT SELECT, UPDATE ON
-                       dim_admission_o2sat_pk_seq,
-                       dim_admission_temp_pk_seq,
-                       dim_assigned_location_pk_seq,
-                       dim_cc_pk_seq,
-                       dim_dx_pk_seq,
-                       dim_flu_vaccine_pk_seq,
-                       dim_h1n1_vaccine_pk_seq,
-                       dim_lab_flag_pk_seq,
-                       dim_lab_result_pk_seq,
-                       dim_location_pk_seq,
-                       dim_note_pk_seq,
-                       dim_order_number_pk_seq,
-                       dim_performing_lab_pk_seq,
-                       dim_pregnancy_pk_seq,
-                       dim_race_pk_seq,
-                       dim_ref_range_pk_seq,
-                       dim_service_area_pk_seq,
-                       dim_specimen_source_pk_seq,
-                       fact_visit_pk_seq,
-                       internal_export_delta_pk_seq,
-                       internal_report_pk_seq
-                       TO %(user)s; COMMIT;""" % {'user': user})
-
     # Provide configured user necessary privileges
-    bless_user(Config().get('longitudinal', 'database_user'))
+    bless_user(engine, Config().get('longitudinal', 'database_user'),
+               enable_delete)
 
     # Add any views
     create_essence_view(engine)
 
 
+def rebuild_pending_visits(engine):
+    """(Re)build internal_pending_visit from internal_message_processed
+
+    The pending visit table is maintained incrementally as messages
+    arrive and visits are processed.  This populates it from scratch,
+    necessary on marts predating the table, and safe to run any time
+    the longitudinal manager isn't.
+
+    """
+    engine.execute(text("""BEGIN;
+        DELETE FROM internal_pending_visit;
+        INSERT INTO internal_pending_visit (visit_id, pending_count,
+          oldest_message)
+        SELECT visit_id, count(*), min(message_datetime)
+        FROM internal_message_processed
+        WHERE processed_datetime IS NULL
+        GROUP BY visit_id;
+        COMMIT;"""))
+
+
+def upgrade_tables(user=None, password=None, database=None):
+    """Non destructive counterpart to `create_tables`
+
+    Adds any tables (or internal_pending_visit columns, or composite
+    indexes) missing from an existing database, refreshes grants and
+    views, and builds the pending visit work queue if new.  Existing
+    tables and their data are left untouched - a queue in use by
+    running managers included, see `--rebuild-pending` to rebuild it.
+
+    :param user: database user with table creation grants
+    :param password: the database password
+    :param database: the database name to upgrade
+
+    """
+    engine = create_engine("postgresql://%s:%s@localhost/%s" %
+                           (user, password, database))
+    engine.execute(text("""BEGIN;
+        ALTER TABLE IF EXISTS internal_pending_visit
+          ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(255),
+          ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP,
+          ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+          ADD COLUMN IF NOT EXISTS admit_datetime TIMESTAMP,
+          ADD COLUMN IF NOT EXISTS facility VARCHAR(255),
+          ADD COLUMN IF NOT EXISTS patient_class VARCHAR(1);
+        COMMIT;"""))
+    new_queue = not internal_pending_visit.exists(bind=engine)
+    metadata.create_all(bind=engine)
+    # create_all skips the indexes of existing tables
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            if len(index.columns) > 1:
+                engine.execute(text(
+                    "CREATE INDEX IF NOT EXISTS %s ON %s (%s)" %
+                    (index.name, table.name,
+                     ', '.join(column.name for column in index.columns))))
+    bless_user(engine, Config().get('longitudinal', 'database_user'))
+    create_essence_view(engine)
+    if new_queue:
+        rebuild_pending_visits(engine)
+
+
+def upgrade():  # pragma: no cover
+    """Entry point to add missing tables using config settings"""
+    config = Config()
+    user = config.get('longitudinal', 'database_user')
+    password = config.get('longitudinal', 'database_password')
+    upgrade_tables(user, password, config.get('longitudinal', 'database'))
+
+
 def main():  # pragma: no cover
     """Entry point to (re)create the table using config settings"""
     config = Config()
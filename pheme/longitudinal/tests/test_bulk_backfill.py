@@ -0,0 +1,207 @@
+import datetime
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from pheme.longitudinal.bulk_backfill import BulkBackfill
+from pheme.longitudinal.longitudinal_manager import LongitudinalManager
+from pheme.longitudinal.longitudinal_worker import LongitudinalWorker
+from pheme.longitudinal.select_or_insert import TABLE_LOCKS, TrackedLock
+from pheme.longitudinal.tables import Facility, create_tables
+from pheme.longitudinal.tables import rebuild_pending_visits
+from pheme.util.config import Config, configure_logging
+from pheme.util.pg_access import db_connection, db_params
+from pheme.warehouse.tables import create_tables as create_warehouse_tables
+
+CONFIG_SECTION = 'longitudinal'
+WAREHOUSE_SECTION = 'warehouse'
+NPI = 1234567890
+ADT = 'ADT^A08^ADT_A01'
+
+# (visit_id, patient_class, minutes after the first message, values)
+MESSAGES = (
+    ('v1', 'E', 0, {'chief_complaint': 'COUGH', 'zip': '98101',
+                    'state': 'WA', 'race': '2106-3', 'gender': 'F',
+                    'dob': '197001', 'assigned_patient_location': 'ER',
+                    'dx': (('786.2', 'COUGH', 'A', 1),)}),
+    ('v1', 'E', 30, {'chief_complaint': 'COUGH, FEVER', 'zip': '98101',
+                     'state': 'WA', 'service_code': 'EME',
+                     'dx': (('780.6', 'FEVER', 'W', 1),
+                            ('786.2', 'COUGH', 'F', 2))}),
+    ('v1', 'I', 90, {'chief_complaint': 'FEVER', 'zip': '98102',
+                     'state': 'WA', 'assigned_patient_location': 'ICU',
+                     'service_code': 'INT'}),
+    ('v2', 'E', 10, {'chief_complaint': 'COUGH', 'zip': '98101',
+                     'state': 'WA', 'race': '2106-3', 'gender': 'M',
+                     'dob': '200512',
+                     'dx': (('786.2', 'COUGH', 'F', 1),)}),
+    ('v3', 'O', 20, {'chief_complaint': 'RASH', 'county': 'KING',
+                     'race': '2054-5', 'gender': 'U'}),
+)
+
+# Comparable contents of the mart, dimension keys resolved to values
+SNAPSHOT = {
+    'fact_visit': """SELECT f.visit_id, f.patient_class, f.patient_id,
+      f.admit_datetime, f.first_message, f.last_message,
+      f.discharge_datetime, f.age, f.dob, f.gender, f.ever_in_icu,
+      f.dim_facility_pk, ar.admit_reason, cc.chief_complaint,
+      l.country, l.county, l.state, l.zip, sa.area, al.location, r.race
+      FROM fact_visit f
+      LEFT JOIN dim_ar ar ON ar.pk = f.dim_ar_pk
+      LEFT JOIN dim_cc cc ON cc.pk = f.dim_cc_pk
+      LEFT JOIN dim_location l ON l.pk = f.dim_location_pk
+      LEFT JOIN dim_service_area sa ON sa.pk = f.dim_service_area_pk
+      LEFT JOIN dim_assigned_location al
+        ON al.pk = f.dim_assigned_location_pk
+      LEFT JOIN dim_race r ON r.pk = f.dim_race_pk
+      ORDER BY f.visit_id, f.patient_class""",
+    'assoc_visit_dx': """SELECT f.visit_id, f.patient_class, dx.icd9,
+      a.status, a.dx_datetime, a.rank FROM assoc_visit_dx a
+      JOIN fact_visit f ON f.pk = a.fact_visit_pk
+      JOIN dim_dx dx ON dx.pk = a.dim_dx_pk ORDER BY 1, 2, 3, 4""",
+    'dim_ar': "SELECT admit_reason FROM dim_ar ORDER BY 1",
+    'dim_cc': "SELECT chief_complaint FROM dim_cc ORDER BY 1",
+    'dim_assigned_location': """SELECT location
+      FROM dim_assigned_location ORDER BY 1""",
+    'dim_dx': "SELECT icd9, description FROM dim_dx ORDER BY 1",
+    'dim_location': """SELECT country, county, state, zip
+      FROM dim_location ORDER BY 1, 2, 3, 4""",
+    'dim_race': "SELECT race FROM dim_race ORDER BY 1",
+    'dim_service_area': "SELECT area FROM dim_service_area ORDER BY 1",
+}
+
+
+def setup_module():
+    """Create fresh dbs (once) for all tests in this module"""
+    configure_logging(verbosity=2, logfile='unittest.log')
+    c = Config()
+    if c.get('general', 'in_production'):  # pragma: no cover
+        raise RuntimeError("DO NOT run destructive test on production system")
+
+    create_tables(enable_delete=True, **db_params(CONFIG_SECTION))
+    create_warehouse_tables(enable_delete=True,
+                            **db_params(WAREHOUSE_SECTION))
+    conn = db_connection(CONFIG_SECTION)
+    conn.session.add(Facility(county='KING', npi=NPI, zip='98101',
+                              organization_name='Bulk Medical Center',
+                              local_code='BMC'))
+    conn.session.commit()
+    conn.disconnect()
+
+
+def load_messages(engine, batch='bulk'):
+    """Add the MESSAGES to the warehouse, as the named batch"""
+    start = datetime.datetime(2009, 1, 1, 8, 0)
+    for i, (visit_id, patient_class, minutes, values) in \
+            enumerate(MESSAGES):
+        message_datetime = start + datetime.timedelta(minutes=minutes)
+        msh_id = engine.execute(text("""INSERT INTO hl7_msh
+        (message_control_id, message_type, facility, message_datetime)
+        VALUES (:control_id, :message_type, :facility, :message_datetime)
+        RETURNING hl7_msh_id"""), control_id='%s-%d' % (batch, i),
+                                message_type=ADT, facility=str(NPI),
+                                message_datetime=message_datetime).scalar()
+        visit = dict((column, values.get(column)) for column in (
+            'chief_complaint', 'zip', 'state', 'county', 'race',
+            'gender', 'dob', 'assigned_patient_location',
+            'service_code'))
+        engine.execute(text("""INSERT INTO hl7_visit (hl7_msh_id,
+        visit_id, patient_class, patient_id, admit_datetime,
+        chief_complaint, zip, state, county, race, gender, dob,
+        assigned_patient_location, service_code) VALUES (:msh_id,
+        :visit_id, :patient_class, :patient_id, :admit_datetime,
+        :chief_complaint, :zip, :state, :county, :race, :gender, :dob,
+        :assigned_patient_location, :service_code)"""),
+                       msh_id=msh_id, visit_id=visit_id,
+                       patient_class=patient_class,
+                       patient_id='patient-%s' % visit_id,
+                       admit_datetime=start, **visit)
+        for code, description, dx_type, rank in values.get('dx', ()):
+            engine.execute(text("""INSERT INTO hl7_dx (hl7_msh_id,
+            dx_code, dx_description, dx_type, rank) VALUES (:msh_id,
+            :code, :description, :dx_type, :rank)"""), msh_id=msh_id,
+                           code=code, description=description,
+                           dx_type=dx_type, rank=rank)
+
+
+class BulkBackfillTest(unittest.TestCase):
+    """Set based backfill matches the workers' visit by visit merge"""
+    def setUp(self):
+        self.params = db_params(CONFIG_SECTION)
+        self.warehouse_params = db_params(WAREHOUSE_SECTION)
+        self.manager = LongitudinalManager(
+            data_warehouse=self.warehouse_params['database'],
+            data_mart=self.params['database'],
+            database_user=self.params['user'],
+            database_password=self.params['password'])
+        self.manager._connect()
+        self.mart = self.manager.data_mart_access.engine
+        self.warehouse = self.manager.data_warehouse_access.engine
+        load_messages(self.warehouse)
+        self.manager._prepDeduplicateTables()
+
+    def tearDown(self):
+        self.reset_mart()
+        self.mart.execute("""BEGIN;
+        DELETE FROM internal_pending_visit;
+        DELETE FROM internal_message_processed;
+        COMMIT;""")
+        self.warehouse.execute("""BEGIN;
+        DELETE FROM hl7_dx; DELETE FROM hl7_visit; DELETE FROM hl7_msh;
+        COMMIT;""")
+        self.manager._disconnect()
+
+    def reset_mart(self):
+        """Undo any merge, leaving all messages pending"""
+        self.mart.execute("""BEGIN;
+        DELETE FROM assoc_visit_dx; DELETE FROM fact_visit;
+        DELETE FROM dim_ar; DELETE FROM dim_cc;
+        DELETE FROM dim_assigned_location; DELETE FROM dim_dx;
+        DELETE FROM dim_location; DELETE FROM dim_race;
+        DELETE FROM dim_service_area;
+        UPDATE internal_message_processed SET processed_datetime = NULL;
+        COMMIT;""")
+        rebuild_pending_visits(self.mart)
+
+    def snapshot(self):
+        return dict((name, self.mart.execute(query).fetchall())
+                    for name, query in SNAPSHOT.items())
+
+    def testSameAsWorkers(self):
+        self.assertEquals(BulkBackfill(self.warehouse, self.mart).run(), 3)
+        self.assertEquals(self.mart.execute(
+            "SELECT count(*) FROM internal_pending_visit").scalar(), 0)
+        bulk = self.snapshot()
+        self.assertEquals(len(bulk['fact_visit']), 4)
+
+        self.reset_mart()
+        worker = LongitudinalWorker(
+            queue=None, procNumber=0,
+            data_warehouse=self.warehouse_params['database'],
+            data_mart=self.params['database'],
+            dbUser=self.params['user'], dbPass=self.params['password'],
+            table_locks=dict((table, TrackedLock())
+                             for table in TABLE_LOCKS))
+        for visit_id in ('v1', 'v2', 'v3'):
+            worker.dedupVisit(visit_id)
+        worker.tearDown()
+        workers = self.snapshot()
+
+        for name in sorted(SNAPSHOT):
+            self.assertEquals(bulk[name], workers[name],
+                              "%s differs" % name)
+
+    def testRepeatRun(self):
+        "Runs reusing a pooled connection, as in daemon mode"
+        mart = create_engine(self.mart.url, pool_size=1, max_overflow=1)
+        self.assertEquals(BulkBackfill(self.warehouse, mart).run(), 3)
+        load_messages(self.warehouse, batch='repeat')
+        self.manager._prepDeduplicateTables()
+        # The repeated messages update the merged visits, left be
+        self.assertEquals(BulkBackfill(self.warehouse, mart).run(), 0)
+        self.assertEquals(BulkBackfill(self.warehouse, mart).run(), 0)
+        mart.dispose()
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+
+from sqlalchemy.pool import NullPool
+
+from pheme.longitudinal.connections import ConnectionFactory
+from pheme.util.config import Config, configure_logging
+from pheme.util.pg_access import db_params
+
+CONFIG_SECTION = 'longitudinal'
+
+
+def setup_module():
+    """Quiet logging for all tests in this module"""
+    configure_logging(verbosity=2, logfile='unittest.log')
+    c = Config()
+    if c.get('general', 'in_production'):  # pragma: no cover
+        raise RuntimeError("DO NOT run destructive test on production system")
+
+
+class ConnectionFactoryTest(unittest.TestCase):
+    """Bounded pools, and the workers that fit the server"""
+    def setUp(self):
+        self.params = db_params(CONFIG_SECTION)
+        self.database = self.params['database']
+
+    def factory(self, **kwargs):
+        return ConnectionFactory(user=self.params['user'],
+                                 password=self.params['password'],
+                                 **kwargs)
+
+    def testPerProcess(self):
+        factory = self.factory(pool_size=3, max_overflow=2)
+        # The pool and a dedicated connection
+        self.assertEquals(factory.per_process, 3 + 2 + 1)
+
+    def testEngineShared(self):
+        factory = self.factory(pool_size=2, max_overflow=1)
+        engine = factory.engine(self.database)
+        self.assertTrue(engine is factory.engine(self.database))
+        self.assertTrue(engine is self.factory(
+            pool_size=2, max_overflow=1).engine(self.database))
+        self.assertEquals(engine.pool.size(), 2)
+        # Differently bound pools aren't shared
+        other = self.factory(pool_size=1, max_overflow=0)
+        self.assertFalse(engine is other.engine(self.database))
+
+    def testDedicatedOutsidePool(self):
+        factory = self.factory(pool_size=1, max_overflow=0)
+        engine = factory.engine(self.database)
+        held = factory.dedicated(self.database)
+        try:
+            self.assertEquals(held.scalar("SELECT 1"), 1)
+            # The pool's one connection is still there for the taking
+            self.assertEquals(engine.pool.checkedout(), 0)
+            self.assertEquals(engine.execute("SELECT 2").scalar(), 2)
+        finally:
+            held.close()
+
+    def testDedicatedAccess(self):
+        access = self.factory().dedicated_access(self.database)
+        try:
+            # Session state outlives each (autocommitted) statement
+            access.raw_query("CREATE TEMPORARY TABLE held (n integer)")
+            access.raw_query("INSERT INTO held VALUES (1), (2)")
+            access.raw_query("DECLARE held_cursor NO SCROLL CURSOR "
+                             "WITH HOLD FOR SELECT n FROM held ORDER BY n")
+            self.assertEquals(access.raw_query(
+                "FETCH FORWARD 5 FROM held_cursor").fetchall(),
+                [(1,), (2,)])
+            access.raw_query("CLOSE held_cursor")
+        finally:
+            access.close()
+
+    def testDedicatedAccessPgbouncer(self):
+        self.assertRaises(ValueError,
+                          self.factory(pgbouncer=True).dedicated_access,
+                          self.database)
+
+    def testPgbouncer(self):
+        factory = self.factory(pgbouncer=True)
+        self.assertTrue(factory.pgbouncer)
+        engine = factory.engine(self.database)
+        self.assertTrue(isinstance(engine.pool, NullPool))
+        self.assertEquals(engine.execute("SELECT 1").scalar(), 1)
+        # The pooler limits server connections, not the factory
+        self.assertEquals(factory.workers_within(engine, 10 ** 6),
+                          10 ** 6)
+
+    def testPgbouncerSetting(self):
+        self.assertTrue(self.factory(pgbouncer='yes').pgbouncer)
+        self.assertFalse(self.factory(pgbouncer='false').pgbouncer)
+
+    def testWorkersWithin(self):
+        factory = self.factory(pool_size=2, max_overflow=1)
+        engine = factory.engine(self.database)
+        self.assertEquals(factory.workers_within(engine, 1), 1)
+        spare = engine.execute("""SELECT
+          current_setting('max_connections')::integer -
+          current_setting('superuser_reserved_connections')::integer -
+          (SELECT count(*) FROM pg_stat_activity)""").scalar()
+        fit = factory.workers_within(engine, 10 ** 6, databases=2,
+                                     reserve=0)
+        self.assertTrue(1 <= fit < 10 ** 6)
+        self.assertTrue(fit == 1 or fit * factory.per_process * 2 <= spare)
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
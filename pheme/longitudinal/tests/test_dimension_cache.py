@@ -0,0 +1,73 @@
+import unittest
+from multiprocessing import Process
+
+from pheme.longitudinal.dimension_cache import SharedDimensionCache
+
+
+def publisher(cache, start):  # pragma: no cover (out of process)
+    """Target publishing a range of entries from a child process"""
+    for i in range(start, start + 50):
+        cache.publish('dim_location', str(i), i)
+
+
+def die_writing(cache):  # pragma: no cover (out of process)
+    """Target dying while holding the cache's lock"""
+    cache._lock.acquire()
+
+
+class TestSharedDimensionCache(unittest.TestCase):
+    """Test the shared memory dimension cache"""
+    def setUp(self):
+        self.cache = SharedDimensionCache(slots=512)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def testMiss(self):
+        self.assertEquals(self.cache.lookup('dim_race', 'white'), None)
+
+    def testPublish(self):
+        self.cache.publish('dim_race', 'white', 12)
+        self.assertEquals(self.cache.lookup('dim_race', 'white'), 12)
+        # Key includes the table
+        self.assertEquals(self.cache.lookup('dim_cc', 'white'), None)
+
+    def testFirstPublishWins(self):
+        self.cache.publish('dim_race', 'white', 12)
+        self.cache.publish('dim_race', 'white', 13)
+        self.assertEquals(self.cache.lookup('dim_race', 'white'), 12)
+
+    def testNonIntegerIgnored(self):
+        self.cache.publish('dim_pregnancy', 'Y', 'Y')
+        self.assertEquals(self.cache.lookup('dim_pregnancy', 'Y'), None)
+
+    def testFull(self):
+        cache = SharedDimensionCache(slots=4)
+        for i in range(8):
+            cache.publish('dim_cc', str(i), i)
+        found = [cache.lookup('dim_cc', str(i)) for i in range(8)]
+        self.assertEquals(len([f for f in found if f is not None]), 4)
+        cache.close()
+
+    def testDeadWriter(self):
+        writer = Process(target=die_writing, args=(self.cache,))
+        writer.start()
+        writer.join()
+        self.assertFalse(self.cache.release_if_held_by(writer.pid + 1))
+        self.assertTrue(self.cache.release_if_held_by(writer.pid))
+        # Writers are no longer blocked
+        self.cache.publish('dim_race', 'white', 12)
+        self.assertEquals(self.cache.lookup('dim_race', 'white'), 12)
+
+    def testAcrossProcesses(self):
+        procs = [Process(target=publisher, args=(self.cache, start))
+                 for start in (1, 51, 101)]
+        [p.start() for p in procs]
+        [p.join() for p in procs]
+        for i in range(1, 151):
+            self.assertEquals(self.cache.lookup('dim_location', str(i)),
+                              i)
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
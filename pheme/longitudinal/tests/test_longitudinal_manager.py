@@ -0,0 +1,368 @@
+from datetime import date
+from multiprocessing import Process
+import os
+from Queue import Queue
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from pheme.longitudinal.longitudinal_manager import LongitudinalManager
+from pheme.longitudinal.scheduling import CoalescingScheduler
+from pheme.longitudinal.select_or_insert import TrackedLock
+from pheme.util.config import Config
+
+
+class PendingManager(LongitudinalManager):
+    """Manager with its pending visits given, rather than queried"""
+    def __init__(self, pending):
+        super(PendingManager, self).__init__()
+        self.pending = pending
+
+    def _pendingCounts(self, visit_ids=None):
+        return [(visit_id, count) for visit_id, count in
+                sorted(self.pending.items()) if visit_ids is None or
+                visit_id in visit_ids]
+
+
+class CoalesceTest(unittest.TestCase):
+    """Held visits are dropped once no longer pending"""
+    def setUp(self):
+        self.manager = PendingManager({'v1': 1, 'v2': 1, 'v3': 1})
+        self.scheduler = CoalescingScheduler(quiet=3600, max_delay=3600)
+        self.manager._coalesce(self.scheduler, None, now=0)
+        self.assertEquals(len(self.scheduler), 3)
+
+    def testFullDiscovery(self):
+        # v1 finished elsewhere, i.e. by bulk backfill
+        del self.manager.pending['v1']
+        self.assertEquals(self.manager._coalesce(self.scheduler, None,
+                                                 now=10), [])
+        self.assertEquals(sorted(self.scheduler), ['v2', 'v3'])
+
+    def testNotified(self):
+        # Only the notified visits are judged
+        del self.manager.pending['v1']
+        del self.manager.pending['v2']
+        self.manager._coalesce(self.scheduler, set(['v1']), now=10)
+        self.assertEquals(sorted(self.scheduler), ['v2', 'v3'])
+
+
+def stall(queue, table_locks, slot):  # pragma: no cover (out of process)
+    """Worker stand-in, hangs on its visit holding a table lock"""
+    visit_id = queue.get()
+    table_locks['location_lock'].acquire()
+    slot.start(visit_id)
+    time.sleep(3600)
+
+
+class RecordingLock(TrackedLock):
+    """TrackedLock noting the dead holders it was released for"""
+    def __init__(self):
+        super(RecordingLock, self).__init__()
+        self.released_for = []
+
+    def release_if_held_by(self, pid):
+        released = super(RecordingLock, self).release_if_held_by(pid)
+        if released:
+            self.released_for.append(pid)
+        return released
+
+
+class StallingManager(LongitudinalManager):
+    """Manager launching workers that hang on their first visit"""
+    def _new_table_locks(self):
+        return {'location_lock': RecordingLock()}
+
+    def _launch_worker(self, procNumber, table_locks, slot=None):
+        worker = Process(target=stall, args=(self.queue, table_locks, slot))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+
+class SuperviseTest(unittest.TestCase):
+    """Hung workers are killed, their locks freed and visit requeued"""
+    def setUp(self):
+        self.manager = StallingManager()
+        self.manager.NUM_PROCS = 1
+        self.manager.visit_timeout = 1
+        self.manager._launch_workers()
+        self.lock = self.manager._table_locks['location_lock']
+
+    def tearDown(self):
+        for worker, slot in self.manager._workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGKILL)
+                worker.join()
+
+    def stalled(self):
+        """Wait for the worker to stall on a visit past the timeout"""
+        worker, slot = self.manager._workers[0]
+        deadline = time.time() + 30
+        while slot.visit_id is None:
+            self.assertTrue(time.time() < deadline, "visit not started")
+            time.sleep(0.1)
+        time.sleep(self.manager.visit_timeout + 0.5)
+        return worker, slot
+
+    def testKillAndRequeue(self):
+        self.manager.queue.put('v1')
+        worker, slot = self.stalled()
+        self.assertEquals(slot.visit_id, 'v1')
+        self.manager._supervise()
+        self.assertEquals(worker.exitcode, -signal.SIGKILL)
+        self.assertEquals(self.lock.released_for, [worker.pid])
+
+        # The replacement picks up the requeued visit, and hangs too
+        replacement, slot = self.stalled()
+        self.assertNotEquals(replacement.pid, worker.pid)
+        self.assertEquals(slot.visit_id, 'v1')
+        self.assertTrue(self.manager.done_queue.empty())
+
+        # Beyond MAX_RETRIES the visit is given up on, reported done
+        self.manager._supervise()
+        self.assertEquals(replacement.exitcode, -signal.SIGKILL)
+        self.assertEquals(self.lock.released_for,
+                          [worker.pid, replacement.pid])
+        self.assertEquals(self.manager.done_queue.get(timeout=5), 'v1')
+        self.assertTrue(self.manager.queue.empty())
+
+    def testWithinTimeout(self):
+        self.manager.queue.put('v1')
+        worker, slot = self.stalled()
+        self.manager.visit_timeout = 3600
+        self.manager._supervise()
+        self.assertTrue(worker.is_alive())
+        self.assertEquals(self.manager._workers[0][0], worker)
+        self.assertEquals(self.lock.released_for, [])
+
+
+class RangeManager(LongitudinalManager):
+    """Manager whose workers finish visits as soon as they're fed
+
+    Stops, as on SIGTERM, once `interrupt_after` visits are done.
+
+    """
+    FEED_AHEAD = 2
+
+    def __init__(self, pending, tmp_dir, interrupt_after=None,
+                 failing=()):
+        super(RangeManager, self).__init__()
+        self.pending = pending
+        self.interrupt_after = interrupt_after
+        self.failing = failing
+        self.discovered = []
+        self.processed = []
+        self.queue = Queue()
+        self.NUM_PROCS = 1
+        self.active_shards = 1
+        self.range_start = min(pending)
+        self.range_end = max(pending)
+        self.checkpoint_file = os.path.join(tmp_dir, 'checkpoint')
+        self.progress_file = os.path.join(tmp_dir, 'progress')
+
+    def _prep(self):
+        pass
+
+    def _visitsToProcess(self, day=None):
+        self.discovered.append(day)
+        return list(self.pending[day])
+
+    def _pendingCounts(self, visit_ids=None):
+        return [(visit_id, 1) for visits in self.pending.values()
+                for visit_id in visits if visit_id in visit_ids]
+
+    def _launch_workers(self):
+        self._workers = []
+
+    def _disconnect(self):
+        pass
+
+    def _reap(self):
+        done = []
+        while not self.queue.empty():
+            visit_id = self.queue.get()
+            for visits in self.pending.values():
+                if visit_id in visits and visit_id not in self.failing:
+                    visits.remove(visit_id)
+            self.processed.append(visit_id)
+            done.append(visit_id)
+            if len(self.processed) == self.interrupt_after:
+                self._handle_signal(signal.SIGTERM, None)
+                break
+        return done
+
+
+class ResumeTest(unittest.TestCase):
+    """Interrupted runs pick up where they left off"""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.days = [date(2013, 1, 1), date(2013, 1, 2), date(2013, 1, 3)]
+        self.pending = {self.days[0]: ['a1', 'a2'],
+                        self.days[1]: ['b1', 'b2', 'b3'],
+                        self.days[2]: ['c1']}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testTmpDir(self):
+        tmp_dir = Config().get('general', 'tmp_dir', default='/tmp')
+        manager = LongitudinalManager()
+        for path in (manager.checkpoint_file, manager.progress_file):
+            self.assertEquals(os.path.dirname(path), tmp_dir)
+
+    def testRangeResume(self):
+        manager = RangeManager(self.pending, self.tmp_dir,
+                               interrupt_after=3)
+        manager._run_range()
+        self.assertTrue(manager._stopping)
+        # The day in progress finished its visits in flight
+        self.assertEquals(manager.discovered, self.days[:2])
+        self.assertEquals(manager._load_progress(), set([str(
+            self.days[0])]))
+        self.assertEquals(self.pending[self.days[0]], [])
+        interrupted = manager.processed
+
+        manager = RangeManager(self.pending, self.tmp_dir)
+        manager._run_range()
+        self.assertFalse(manager._stopping)
+        # The finished day isn't rediscovered
+        self.assertEquals(manager.discovered, self.days[1:])
+        self.assertEquals(sorted(interrupted + manager.processed),
+                          ['a1', 'a2', 'b1', 'b2', 'b3', 'c1'])
+        self.assertFalse(os.path.exists(manager.progress_file))
+
+    def testFailingVisit(self):
+        manager = RangeManager(self.pending, self.tmp_dir,
+                               failing=set(['b2']))
+        manager._run_range()
+        # The day with a failing visit isn't recorded as done
+        self.assertEquals(manager._load_progress(),
+                          set([str(self.days[0]), str(self.days[2])]))
+
+        manager = RangeManager(self.pending, self.tmp_dir)
+        manager._run_range()
+        self.assertEquals(manager.discovered, self.days[1:2])
+        self.assertEquals(manager.processed, ['b2'])
+        self.assertFalse(os.path.exists(manager.progress_file))
+
+    def testRangeFailure(self):
+        manager = RangeManager(self.pending, self.tmp_dir)
+
+        def lost_connection():
+            raise RuntimeError("connection lost")
+        manager._reap = lost_connection
+        self.assertRaises(RuntimeError, manager._run_range)
+        # The workers were told to stop all the same
+        self.assertTrue(manager.stop.is_set())
+
+    def testRangeProgressOtherRange(self):
+        manager = RangeManager(self.pending, self.tmp_dir)
+        manager.range_end = self.days[1]
+        manager._save_progress(set([str(self.days[0])]))
+        manager = RangeManager(self.pending, self.tmp_dir)
+        self.assertEquals(manager._load_progress(), set())
+
+    def testCheckpoint(self):
+        manager = RangeManager(self.pending, self.tmp_dir)
+        manager._save_checkpoint(['b2', 'b3'])
+        manager.reportDate = self.days[0]
+        self.assertEquals(manager._load_checkpoint(), None)
+        manager.reportDate = None
+        self.assertEquals(manager._load_checkpoint(), ['b2', 'b3'])
+        # Consumed by the resumed run
+        self.assertEquals(manager._load_checkpoint(), None)
+
+
+class UrgentManager(LongitudinalManager):
+    """Manager whose urgent visits stay pending, as if failing"""
+    PRIORITY_REFRESH_SECONDS = 0
+
+    def __init__(self, urgent):
+        super(UrgentManager, self).__init__()
+        self.urgent = urgent
+        self.processed = []
+        self.queue = Queue()
+        self.NUM_PROCS = 2
+        self.priority_workers = 1
+        self.skip_prep = True
+
+    def _urgentVisits(self):
+        return list(self.urgent)
+
+    def _reap(self):
+        done = []
+        while not self.queue.empty():
+            done.append(self.queue.get())
+        self.processed.extend(done)
+        return done
+
+
+class DispatchTest(unittest.TestCase):
+    """Failing urgent visits aren't fed on every refresh"""
+    def testFailingUrgent(self):
+        manager = UrgentManager(['bad'])
+        self.assertEquals(manager._dispatch(['b1', 'b2']), [])
+        self.assertEquals(manager.processed.count('bad'),
+                          1 + manager.MAX_RETRIES)
+        self.assertEquals(sorted(set(manager.processed)),
+                          ['b1', 'b2', 'bad'])
+
+
+class FlakyManager(LongitudinalManager):
+    """Daemon whose first `failures` cycles lose their connection"""
+    BACKOFF_SECONDS = 0
+
+    def __init__(self, failures):
+        super(FlakyManager, self).__init__()
+        self.failures = failures
+        self.cycles = 0
+        self.reconnects = 0
+        self.daemon_interval = 0
+
+    def _launch_workers(self):
+        self._workers = []
+
+    def _reconnect(self, listener):
+        self.reconnects += 1
+        return listener
+
+    def _prep(self):
+        self.cycles += 1
+        if self.cycles <= self.failures:
+            raise RuntimeError("connection lost")
+
+    def _visitsToProcess(self, day=None):
+        # Stop once a cycle gets this far
+        self._stopping = True
+        return []
+
+    def _dispatch(self, visits_to_process):
+        return []
+
+
+class DaemonTest(unittest.TestCase):
+    """A failed cycle doesn't end the daemon"""
+    def testRecovers(self):
+        manager = FlakyManager(failures=2)
+        manager._run_daemon()
+        self.assertEquals(manager.cycles, 3)
+        self.assertEquals(manager.reconnects, 2)
+        self.assertTrue(manager.stop.is_set())
+
+    def testStoppedWhileFailing(self):
+        manager = FlakyManager(failures=1)
+
+        def stopping_prep():
+            manager._stopping = True
+            raise RuntimeError("connection lost")
+        manager._prep = stopping_prep
+        manager._run_daemon()
+        self.assertEquals(manager.reconnects, 0)
+        self.assertTrue(manager.stop.is_set())
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from pheme.longitudinal.notify import VisitListener
+from pheme.util.config import configure_logging
+from pheme.util.pg_access import db_connection
+
+CONFIG_SECTION = 'longitudinal'
+
+
+def setup_module():
+    configure_logging(verbosity=2, logfile='unittest.log')
+
+
+class TestVisitListener(unittest.TestCase):
+    """Collect visit_id notifications"""
+    def setUp(self):
+        self.conn = db_connection(CONFIG_SECTION)
+        self.listener = VisitListener(self.conn.engine, 'test_visits',
+                                      debounce=0.1)
+
+    def tearDown(self):
+        self.listener.close()
+        self.conn.disconnect()
+
+    def notify(self, visit_id):
+        self.conn.engine.execute("SELECT pg_notify('test_visits', '%s')" %
+                                 visit_id)
+
+    def testTimeout(self):
+        self.assertEquals(self.listener.wait(0.1), set())
+
+    def testMicroBatch(self):
+        for visit_id in ('v1', 'v2', 'v1'):
+            self.notify(visit_id)
+        self.assertEquals(self.listener.wait(1), set(('v1', 'v2')))
+        self.assertEquals(self.listener.wait(0.1), set())
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -2,14 +2,21 @@
 """ Test region reports w/o loading any static data in db.
 """
 
+import datetime
+from multiprocessing import Pool
 import os
 import unittest
 
 from pheme.util.config import Config, configure_logging
 from pheme.util.pg_access import db_connection, db_params
 from pheme.longitudinal.generate_daily_essence_report import GenerateReport
+from pheme.longitudinal.generate_daily_essence_report import MultiReport
 from pheme.longitudinal.generate_daily_essence_report import ReportCriteria
+from pheme.longitudinal.generate_daily_essence_report import \
+    _generate_report
 from pheme.longitudinal.tables import Facility, ReportableRegion, Visit
+from pheme.longitudinal.tables import ChiefComplaint, Diagnosis
+from pheme.longitudinal.tables import VisitDiagnosisAssociation
 from pheme.longitudinal.tables import create_tables
 
 CONFIG_SECTION = 'longitudinal'
@@ -129,3 +136,263 @@ class GenerateRegionReportTest(unittest.TestCase):
         lines = results.readlines()
         self.assertEqual(len(lines), 2)
         self.assertTrue('45' in lines[1])
+
+
+class MultiReportTest(unittest.TestCase):
+    """Several reports generated in a single pass"""
+    def setUp(self):
+        self.conn = db_connection(CONFIG_SECTION)
+        self.params = db_params(CONFIG_SECTION)
+        self.criteria = [self.region_criteria(patient_class)
+                         for patient_class in (None, 'E', 'I')]
+
+    def tearDown(self):
+        self.conn.disconnect()
+
+    def region_criteria(self, patient_class, date="2009-01-02"):
+        criteria = ReportCriteria()
+        criteria.database = self.params['database']
+        criteria.start_date = criteria.end_date = date
+        criteria.credentials(user=self.params['user'],
+                             password=self.params['password'])
+        criteria.reportable_region = 'test_region'
+        criteria.patient_class = patient_class
+        return criteria
+
+    def lines(self, report):
+        return open(report.output_filename, 'r').readlines()
+
+    def testMismatchedDates(self):
+        self.criteria[1] = self.region_criteria('E', date="2009-01-03")
+        self.assertRaises(ValueError, MultiReport,
+                          user=self.params['user'],
+                          password=self.params['password'],
+                          report_criteria=self.criteria)
+
+    def testFanOut(self):
+        visits = []
+        for pk, facility, patient_class in ((3, 10987, u'E'),
+                                            (4, 10987, u'I'),
+                                            (5, 65432, u'E')):
+            visits.append(Visit(pk=pk,
+                                visit_id=u'%d' % (pk + 44),
+                                patient_id=u'patient id',
+                                dim_facility_pk=facility,
+                                zip=u'zip',
+                                admit_datetime='2009-01-02',
+                                gender=u'F',
+                                dob=u'200101',
+                                chief_complaint=u'Loves Testing',
+                                patient_class=patient_class,
+                                disposition='01',
+                                first_message='2010-10-10',
+                                last_message='2010-10-10',))
+        self.conn.session.add_all(visits)
+        self.conn.session.commit()
+
+        report = MultiReport(user=self.params['user'],
+                             password=self.params['password'],
+                             report_criteria=self.criteria)
+        try:
+            report.execute()
+            region, emergency, inpatient = report.reports
+            self.assertEqual(len(self.lines(region)), 3)
+            lines = self.lines(emergency)
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(emergency._header(), lines[0].rstrip())
+            self.assertTrue('47' in lines[1])
+            self.assertEqual(len(lines[1].split('|')),
+                             len(region.columns) - 1)
+            lines = self.lines(inpatient)
+            self.assertEqual(len(lines), 2)
+            self.assertTrue('48' in lines[1])
+        finally:
+            report.tearDown()
+            for each in report.reports:
+                os.remove(each.output_filename)
+
+
+class ExportReportTest(unittest.TestCase):
+    """The COPY export writes the very same report"""
+    def setUp(self):
+        self.conn = db_connection(CONFIG_SECTION)
+        self.params = db_params(CONFIG_SECTION)
+
+    def tearDown(self):
+        self.conn.disconnect()
+
+    def generate(self, **kwargs):
+        criteria = ReportCriteria()
+        criteria.database = self.params['database']
+        criteria.start_date = criteria.end_date = "2009-01-03"
+        criteria.credentials(user=self.params['user'],
+                             password=self.params['password'])
+        criteria.reportable_region = 'test_region'
+        report = GenerateReport(user=self.params['user'],
+                                password=self.params['password'],
+                                report_criteria=criteria, **kwargs)
+        try:
+            report.execute()
+            return open(report.output_filename, 'r').read()
+        finally:
+            report.tearDown()
+            os.remove(report.output_filename)
+
+    def testByteIdentical(self):
+        session = self.conn.session
+        # Characters COPY's text format would escape
+        session.add(ChiefComplaint(pk=1, chief_complaint='back\\slash '
+                                   '"quoted"\tand\nnewline'))
+        session.add_all([Diagnosis(pk=1, icd9='487.1'),
+                         Diagnosis(pk=2, icd9='780.6')])
+        for pk in (6, 7):
+            session.add(Visit(pk=pk,
+                              visit_id=u'%d' % (pk + 44),
+                              patient_id=u'patient id',
+                              dim_facility_pk=10987,
+                              dim_cc_pk=pk == 6 and 1 or None,
+                              admit_datetime='2009-01-03',
+                              gender=u'F',
+                              patient_class=u'E',
+                              first_message='2010-10-10',
+                              last_message='2010-10-10',))
+        session.commit()
+        # The most recent 487.1 ranks behind 780.6
+        for dx, status, rank, hour in ((1, 'A', 1, 1), (1, 'F', 2, 2),
+                                       (2, 'F', 1, 3)):
+            session.add(VisitDiagnosisAssociation(
+                fact_visit_pk=6, dim_dx_pk=dx, status=status, rank=rank,
+                dx_datetime=datetime.datetime(2009, 1, 3, hour)))
+        session.commit()
+
+        merged = self.generate()
+        self.assertEqual(len(merged.splitlines()), 4)  # newline in cc
+        self.assertTrue('|780.6 487.1|' in merged)
+        self.assertEqual(self.generate(sql_diagnosis=True), merged)
+
+
+class ParallelReportTest(unittest.TestCase):
+    """Reports generated by the --parallel pool match the serial run"""
+    def setUp(self):
+        self.conn = db_connection(CONFIG_SECTION)
+        self.params = db_params(CONFIG_SECTION)
+
+    def tearDown(self):
+        self.conn.disconnect()
+
+    def region_criteria(self, patient_class):
+        criteria = ReportCriteria()
+        criteria.database = self.params['database']
+        criteria.start_date = criteria.end_date = "2009-01-04"
+        criteria.credentials(user=self.params['user'],
+                             password=self.params['password'])
+        criteria.reportable_region = 'test_region'
+        criteria.patient_class = patient_class
+        return criteria
+
+    def read(self, filename):
+        try:
+            return open(filename, 'r').read()
+        finally:
+            os.remove(filename)
+
+    def testByteIdentical(self):
+        visits = []
+        for pk, patient_class, gender in ((8, u'E', u'F'),
+                                          (9, u'I', None),
+                                          (10, u'E', u'M')):
+            visits.append(Visit(pk=pk,
+                                visit_id=u'%d' % (pk + 44),
+                                patient_id=u'patient id',
+                                dim_facility_pk=10987,
+                                admit_datetime='2009-01-04',
+                                gender=gender,
+                                patient_class=patient_class,
+                                first_message='2010-10-10',
+                                last_message='2010-10-10',))
+        self.conn.session.add_all(visits)
+        self.conn.session.commit()
+
+        criteria = [self.region_criteria(patient_class)
+                    for patient_class in (None, 'E', 'I')]
+        report = MultiReport(user=self.params['user'],
+                             password=self.params['password'],
+                             report_criteria=criteria)
+        try:
+            report.execute()
+        finally:
+            report.tearDown()
+        serial = dict((each.criteria.report_method,
+                       (each.output_filename,
+                        self.read(each.output_filename)))
+                      for each in report.reports)
+
+        # The jobs as ReportCommandLineInterface._execute_parallel
+        # builds them
+        jobs = [{'criteria': dict(each._crit),
+                 'user': self.params['user'],
+                 'password': self.params['password'],
+                 'sql_diagnosis': False,
+                 'essence_flat': False,
+                 'compress': False,
+                 'part_size': None,
+                 'save_report': False,
+                 'transmit_report': False,
+                 'transmit_differences': False}
+                for each in criteria]
+        pool = Pool(len(jobs))
+        try:
+            results = pool.map(_generate_report, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(sorted(results),
+                         sorted((method, None) for method in serial))
+        # Header and visits: all three, the two E and the one I
+        lines = dict(zip([each.report_method for each in criteria],
+                         (4, 3, 2)))
+        for method, (filename, content) in serial.items():
+            self.assertEqual(len(content.splitlines()), lines[method])
+            self.assertEqual(self.read(filename), content,
+                             "%s differs" % method)
+
+
+class IncludeUpdatesPlanTest(unittest.TestCase):
+    """The include updates selection is index backed"""
+    def setUp(self):
+        params = db_params(CONFIG_SECTION)
+        self.criteria = ReportCriteria()
+        self.criteria.database = params['database']
+        self.criteria.start_date = self.criteria.end_date = "2009-01-04"
+        self.criteria.credentials(user=params['user'],
+                                  password=params['password'])
+        self.criteria.include_updates = True
+
+    def plan(self):
+        report = GenerateReport(user=self.criteria.user,
+                                password=self.criteria.password,
+                                report_criteria=self.criteria)
+        try:
+            report._getConn()
+            # The test tables are tiny, a sequential scan would win
+            report.access.raw_query("SET enable_seqscan = off")
+            updates = report._reportable_visits()[1]
+            return '\n'.join(row[0] for row in report.access.raw_query(
+                "EXPLAIN %s" % updates).fetchall())
+        finally:
+            report.access.raw_query("RESET enable_seqscan")
+            report.tearDown()
+            os.remove(report.output_filename)
+
+    def assertIndexed(self, plan):
+        # Either composite index serves, depending on the join order
+        self.assertTrue('ix_fact_visit_facility_admit' in plan or
+                        'ix_fact_visit_updated_admit' in plan, plan)
+        self.assertFalse('Seq Scan on fact_visit' in plan, plan)
+
+    def testStatewide(self):
+        self.assertIndexed(self.plan())
+
+    def testRegion(self):
+        self.criteria.reportable_region = 'test_region'
+        self.assertIndexed(self.plan())
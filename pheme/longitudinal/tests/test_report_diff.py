@@ -0,0 +1,77 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from pheme.longitudinal.report_diff import ReportDiff
+
+
+class TestReportDiff(unittest.TestCase):
+    """Only new and changed rows, in bounded memory"""
+    header = 'Hosp|Visit Record No.|Service Area\n'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def report(self, name, rows, header=None):
+        filename = os.path.join(self.tmp_dir, name)
+        if name.endswith('.gz'):
+            report = gzip.open(filename, 'wb')
+        else:
+            report = open(filename, 'wb')
+        report.write(header or self.header)
+        report.writelines(rows)
+        report.close()
+        return filename
+
+    def diff(self, old_files, new_files, partitions=None):
+        out = StringIO()
+        written = ReportDiff(old_files, new_files, key_columns=(1, 2),
+                             partitions=partitions,
+                             tmp_dir=self.tmp_dir).write(out)
+        lines = out.getvalue().splitlines(True)
+        self.assertEquals(lines[0], self.header)
+        self.assertEquals(written, len(lines) - 1)
+        return sorted(lines[1:])
+
+    def testNewAndChanged(self):
+        old = self.report('old.txt', ['H1|v1|E\n', 'H1|v2|E\n',
+                                      'H1|v3|E\n'])
+        new = self.report('new.txt', ['H1|v1|E\n', 'H2|v2|E\n',
+                                      'H1|v4|E\n', 'H1|v1|I\n'])
+        for partitions in (1, 3):
+            self.assertEquals(self.diff([old], [new], partitions),
+                              ['H1|v1|I\n', 'H1|v4|E\n', 'H2|v2|E\n'])
+        self.assertEquals(sorted(os.listdir(self.tmp_dir)),
+                          ['new.txt', 'old.txt'])
+
+    def testUnchanged(self):
+        rows = ['H1|v%d|E\n' % i for i in range(50)]
+        old = self.report('old.txt', rows)
+        new = self.report('new.txt', list(reversed(rows)))
+        self.assertEquals(self.diff([old], [new], partitions=7), [])
+
+    def testCompressedParts(self):
+        old = self.report('old.txt.gz', ['H1|v1|E\n', 'H1|v2|E\n'])
+        new = [self.report('new-part001.txt.gz', ['H1|v1|E\n']),
+               self.report('new-part002.txt.gz', ['H1|v2|O\n'])]
+        self.assertEquals(self.diff([old], new), ['H1|v2|O\n'])
+
+    def testDefaultPartitions(self):
+        old = self.report('old.txt', [])
+        diff = ReportDiff([old], [old], key_columns=(1,))
+        self.assertEquals(diff.partitions, 1)
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, ReportDiff, [], ['new.txt'], (1,))
+        old = self.report('old.txt', [])
+        self.assertRaises(ValueError, ReportDiff, [old], [old], (1,), 0)
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
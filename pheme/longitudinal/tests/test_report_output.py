@@ -0,0 +1,91 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from pheme.longitudinal.report_output import ReportOutput
+
+
+class TestReportOutput(unittest.TestCase):
+    """Compressed and split report files"""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, 'report.txt')
+        self.lines = ['Hosp|Reg Date\n'] + \
+            ['hospital %02d|01/01/2009\n' % i for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, name):
+        if name.endswith('.gz'):
+            return gzip.open(name).read()
+        return open(name).read()
+
+    def testPlain(self):
+        output = ReportOutput(self.filepath)
+        print >> output, self.lines[0].rstrip()
+        output.write(''.join(self.lines[1:]))
+        output.close()
+        self.assertEquals(output.names, [self.filepath])
+        self.assertEquals(self.read(output.name), ''.join(self.lines))
+
+    def testCompressed(self):
+        output = ReportOutput(self.filepath, compress=True)
+        output.write(''.join(self.lines))
+        output.close()
+        self.assertEquals(output.name, self.filepath + '.gz')
+        self.assertEquals(self.read(output.name), ''.join(self.lines))
+
+    def testParts(self):
+        output = ReportOutput(self.filepath, part_size=100)
+        # Chunks ending mid line, as written by COPY
+        data = ''.join(self.lines)
+        for start in range(0, len(data), 30):
+            output.write(data[start:start + 30])
+        output.close()
+        self.assertTrue(len(output.names) > 1)
+        self.assertEquals(output.name,
+                          os.path.join(self.tmp_dir, 'report-part001.txt'))
+        rows = []
+        for name in output.names:
+            part = self.read(name)
+            self.assertTrue(len(part) <= 100)
+            lines = part.splitlines(True)
+            self.assertEquals(lines[0], self.lines[0])
+            rows.extend(lines[1:])
+        self.assertEquals(rows, self.lines[1:])
+
+    def testCompressedParts(self):
+        output = ReportOutput(self.filepath, compress=True, part_size=200)
+        for line in self.lines:
+            output.write(line)
+        output.close()
+        self.assertTrue(output.name.endswith('report-part001.txt.gz'))
+        rows = []
+        for name in output.names:
+            lines = self.read(name).splitlines(True)
+            self.assertEquals(lines[0], self.lines[0])
+            rows.extend(lines[1:])
+        self.assertEquals(rows, self.lines[1:])
+
+    def testUnterminated(self):
+        output = ReportOutput(self.filepath, part_size=1000)
+        output.write('header\nlast line')
+        output.close()
+        self.assertEquals(self.read(output.name), 'header\nlast line')
+
+    def testEmpty(self):
+        output = ReportOutput(self.filepath, compress=True)
+        self.assertEquals(output.name, self.filepath + '.gz')
+        output.close()
+        self.assertEquals(self.read(output.name), '')
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, ReportOutput, self.filepath,
+                          part_size=0)
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,79 @@
+import datetime
+import unittest
+
+from pheme.longitudinal.generate_daily_essence_report import GenerateReport
+from pheme.longitudinal.generate_daily_essence_report import RowFormatter
+from pheme.longitudinal.generate_daily_essence_report import strSansNone
+
+DIAGNOSIS = GenerateReport.diagnosis_column_index
+PATIENT_CLASS = GenerateReport.patient_class_column_index
+
+
+def per_row(row, diagnosis, vitals=()):
+    """The line as formerly written, one join of str() values per row"""
+    return '|'.join([strSansNone(column) for column in row[:DIAGNOSIS]] +
+                    [diagnosis] +
+                    [strSansNone(column) for column in
+                     row[DIAGNOSIS + 1:]] +
+                    list(vitals)) + '\n'
+
+
+class TestRowFormatter(unittest.TestCase):
+    """Compiled formatting matches the former per row formatting"""
+    def setUp(self):
+        self.columns = GenerateReport.columns
+        self.row = [u'RMC', datetime.date(2009, 1, 2),
+                    datetime.time(13, 45, 7), u'F', 42, u'COUGH',
+                    u'98101', 1234, u'01', u'patient id', u'visit id',
+                    u'E']
+        self.assertEquals(len(self.row), len(self.columns))
+
+    def assertSame(self, columns, row, diagnosis, vitals=()):
+        formatter = RowFormatter(columns, DIAGNOSIS, vitals=bool(vitals))
+        self.assertEquals(formatter.format(row, diagnosis, vitals),
+                          per_row(row, diagnosis, vitals))
+
+    def testValues(self):
+        self.assertSame(self.columns, self.row, '487.1 780.6')
+
+    def testNone(self):
+        for i in range(len(self.row)):
+            if i != DIAGNOSIS:
+                self.row[i] = None
+        self.assertSame(self.columns, self.row, '')
+        line = RowFormatter(self.columns, DIAGNOSIS).format(self.row, '')
+        self.assertEquals(line, '|' * (len(self.columns) - 1) + '\n')
+
+    def testDates(self):
+        self.row[1] = datetime.date(2009, 12, 31)
+        self.row[2] = datetime.time(23, 59, 59, 999)
+        self.row[DIAGNOSIS + 1] = datetime.datetime(2010, 1, 1, 0, 5)
+        self.assertSame(self.columns, self.row, '780.6')
+        self.assertTrue(RowFormatter(self.columns, DIAGNOSIS).format(
+            self.row, '780.6').startswith(
+                'RMC|2009-12-31|23:59:59.000999|'))
+
+    def testPatientClassRemoved(self):
+        # As for a report limited to a patient_class
+        columns = self.columns[:PATIENT_CLASS] + \
+            self.columns[PATIENT_CLASS + 1:]
+        del self.row[PATIENT_CLASS]
+        self.row[DIAGNOSIS + 1] = None
+        self.assertSame(columns, self.row, '487.1')
+
+    def testPatientClassOmitted(self):
+        # As for a report limited to a patient_class, of several
+        formatter = RowFormatter(self.columns, DIAGNOSIS,
+                                 omit=PATIENT_CLASS)
+        narrow = list(self.row)
+        del narrow[PATIENT_CLASS]
+        self.assertEquals(formatter.format(self.row, '487.1'),
+                          per_row(narrow, '487.1'))
+
+    def testVitals(self):
+        self.assertSame(self.columns, self.row, '487.1',
+                        vitals=['38.5', '', 'Y', 'N'])
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,165 @@
+import unittest
+
+from pheme.longitudinal.scheduling import CoalescingScheduler
+from pheme.longitudinal.scheduling import PriorityLanes, ShardFeeder
+
+
+class TestCoalescingScheduler(unittest.TestCase):
+    """Hold busy visits till quiet or held too long"""
+    def setUp(self):
+        self.scheduler = CoalescingScheduler(quiet=30, max_delay=120)
+
+    def testQuiet(self):
+        self.scheduler.observe('v1', 1, now=0)
+        self.assertEquals(self.scheduler.ready(now=29), [])
+        self.assertEquals(self.scheduler.ready(now=30), ['v1'])
+        self.assertFalse('v1' in self.scheduler)
+
+    def testActivityResetsQuiet(self):
+        self.scheduler.observe('v1', 1, now=0)
+        self.scheduler.observe('v1', 2, now=20)
+        self.assertEquals(self.scheduler.ready(now=30), [])
+        self.assertEquals(self.scheduler.ready(now=50), ['v1'])
+
+    def testUnchangedMarker(self):
+        self.scheduler.observe('v1', 1, now=0)
+        self.scheduler.observe('v1', 1, now=20)
+        self.assertEquals(self.scheduler.ready(now=30), ['v1'])
+
+    def testMaxDelay(self):
+        for now in range(0, 120, 10):
+            self.scheduler.observe('v1', now, now=now)
+        self.assertEquals(self.scheduler.ready(now=119), [])
+        self.assertEquals(self.scheduler.ready(now=120), ['v1'])
+
+    def testOrder(self):
+        self.scheduler.observe('v2', 1, now=5)
+        self.scheduler.observe('v1', 1, now=0)
+        self.scheduler.observe('v3', 1, now=50)
+        self.assertEquals(self.scheduler.ready(now=40), ['v1', 'v2'])
+        self.assertEquals(len(self.scheduler), 1)
+
+    def testForget(self):
+        self.scheduler.observe('v1', 1, now=0)
+        self.scheduler.forget('v1')
+        self.scheduler.forget('unknown')
+        self.assertEquals(self.scheduler.ready(now=200), [])
+
+    def testIter(self):
+        self.scheduler.observe('v1', 1, now=0)
+        self.scheduler.observe('v2', 1, now=0)
+        for visit_id in self.scheduler:
+            self.scheduler.forget(visit_id)
+        self.assertEquals(len(self.scheduler), 0)
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, CoalescingScheduler, 60, 30)
+
+
+class TestPriorityLanes(unittest.TestCase):
+    """Urgent visits overtake the backlog"""
+    def drain(self, lanes):
+        fed = []
+        while True:
+            visit_id = lanes.next()
+            if visit_id is None:
+                return fed
+            fed.append(visit_id)
+
+    def testUrgentFirst(self):
+        lanes = PriorityLanes()
+        lanes.add(['old1', 'old2'])
+        lanes.add(['new1'], urgent=True)
+        self.assertEquals(len(lanes), 3)
+        self.assertEquals(self.drain(lanes), ['new1', 'old1', 'old2'])
+        self.assertEquals(len(lanes), 0)
+
+    def testPromote(self):
+        lanes = PriorityLanes()
+        lanes.add(['v1', 'v2', 'v3'])
+        lanes.add(['v2'], urgent=True)
+        lanes.add(['v2', 'v3'])
+        self.assertEquals(lanes.remaining(), ['v2', 'v1', 'v3'])
+        self.assertEquals(self.drain(lanes), ['v2', 'v1', 'v3'])
+
+    def testBacklogLimit(self):
+        lanes = PriorityLanes(backlog_limit=2)
+        lanes.add(['old1', 'old2', 'old3'])
+        self.assertEquals(self.drain(lanes), ['old1', 'old2'])
+        lanes.add(['new1'], urgent=True)
+        self.assertEquals(self.drain(lanes), ['new1'])
+        lanes.done('new1')
+        self.assertEquals(lanes.next(), None)
+        lanes.done('old1')
+        self.assertEquals(self.drain(lanes), ['old3'])
+
+    def testReadd(self):
+        lanes = PriorityLanes()
+        lanes.add(['v1'])
+        self.assertEquals(self.drain(lanes), ['v1'])
+        lanes.add(['v1'], urgent=True)
+        self.assertEquals(self.drain(lanes), ['v1'])
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, PriorityLanes, 0)
+
+
+class TestShardFeeder(unittest.TestCase):
+    """Feed a few shards at a time, in turn"""
+    def setUp(self):
+        self.shards = {'d1': ['a', 'b', 'c'], 'd2': ['x', 'y'],
+                       'd3': ['m'], 'd4': []}
+        self.discovered = []
+
+    def discover(self, shard):
+        self.discovered.append(shard)
+        return self.shards[shard]
+
+    def drain(self, feeder):
+        fed = []
+        while True:
+            visit_id = feeder.next()
+            if visit_id is None:
+                return fed
+            fed.append(visit_id)
+
+    def testRoundRobin(self):
+        feeder = ShardFeeder(['d1', 'd2', 'd3'], self.discover, active=2)
+        self.assertEquals(self.drain(feeder), ['a', 'x', 'b', 'y', 'c'])
+        self.assertEquals(self.discovered, ['d1', 'd2'])
+        self.assertEquals(len(feeder), 5)
+
+    def testFinished(self):
+        feeder = ShardFeeder(['d2', 'd3'], self.discover, active=1)
+        self.drain(feeder)
+        feeder.done('x')
+        self.assertEquals(feeder.finished(), [])
+        feeder.done('y')
+        self.assertEquals(feeder.finished(), [('d2', 2)])
+        self.assertEquals(self.drain(feeder), ['m'])
+        feeder.done('m')
+        self.assertEquals(feeder.finished(), [('d3', 1)])
+        self.assertTrue(feeder.exhausted)
+
+    def testEmptyShard(self):
+        feeder = ShardFeeder(['d4', 'd3'], self.discover, active=1)
+        self.assertEquals(self.drain(feeder), ['m'])
+        self.assertEquals(feeder.finished(), [('d4', 0)])
+
+    def testDuplicateVisit(self):
+        self.shards['d3'] = ['a', 'm']
+        feeder = ShardFeeder(['d1', 'd3'], self.discover, active=2)
+        self.assertEquals(sorted(self.drain(feeder)),
+                          ['a', 'b', 'c', 'm'])
+        for visit_id in 'bcm':
+            feeder.done(visit_id)
+        self.assertEquals(feeder.finished(), [('d3', 1)])
+        feeder.done('a')
+        self.assertEquals(feeder.finished(), [('d1', 3)])
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, ShardFeeder, [], self.discover, 0)
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -2,8 +2,10 @@ import unittest
 from multiprocessing import Lock, Process
 
 from pheme.longitudinal.tables import create_tables
+from pheme.longitudinal.dimension_cache import SharedDimensionCache
 from pheme.longitudinal.tables import Pregnancy, Location
 from pheme.longitudinal.select_or_insert import SelectOrInsert
+from pheme.longitudinal.select_or_insert import TrackedLock
 from pheme.util.config import Config, configure_logging
 from pheme.util.pg_access import db_connection, db_params
 
@@ -76,14 +78,130 @@ class TestSelectOrCreate(unittest.TestCase):
         self.assertNotEquals(l3.pk, l4.pk)
 
 
-def process_hammer(proc_no, lock):  # pragma: no cover (out of process)
+class TestAdvisorySelectOrCreate(TestSelectOrCreate):
+    """Repeat select or create tests using per value advisory locks"""
+    def setUp(self):
+        self.conn = db_connection(CONFIG_SECTION)
+        self.s_or_i = SelectOrInsert(None, self.conn.session,
+                                     advisory_locks=True)
+        self.remove_after_test = []
+
+    def testValueKey(self):
+        l1 = Location(zip='98101')
+        l2 = Location(zip=u'98101')
+        l3 = Location(zip='98102')
+        self.assertEquals(self.s_or_i._value_key(l1),
+                          self.s_or_i._value_key(l2))
+        self.assertNotEquals(self.s_or_i._value_key(l1),
+                             self.s_or_i._value_key(l3))
+
+
+class TestCachedSelectOrCreate(TestSelectOrCreate):
+    """Repeat select or create tests with the cache enabled"""
+    def setUp(self):
+        self.conn = db_connection(CONFIG_SECTION)
+        self.shared_cache = SharedDimensionCache(slots=64)
+        self.s_or_i = SelectOrInsert(Lock(), self.conn.session,
+                                     cache_size=10,
+                                     shared_cache=self.shared_cache)
+        self.remove_after_test = []
+
+    def tearDown(self):
+        # Cache hits return transient objects with the pk set, which
+        # the session can't delete - delete their rows by pk instead
+        for obj in self.remove_after_test:
+            if obj.pk is not None:
+                self.conn.session.query(type(obj)).\
+                    filter_by(pk=obj.pk).delete()
+        self.conn.session.commit()
+        self.conn.disconnect()
+
+    def testCacheHit(self):
+        loc = Location(zip='98101')
+        self.remove_after_test.append(loc)
+        loc = self.s_or_i.fetch(loc)
+
+        # Hits return the given object, with the cached pk set
+        l2 = Location(zip='98101')
+        self.assertTrue(self.s_or_i.fetch(l2) is l2)
+        self.assertEquals(l2.pk, loc.pk)
+
+    def testLeastRecentlyUsedEvicted(self):
+        s_or_i = SelectOrInsert(Lock(), self.conn.session, cache_size=2)
+        a, b, c = [Location(zip=z) for z in ('98103', '98104', '98105')]
+        self.remove_after_test.extend((a, b, c))
+        map(s_or_i.fetch, (a, b))
+
+        # The hit on a leaves b the least recently used, evicted by c
+        self.assertTrue(s_or_i.cache_lookup(Location(zip='98103')))
+        s_or_i.fetch(c)
+        self.assertTrue(s_or_i.cache_lookup(Location(zip='98103')))
+        self.assertEquals(s_or_i.cache_lookup(Location(zip='98104')),
+                          None)
+
+    def testSharedCacheHit(self):
+        loc = Location(zip='98102')
+        self.remove_after_test.append(loc)
+        loc = self.s_or_i.fetch(loc)
+
+        # Another worker's SelectOrInsert finds it in the shared cache
+        other = SelectOrInsert(None, None, shared_cache=self.shared_cache)
+        l2 = Location(zip='98102')
+        self.assertEquals(other.fetch(l2).pk, loc.pk)
+
+    def testPreload(self):
+        preg = Pregnancy(result='Patient Not Pregnant')
+        self.remove_after_test.append(preg)
+        self.conn.session.add(preg)
+        self.conn.session.commit()
+
+        s_or_i = SelectOrInsert(Lock(), self.conn.session, cache_size=10)
+        self.assertEquals(
+            s_or_i.preload(self.conn.session.query(Pregnancy)), 1)
+        p2 = Pregnancy(result='Patient Not Pregnant')
+        self.assertTrue(s_or_i.cache_lookup(p2) is p2)
+        self.assertEquals(p2.pk, preg.pk)
+
+
+def acquire_and_die(lock):  # pragma: no cover (out of process)
+    """Target acquiring the lock, exiting without release"""
+    lock.acquire()
+
+
+class TestTrackedLock(unittest.TestCase):
+    """Locks held by dead processes can be released"""
+    def testReleaseDead(self):
+        lock = TrackedLock()
+        proc = Process(target=acquire_and_die, args=(lock,))
+        proc.start()
+        proc.join()
+        self.assertFalse(lock.release_if_held_by(proc.pid + 1))
+        self.assertTrue(lock.release_if_held_by(proc.pid))
+        lock.acquire()
+        lock.release()
+
+    def testReleaseOrphaned(self):
+        lock = TrackedLock()
+        lock.ORPHAN_SECONDS = 0.1
+        # As if the holder died before recording its pid
+        lock._lock.acquire()
+        self.assertTrue(lock.release_if_held_by(12345))
+        lock.acquire()
+        # A recorded holder is left be
+        self.assertFalse(lock.release_if_held_by(12345))
+        lock.release()
+        self.assertFalse(lock.release_if_held_by(12345))
+
+
+def process_hammer(proc_no, lock, advisory_locks=False):  # pragma: no cover (out of process)
     """The target used from several concurrent processes to hammer on
     the same set of database objects.  Intended to test syncronization
     problems with unique constraints, etc.
 
     """
     conn = db_connection(CONFIG_SECTION)
-    s_or_i = SelectOrInsert(lock, conn.session)
+    s_or_i = SelectOrInsert(lock, conn.session,
+                            advisory_locks=advisory_locks)
     #print "enter proc_no %d" % proc_no
     "Loops over the same set 3 times - this reliably breaks w/o locks"
     for i in range(0, 3):
@@ -119,3 +237,15 @@ class MultiProcessTest(unittest.TestCase):
         [p.join() for p in procs]
 
         self.assertEquals(query.count(), 10)
+
+    def testMultiProcAdvisory(self):
+        "Same hammering, synchronized by per value advisory locks"
+        query = self.conn.session.query(Location)
+        self.assertEquals(query.count(), 0)
+
+        procs = [Process(target=process_hammer, args=(e, None, True))
+                 for e in range(3)]
+        [p.start() for p in procs]
+        [p.join() for p in procs]
+
+        self.assertEquals(query.count(), 10)
@@ -2,14 +2,15 @@ import datetime
 import unittest
 from decimal import Decimal
 
-from pheme.longitudinal.tables import create_tables
+from pheme.longitudinal.tables import create_tables, upgrade_tables
 from pheme.longitudinal.tables import AdmissionSource, AssignedLocation
 from pheme.longitudinal.tables import AdmissionTemp, AdmissionO2sat
 from pheme.longitudinal.tables import ChiefComplaint, FluVaccine, H1N1Vaccine
 from pheme.longitudinal.tables import Disposition, Diagnosis, Location
 from pheme.longitudinal.tables import Note, PerformingLab, SpecimenSource
 from pheme.longitudinal.tables import Facility, Pregnancy, Race, ServiceArea
-from pheme.longitudinal.tables import LabResult, Visit
+from pheme.longitudinal.tables import LabResult, PendingVisit, Visit
+from pheme.longitudinal.tables import EssenceFlat, refresh_essence_flat
 from pheme.util.config import Config, configure_logging
 from pheme.util.pg_access import AlchemyAccess, db_params
 
@@ -238,6 +239,27 @@ class TestLongitudinalAccess(unittest.TestCase):
         self.assertEquals(1, query.count())
         self.assertEquals(query.first().status, 'Not Applicable (Age&lt;18)')
 
+    def testPendingVisit(self):
+        self.commit_test_obj(PendingVisit(
+            visit_id='284999^^^&650903.98473.0179.6039.1.333.1&ISO',
+            pending_count=3,
+            oldest_message=datetime.datetime(2007, 1, 1)))
+        query = self.session.query(PendingVisit)
+        self.assertEquals(1, query.count())
+        self.assertEquals(query.first().pending_count, 3)
+
+    def testUpgradeKeepsQueue(self):
+        "Upgrades leave the queue, and claims on it, be"
+        self.commit_test_obj(PendingVisit(
+            visit_id='284999^^^&650903.98473.0179.6039.1.333.1&ISO',
+            pending_count=3, claimed_by='peer',
+            oldest_message=datetime.datetime(2007, 1, 1),
+            lease_expires=datetime.datetime.now()))
+        upgrade_tables(**db_params(CONFIG_SECTION))
+        self.session.expire_all()
+        self.assertEquals(self.session.query(PendingVisit).one().claimed_by,
+                          'peer')
+
     def testVisit(self):
         "Test with minimal required fields set"
         self.commit_test_obj(Facility(county='NEAR', npi=123454321,
@@ -257,5 +279,28 @@ class TestLongitudinalAccess(unittest.TestCase):
         self.assertEquals(1, query.count())
         self.assertEquals(query.first().ever_in_icu, False)
 
+    def testEssenceFlat(self):
+        self.commit_test_obj(Facility(county='NEAR', npi=123454321,
+                                      zip='99999',
+                                      organization_name='Nearby Medical '
+                                      'Center', local_code='NMC'))
+        visit_id = '284999^^^&650903.98473.0179.6039.1.333.1&ISO'
+        self.commit_test_obj(Visit(
+            visit_id=visit_id, patient_class='E',
+            patient_id='156999^^^&650903.98473.0179.6039.1.333.1&ISO',
+            admit_datetime=datetime.datetime(2007, 01, 01, 13, 30),
+            first_message=datetime.datetime(2007, 01, 01),
+            last_message=datetime.datetime(2007, 01, 01),
+            dim_facility_pk=123454321))
+        engine = self.alchemy.engine
+        self.assertEquals(refresh_essence_flat(engine), 1)
+        self.assertEquals(refresh_essence_flat(engine, visit_id=visit_id),
+                          1)
+        flat = self.session.query(EssenceFlat).one()
+        self.assertEquals(flat.hospital, 'Nearby Medical Center')
+        self.assertEquals(flat.visit_date, '01/01/2007')
+        self.assertEquals(flat.visit_time, '13:30:00')
+        self.assertEquals(flat.diagnosis, None)
+
 if '__main__' == __name__:  # pragma: no cover
     unittest.main()
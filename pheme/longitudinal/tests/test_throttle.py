@@ -0,0 +1,44 @@
+import unittest
+
+from pheme.longitudinal.throttle import Throttle
+
+
+class TestThrottle(unittest.TestCase):
+    """Shed load quickly, regain it gradually"""
+    def setUp(self):
+        self.throttle = Throttle(ceiling=5, thresholds={
+            'lock_waits': 10, 'commit_latency': 1.0})
+
+    def testFullSpeed(self):
+        self.assertEquals(self.throttle.level, 5)
+        self.assertFalse(self.throttle.throttled)
+        self.assertEquals(self.throttle.update({'lock_waits': 3}), 5)
+
+    def testDecrease(self):
+        self.assertEquals(self.throttle.update({'lock_waits': 11}), 2)
+        self.assertTrue(self.throttle.throttled)
+        self.assertEquals(self.throttle.update(
+            {'commit_latency': 2.5}), 1)
+        self.assertEquals(self.throttle.update({'lock_waits': 20}), 0)
+        self.assertEquals(self.throttle.update({'lock_waits': 20}), 0)
+
+    def testRecover(self):
+        self.throttle.level = 0
+        for expected in (1, 2, 3, 4, 5, 5):
+            self.assertEquals(self.throttle.update({'lock_waits': 0}),
+                              expected)
+
+    def testExceeded(self):
+        self.assertEquals(self.throttle.exceeded(
+            {'lock_waits': 12, 'commit_latency': 1.5,
+             'replication_lag': 500, 'active_connections': None}),
+            ['commit_latency', 'lock_waits'])
+        self.assertEquals(self.throttle.exceeded(
+            {'lock_waits': None, 'commit_latency': 1.0}), [])
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, Throttle, 0, {})
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,137 @@
+import datetime
+import time
+import unittest
+from multiprocessing import Process, Queue
+
+from pheme.longitudinal.tables import create_tables
+from pheme.longitudinal.tables import PendingVisit
+from pheme.longitudinal.visit_claims import VisitClaims
+from pheme.util.config import Config, configure_logging
+from pheme.util.pg_access import db_connection, db_params
+
+CONFIG_SECTION = 'longitudinal'
+NUM_VISITS = 60
+
+
+def setup_module():
+    """Create a fresh db (once) for all tests in this module"""
+    configure_logging(verbosity=2, logfile='unittest.log')
+    c = Config()
+    if c.get('general', 'in_production'):  # pragma: no cover
+        raise RuntimeError("DO NOT run destructive test on production system")
+
+    create_tables(enable_delete=True, **db_params(CONFIG_SECTION))
+
+
+def claim_all(proc_no, results):  # pragma: no cover (out of process)
+    """Target used from several concurrent processes, each claiming
+    and completing visits till none remain.  Every visit claimed is
+    reported on the results queue.
+
+    """
+    conn = db_connection(CONFIG_SECTION)
+    claims = VisitClaims(conn.engine, owner='claimant-%d' % proc_no,
+                         batch_size=7)
+    while True:
+        visit_id = claims.get()
+        if visit_id is None:
+            break
+        results.put(visit_id)
+        conn.engine.execute("DELETE FROM internal_pending_visit WHERE "
+                            "visit_id = '%s'" % visit_id)
+        claims.task_done()
+    results.put(None)
+    conn.disconnect()
+
+
+class TestVisitClaims(unittest.TestCase):
+    """Claim visits from the pending visit work queue"""
+    def setUp(self):
+        self.conn = db_connection(CONFIG_SECTION)
+        now = datetime.datetime.now()
+        self.conn.session.add_all([
+            PendingVisit(visit_id='visit-%d' % i, pending_count=1,
+                         oldest_message=now - datetime.timedelta(
+                             minutes=i))
+            for i in range(NUM_VISITS)])
+        self.conn.session.commit()
+
+    def tearDown(self):
+        self.conn.session.query(PendingVisit).delete()
+        self.conn.session.commit()
+        self.conn.disconnect()
+
+    def testOldestFirst(self):
+        claims = VisitClaims(self.conn.engine, batch_size=5)
+        self.assertEquals(claims.get(), 'visit-%d' % (NUM_VISITS - 1))
+        self.assertEquals(claims.qsize(), 4)
+
+    def testLeaseHonored(self):
+        first = VisitClaims(self.conn.engine, owner='first',
+                            batch_size=NUM_VISITS)
+        second = VisitClaims(self.conn.engine, owner='second')
+        self.assertTrue(first.get())
+        self.assertEquals(second.get(), None)
+
+    def testExpiredLease(self):
+        first = VisitClaims(self.conn.engine, owner='first',
+                            batch_size=NUM_VISITS, lease_seconds=-1)
+        second = VisitClaims(self.conn.engine, owner='second')
+        self.assertTrue(first.get())
+        self.assertTrue(second.get())
+
+    def testLongVisitKeepsClaim(self):
+        first = VisitClaims(self.conn.engine, owner='first',
+                            batch_size=1, lease_seconds=2)
+        active = first.get()
+        # The visit outlasts its lease, renewed meanwhile
+        time.sleep(3)
+        second = VisitClaims(self.conn.engine, owner='second',
+                             batch_size=NUM_VISITS)
+        self.assertNotEquals(second.get(), active)
+        self.assertEquals(second.qsize(), NUM_VISITS - 2)
+        first.task_done()
+        second.task_done()
+
+    def testRetriesExhausted(self):
+        claimants = [VisitClaims(self.conn.engine, owner='claimant-%d' % i,
+                                 batch_size=1, lease_seconds=-1,
+                                 max_retries=1) for i in range(3)]
+        failing = claimants[0].get()
+        self.assertEquals(claimants[1].get(), failing)
+        # Attempted twice, the failing visit is no longer claimed
+        self.assertNotEquals(claimants[2].get(), failing)
+        self.assertEquals(self.conn.session.query(PendingVisit).get(
+            failing).attempts, 2)
+
+    def testRelease(self):
+        first = VisitClaims(self.conn.engine, owner='first',
+                            batch_size=NUM_VISITS)
+        second = VisitClaims(self.conn.engine, owner='second')
+        self.assertTrue(first.get())
+        first.release()
+        self.assertTrue(second.get())
+
+    def testMultiProc(self):
+        "Several processes claim each visit exactly once"
+        results = Queue()
+        procs = [Process(target=claim_all, args=(e, results)) for e
+                 in range(4)]
+        [p.start() for p in procs]
+
+        claimed, finished = [], 0
+        while finished < len(procs):
+            visit_id = results.get()
+            if visit_id is None:
+                finished += 1
+            else:
+                claimed.append(visit_id)
+        [p.join() for p in procs]
+
+        self.assertEquals(len(claimed), NUM_VISITS)
+        self.assertEquals(len(set(claimed)), NUM_VISITS)
+        self.assertEquals(self.conn.session.query(PendingVisit).count(), 0)
+
+
+if '__main__' == __name__:  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,120 @@
+"""Throttling of deduplication under database load
+
+The mart and warehouse are often shared with other clients, which a
+full speed deduplication run can starve.  The manager samples a few
+load signals from each database (see `database_load`), adds the
+commit latency its workers measure, and lets a `Throttle` decide how
+many visits the workers may have in flight.
+
+"""
+import logging
+
+from sqlalchemy import text
+
+from pheme.util.config import Config
+
+# Load signals, with the default threshold for each.  Override in the
+# [longitudinal] config section as `throttle_<signal>`, i.e.
+# `throttle_lock_waits = 5`, 'off' to ignore the signal.
+SIGNALS = {
+    'active_connections': 40,  # backends running a query
+    'lock_waits': 10,  # backends waiting on a lock
+    'replication_lag': 60,  # seconds standbys are behind
+    'commit_latency': 1.0,  # seconds for a worker to commit a visit
+}
+
+
+def configured_thresholds():
+    """Returns the signal thresholds, as configured"""
+    config = Config()
+    thresholds = {}
+    for signal, default in SIGNALS.items():
+        value = config.get('longitudinal', 'throttle_%s' % signal,
+                           default=default)
+        if str(value).lower() != 'off':
+            thresholds[signal] = float(value)
+    return thresholds
+
+
+def database_load(engine):
+    """Sample the load signals of the database behind engine
+
+    Lock waits depend on postgres 9.6, replication lag on 10 or
+    later.  Replication lag is the worst of the standbys when run on
+    a primary, or this server's own lag when on a standby.
+
+    returns dictionary of active_connections, lock_waits and
+    replication_lag
+
+    """
+    row = engine.execute(text("""SELECT
+      count(*) FILTER (WHERE state = 'active'),
+      count(*) FILTER (WHERE wait_event_type = 'Lock'),
+      greatest(
+        (SELECT max(extract(epoch FROM replay_lag))
+         FROM pg_stat_replication),
+        CASE WHEN pg_is_in_recovery() THEN
+          extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+        END)
+    FROM pg_stat_activity
+    WHERE datname = current_database()
+    AND pid <> pg_backend_pid()""")).first()
+    return {'active_connections': row[0], 'lock_waits': row[1],
+            'replication_lag': float(row[2] or 0)}
+
+
+class Throttle(object):
+    """Additive increase, multiplicative decrease concurrency control
+
+    The `level` is the number of workers allowed busy at once, from 0
+    (paused) up to the `ceiling`.  Each `update` with any signal over
+    its threshold halves the level, otherwise the level is raised by
+    one, so the load is shed quickly and regained gradually.
+
+    """
+    def __init__(self, ceiling, thresholds):
+        """Initialize the throttle, at full speed
+
+        :param ceiling: the highest level, i.e. the number of workers
+        :param thresholds: dictionary of signal thresholds, signals
+          without one are ignored
+
+        """
+        if ceiling < 1:
+            raise ValueError("ceiling must be positive")
+        self.ceiling = ceiling
+        self.thresholds = thresholds
+        self.level = ceiling
+
+    @property
+    def throttled(self):
+        return self.level < self.ceiling
+
+    def exceeded(self, signals):
+        """Returns the names of the signals over threshold"""
+        return sorted(signal for signal, value in signals.items()
+                      if value is not None and signal in self.thresholds
+                      and value > self.thresholds[signal])
+
+    def update(self, signals):
+        """Adjust the level for the latest signals
+
+        :param signals: dictionary of signal values, None if unknown
+
+        returns the new level
+
+        """
+        exceeded = self.exceeded(signals)
+        level = self.level
+        if exceeded:
+            self.level //= 2
+        elif self.level < self.ceiling:
+            self.level += 1
+        if self.level < level:
+            logging.warn("database load (%s), throttling to %d workers",
+                         ', '.join('%s %s' % (signal, signals[signal])
+                                   for signal in exceeded), self.level)
+        elif self.level > level:
+            logging.info("database load eased, ramping up to %d workers",
+                         self.level)
+        return self.level
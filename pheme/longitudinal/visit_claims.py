@@ -0,0 +1,173 @@
+"""Database backed work claiming for distributed workers
+
+Longitudinal workers launched by managers on any number of hosts can
+share the deduplication load of a single data mart, by claiming
+batches of visits from the internal_pending_visit work queue rather
+than reading from a `multiprocessing.JoinableQueue` filled by a
+single manager.
+
+"""
+import logging
+import os
+import socket
+import threading
+
+from sqlalchemy.sql import text
+
+
+class VisitClaims(object):
+    """Queue like interface to claim pending visits from the mart
+
+    Presents the subset of the `JoinableQueue` interface used by the
+    `LongitudinalWorker`, so the worker's run loop needn't care where
+    its visits come from.
+
+    Batches of visits are claimed using `SELECT ... FOR UPDATE SKIP
+    LOCKED`, so concurrent claimants never block on, nor receive, the
+    same rows.  A claim is a lease - should the claimant die, the
+    visits become claimable again once the lease expires.  Leases on
+    the active visit and those yet to be processed are renewed (the
+    heartbeat) as each visit is completed, and from a background
+    thread every `lease_seconds` / RENEWALS while a visit is being
+    processed, so a visit outlasting the lease keeps its claim.
+
+    The worker removes a visit from the work queue once processed, see
+    `LongitudinalWorker._mark_processed`.  A visit that fails keeps
+    its claim until the lease expires, so it isn't retried by every
+    worker in turn.  Each visit handed out counts an attempt, and
+    once retried `max_retries` times it's no longer claimed - it
+    remains pending till new messages for it reset the count, as for
+    the manager's requeue of visits of dead workers.
+
+    """
+    BATCH_SIZE = 25
+    LEASE_SECONDS = 600
+    MAX_RETRIES = 1
+    RENEWALS = 3  # heartbeats per lease during a visit
+
+    def __init__(self, engine, owner=None, batch_size=BATCH_SIZE,
+                 lease_seconds=LEASE_SECONDS, max_retries=MAX_RETRIES):
+        """Initialize the claimant
+
+        :param engine: sqlalchemy engine for the data mart
+        :param owner: unique name for the claimant, defaults to
+          hostname:pid
+        :param batch_size: number of visits to claim at a time
+        :param lease_seconds: time a claim is honored without a
+          heartbeat
+        :param max_retries: times a visit is claimed again after its
+          first attempt
+
+        """
+        self.engine = engine
+        self.owner = owner or "%s:%d" % (socket.gethostname(),
+                                         os.getpid())
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_retries = max_retries
+        self._claimed = []
+        self._active = None
+        self._renewing = None
+
+    def _claim(self):
+        """Claim the next batch of unclaimed (or expired) visits"""
+        rs = self.engine.execute(text("""UPDATE internal_pending_visit
+        SET claimed_by = :owner,
+          lease_expires = now() + :lease * interval '1 second'
+        WHERE visit_id IN (
+          SELECT visit_id FROM internal_pending_visit
+          WHERE (lease_expires IS NULL OR lease_expires < now())
+          AND attempts <= :max_retries
+          ORDER BY oldest_message LIMIT :batch_size
+          FOR UPDATE SKIP LOCKED)
+        RETURNING visit_id, oldest_message"""),
+                                 owner=self.owner,
+                                 lease=self.lease_seconds,
+                                 max_retries=self.max_retries,
+                                 batch_size=self.batch_size)
+        claimed = sorted(rs.fetchall(), key=lambda r: r[1])
+        self._claimed = [r[0] for r in claimed]
+        logging.debug("%s: claimed %d visits", self.owner,
+                      len(self._claimed))
+
+    def heartbeat(self):
+        """Renew the lease on the active and yet to process visits"""
+        visit_ids = list(self._claimed)
+        if self._active is not None:
+            visit_ids.append(self._active)
+        if not visit_ids:
+            return
+        self.engine.execute(text("""UPDATE internal_pending_visit SET
+        lease_expires = now() + :lease * interval '1 second'
+        WHERE claimed_by = :owner AND visit_id = ANY(:visit_ids)"""),
+                            owner=self.owner, lease=self.lease_seconds,
+                            visit_ids=visit_ids)
+
+    def _start_renewal(self):
+        """Heartbeat from a thread, till `_stop_renewal`"""
+        if self.lease_seconds <= 0:
+            return
+        interval = float(self.lease_seconds) / self.RENEWALS
+        done = self._renewing = threading.Event()
+
+        def renew():
+            while not done.wait(interval):
+                try:
+                    self.heartbeat()
+                except Exception:
+                    logging.exception("%s: failed to renew lease",
+                                      self.owner)
+        thread = threading.Thread(target=renew, name='lease-renewal')
+        thread.daemon = True
+        thread.start()
+
+    def _stop_renewal(self):
+        if self._renewing is not None:
+            self._renewing.set()
+            self._renewing = None
+
+    def get(self):
+        """Returns the next claimed visit_id, None once out of work"""
+        self._stop_renewal()
+        if not self._claimed:
+            self._claim()
+        if not self._claimed:
+            self._active = None
+            return None
+        self._active = self._claimed.pop(0)
+        attempts = self.engine.execute(text("""UPDATE
+        internal_pending_visit SET attempts = attempts + 1
+        WHERE claimed_by = :owner AND visit_id = :visit_id
+        RETURNING attempts"""), owner=self.owner,
+                                       visit_id=self._active).scalar()
+        if attempts > self.max_retries:
+            logging.warn("%s: last attempt at visit %s, it won't be "
+                         "claimed again till new messages arrive",
+                         self.owner, self._active)
+        self._start_renewal()
+        return self._active
+
+    def task_done(self):
+        """Called as each visit is completed, renews remaining leases"""
+        self._stop_renewal()
+        self._active = None
+        self.heartbeat()
+
+    def empty(self):
+        """Claims are only exhausted once `get` returns None"""
+        return False
+
+    def qsize(self):
+        """Number of visits claimed, yet to be processed"""
+        return len(self._claimed)
+
+    def release(self):
+        """Give up claims on any visits not yet processed"""
+        self._stop_renewal()
+        if not self._claimed:
+            return
+        self.engine.execute(text("""UPDATE internal_pending_visit SET
+        claimed_by = NULL, lease_expires = NULL
+        WHERE claimed_by = :owner AND visit_id = ANY(:visit_ids)"""),
+                            owner=self.owner, visit_ids=self._claimed)
+        self._claimed = []
@@ -32,9 +32,11 @@ setup(name='pheme.longitudinal',
       entry_points=("""
                     [console_scripts]
                     create_longitudinal_tables=pheme.longitudinal.tables:main
+                    upgrade_longitudinal_tables=pheme.longitudinal.tables:upgrade
                     load_static_data=pheme.longitudinal.static_data:load
                     dump_static_data=pheme.longitudinal.static_data:dump
                     generate_daily_essence_report=pheme.longitudinal.generate_daily_essence_report:main
                     longitudinal_manager=pheme.longitudinal.longitudinal_manager:main
+                    install_notify_trigger=pheme.longitudinal.notify:install
                     """),
 )